@@ -0,0 +1,328 @@
+"""
+Benchmark del simulatore di chiusura degli uffici postali (postal-simulation.py)
+
+Genera dataset sintetici di dimensione crescente, fino alla scala nazionale
+(circa 13k UP, 50k LIS, 20k banche, 400k sezioni di censimento), e misura
+separatamente le fasi del simulatore:
+
+- carica_dati: costruzione di SimulazioneChiusuraUP (lettura dei file,
+  densità delle sezioni, archivi e BallTree)
+- prepara_balltree: sola ricostruzione dei BallTree
+- simula_chiusura_up: una chiusura a cache vuota e una con le cache già popolate
+- sweep: simula_chiusure_batch su tutti gli uffici e simula_scenario_chiusure
+  sul 10% degli uffici
+- visualizza_mappa_redistribuzione: costruzione e rendering HTML della mappa,
+  in modalità 'marker' e 'geojson'
+
+I risultati vengono salvati in JSON (metadati dell'ambiente e un record per
+ogni misura), così da poter confrontare esecuzioni diverse nel tempo.
+
+Esempio:
+    python benchmark_simulazione.py --dimensioni piccolo medio --output benchmark.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# Dimensioni dei dataset: (UP, LIS, banche, sezioni di censimento)
+DIMENSIONI = {
+    'minimo': (500, 2_000, 800, 10_000),
+    'piccolo': (1_300, 5_000, 2_000, 40_000),
+    'medio': (5_000, 20_000, 8_000, 150_000),
+    'nazionale': (13_000, 50_000, 20_000, 400_000),
+}
+
+# Area di generazione dei punti (riquadro dell'Italia peninsulare)
+LONGITUDINE = (7.0, 18.0)
+LATITUDINE = (37.0, 46.5)
+
+SERVIZI_LIS = ['bollettini', 'bollette', 'pagoPA', 'ricariche_postepay', 'ricariche_telefoniche', 'pacchi']
+SERVIZI_UP = ['polizze', 'conti', 'fibra', 'energia', 'altri_servizi']
+
+
+def carica_simulatore():
+    """
+    Importa postal-simulation.py (il nome con il trattino non è importabile direttamente)
+    """
+    percorso = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'postal-simulation.py')
+    spec = importlib.util.spec_from_file_location('postal_simulation', percorso)
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules['postal_simulation'] = modulo
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def genera_punti(rng, n, centri, quota_urbana=0.7):
+    """
+    Genera punti concentrati attorno ai centri urbani, più una quota sparsa
+    uniformemente, per avere densità di vicini realistiche
+    """
+    n_urbani = int(n * quota_urbana)
+    centro = rng.integers(0, len(centri), n_urbani)
+    scala = rng.uniform(0.02, 0.15, len(centri))[centro]
+    lon = np.concatenate([
+        centri[centro, 0] + rng.normal(0, 1, n_urbani) * scala,
+        rng.uniform(*LONGITUDINE, n - n_urbani)
+    ])
+    lat = np.concatenate([
+        centri[centro, 1] + rng.normal(0, 1, n_urbani) * scala,
+        rng.uniform(*LATITUDINE, n - n_urbani)
+    ])
+    return lon, lat
+
+
+def genera_dati(cartella, n_up, n_lis, n_banche, n_sezioni, seed=0):
+    """
+    Scrive nella cartella un dataset sintetico nel formato letto da carica_dati
+
+    Parameters:
+    -----------
+    cartella : str
+        Cartella di destinazione
+    n_up, n_lis, n_banche, n_sezioni : int
+        Numero di uffici postali, LIS, banche e sezioni di censimento
+    seed : int, optional
+        Seme del generatore casuale
+
+    Returns:
+    --------
+    dict : percorsi dei file generati
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(cartella, exist_ok=True)
+    centri = np.column_stack([rng.uniform(*LONGITUDINE, 100), rng.uniform(*LATITUDINE, 100)])
+
+    lon, lat = genera_punti(rng, n_up, centri)
+    df_up = pd.DataFrame({
+        'id': np.arange(1, n_up + 1),
+        'nome': [f'UP {i}' for i in range(1, n_up + 1)],
+        'longitude': lon,
+        'latitude': lat
+    })
+    for servizio in SERVIZI_LIS + SERVIZI_UP:
+        df_up[servizio] = rng.integers(100, 5000, n_up).astype(float)
+
+    lon, lat = genera_punti(rng, n_lis, centri)
+    df_lis = pd.DataFrame({
+        'id': [f'LIS{i}' for i in range(n_lis)],
+        'nome': [f'LIS {i}' for i in range(n_lis)],
+        'longitude': lon,
+        'latitude': lat
+    })
+    for servizio in SERVIZI_LIS:
+        df_lis[f'abilitato_{servizio}'] = rng.random(n_lis) < 0.6
+
+    lon, lat = genera_punti(rng, n_banche, centri)
+    df_banche = pd.DataFrame({
+        'id': np.arange(n_banche),
+        'nome': [f'Banca {i}' for i in range(n_banche)],
+        'gruppo': rng.choice(['Gruppo A', 'Gruppo B', 'Gruppo C'], n_banche),
+        'longitude': lon,
+        'latitude': lat
+    })
+
+    # Sezioni di censimento: griglia regolare sul riquadro
+    lato = int(np.ceil(np.sqrt(n_sezioni)))
+    x = np.linspace(*LONGITUDINE, lato + 1)
+    y = np.linspace(*LATITUDINE, lato + 1)
+    xmin, ymin = np.meshgrid(x[:-1], y[:-1])
+    xmax, ymax = np.meshgrid(x[1:], y[1:])
+    geometrie = shapely.box(xmin.ravel(), ymin.ravel(), xmax.ravel(), ymax.ravel())[:n_sezioni]
+    gdf_sezioni = gpd.GeoDataFrame(
+        {'popolazione': rng.integers(0, 3000, len(geometrie))}, geometry=geometrie, crs='EPSG:4326'
+    )
+
+    percorsi = {
+        'file_up': os.path.join(cartella, 'up.csv'),
+        'file_lis': os.path.join(cartella, 'lis.csv'),
+        'file_banche': os.path.join(cartella, 'banche.csv'),
+        'file_sezioni_censimento': os.path.join(cartella, 'sezioni.gpkg'),
+        'file_presenze': os.path.join(cartella, 'presenze.csv'),
+    }
+    df_up.to_csv(percorsi['file_up'], index=False)
+    df_lis.to_csv(percorsi['file_lis'], index=False)
+    df_banche.to_csv(percorsi['file_banche'], index=False)
+    gdf_sezioni.to_file(percorsi['file_sezioni_censimento'])
+    pd.DataFrame({'id': df_up['id'], 'presenze': 1}).to_csv(percorsi['file_presenze'], index=False)
+    return percorsi
+
+
+def cronometra(funzione, ripetizioni):
+    """
+    Esegue la funzione più volte e restituisce i tempi in secondi e l'ultimo risultato
+    """
+    tempi = []
+    risultato = None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        risultato = funzione()
+        tempi.append(time.perf_counter() - inizio)
+    return tempi, risultato
+
+
+def memoria_picco_mb():
+    # Picco di memoria residente del processo (solo sistemi Unix)
+    try:
+        import resource
+    except ImportError:
+        return None
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return picco / 1024 ** 2 if sys.platform == 'darwin' else picco / 1024
+
+
+def esegui_benchmark(modulo, dimensione, cartella_dati, ripetizioni=3, n_singole=20, seed=0):
+    """
+    Misura le fasi del simulatore su un dataset sintetico
+
+    Parameters:
+    -----------
+    modulo : module
+        Modulo postal-simulation caricato con carica_simulatore
+    dimensione : str
+        Chiave di DIMENSIONI
+    cartella_dati : str
+        Cartella in cui generare il dataset
+    ripetizioni : int, optional
+        Ripetizioni di ogni misura
+    n_singole : int, optional
+        Numero di uffici per la misura di simula_chiusura_up
+    seed : int, optional
+        Seme del generatore casuale
+
+    Returns:
+    --------
+    list : un record (dict) per fase e ripetizione
+    """
+    n_up, n_lis, n_banche, n_sezioni = DIMENSIONI[dimensione]
+    record = []
+
+    def registra(fase, tempi, **extra):
+        for ripetizione, secondi in enumerate(tempi):
+            record.append({
+                'dimensione': dimensione, 'n_up': n_up, 'n_lis': n_lis, 'n_banche': n_banche,
+                'n_sezioni': n_sezioni, 'fase': fase, 'ripetizione': ripetizione,
+                'secondi': secondi, **extra
+            })
+        etichetta = ' '.join([fase] + [f'{k}={v}' for k, v in extra.items() if isinstance(v, str)])
+        print(f"  {etichetta:<50} mediana {np.median(tempi):9.4f} s")
+
+    inizio = time.perf_counter()
+    percorsi = genera_dati(cartella_dati, n_up, n_lis, n_banche, n_sezioni, seed)
+    print(f"[{dimensione}] dati generati in {time.perf_counter() - inizio:.1f} s")
+
+    tempi, simulazione = cronometra(lambda: modulo.SimulazioneChiusuraUP(**percorsi), ripetizioni)
+    registra('carica_dati', tempi)
+
+    tempi, _ = cronometra(simulazione.prepara_balltree, ripetizioni)
+    registra('prepara_balltree', tempi)
+
+    ids = simulazione.df_up['id'].to_numpy()
+    campione = np.random.default_rng(seed).choice(ids, min(n_singole, len(ids)), replace=False)
+
+    def chiusure_singole():
+        for id_up in campione:
+            simulazione.simula_chiusura_up(id_up)
+
+    def chiusure_singole_a_freddo():
+        simulazione.svuota_cache()
+        chiusure_singole()
+
+    tempi, _ = cronometra(chiusure_singole_a_freddo, ripetizioni)
+    registra('simula_chiusura_up', [t / len(campione) for t in tempi], cache='vuota')
+    tempi, _ = cronometra(chiusure_singole, ripetizioni)
+    registra('simula_chiusura_up', [t / len(campione) for t in tempi], cache='popolata')
+
+    tempi, batch = cronometra(lambda: simulazione.simula_chiusure_batch(ids), ripetizioni)
+    registra('sweep_simula_chiusure_batch', tempi, n_flussi=len(batch['flussi']))
+
+    chiusi = ids[::10]
+    tempi, _ = cronometra(lambda: simulazione.simula_scenario_chiusure(chiusi), ripetizioni)
+    registra('sweep_simula_scenario_chiusure', tempi, n_chiusi=len(chiusi))
+
+    # Bacino knn con metà degli uffici chiusi
+    chiusi_knn = ids[::2]
+    bacino_knn = {'bacino': {'modalita': 'knn', 'k': 1}}
+    tempi, _ = cronometra(
+        lambda: simulazione.simula_scenario_chiusure(chiusi_knn, bacino_knn), ripetizioni
+    )
+    registra('sweep_simula_scenario_chiusure', tempi, n_chiusi=len(chiusi_knn), bacino='knn')
+
+    # Mappa dell'ufficio con più punti riceventi (il caso peggiore per il rendering)
+    densissimo = batch['flussi'].groupby('id_up', observed=True).size().idxmax()
+    risultati = simulazione.simula_chiusura_up(densissimo)
+    for modalita in ('marker', 'geojson'):
+        tempi, html = cronometra(
+            lambda: simulazione.visualizza_mappa_redistribuzione(risultati, modalita).get_root().render(),
+            ripetizioni
+        )
+        registra('visualizza_mappa_redistribuzione', tempi, modalita=modalita, dimensione_html=len(html))
+
+    record.append({'dimensione': dimensione, 'fase': 'memoria_picco_mb', 'valore': memoria_picco_mb()})
+    return record
+
+
+def metadati_ambiente():
+    """
+    Versioni e commit correnti, per confrontare esecuzioni su macchine o revisioni diverse
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    import sklearn
+    return {
+        'data': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'piattaforma': platform.platform(),
+        'cpu': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'geopandas': gpd.__version__,
+        'shapely': shapely.__version__,
+        'scikit-learn': sklearn.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del simulatore di chiusura UP')
+    parser.add_argument('--dimensioni', nargs='+', default=['minimo', 'piccolo'], choices=list(DIMENSIONI),
+                        help='Dimensioni dei dataset da misurare')
+    parser.add_argument('--ripetizioni', type=int, default=3, help='Ripetizioni di ogni misura')
+    parser.add_argument('--n-singole', type=int, default=20, help='Uffici per la misura di simula_chiusura_up')
+    parser.add_argument('--cartella-dati', default=None,
+                        help='Cartella per i dataset generati (default: cartella temporanea)')
+    parser.add_argument('--output', default='benchmark_simulazione.json', help='File JSON dei risultati')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    modulo = carica_simulatore()
+    record = []
+    with tempfile.TemporaryDirectory() as temporanea:
+        for dimensione in args.dimensioni:
+            cartella = os.path.join(args.cartella_dati or temporanea, dimensione)
+            record.extend(esegui_benchmark(modulo, dimensione, cartella, args.ripetizioni,
+                                           args.n_singole, args.seed))
+
+    with open(args.output, 'w') as f:
+        json.dump({'ambiente': metadati_ambiente(), 'misure': record}, f, indent=2, default=float)
+    print(f"Risultati salvati in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
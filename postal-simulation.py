@@ -1,377 +1,3001 @@
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-import matplotlib.pyplot as plt
-import ipywidgets as widgets
-from ipywidgets import interact, fixed
-from IPython.display import display, HTML
-import folium
-from folium.plugins import MarkerCluster
-from shapely.geometry import Point, Polygon
-import contextily as ctx
+import shapely
+from shapely.geometry import Point
+from shapely.strtree import STRtree
+import sklearn
 from sklearn.neighbors import BallTree
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+from scipy.sparse.csgraph import dijkstra
 import math
+import copy
+import os
+import pickle
+import tempfile
+import shutil
+import glob
+import hashlib
+import re
+import itertools
+import json
+from collections import OrderedDict
+import asyncio
+import time
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Le dipendenze di visualizzazione (matplotlib, folium, ipywidgets, IPython) sono
+# importate solo dai metodi che le usano, così il motore di simulazione resta
+# utilizzabile in batch senza lo stack dei notebook
+
+# Raggio medio terrestre in km, per convertire le distanze haversine dei BallTree
+RAGGIO_TERRA_KM = 6371.0
+
+# Sistema di riferimento metrico equivalente (ETRS89-LAEA) per il calcolo delle aree
+CRS_METRICO = "EPSG:3035"
+
+# Densità di popolazione (abitanti/km²) usata per i punti fuori dalle sezioni di censimento
+DENSITA_DEFAULT = 1000
+
+# Versione del formato della cache dei dati preparati (da incrementare se cambia)
+VERSIONE_CACHE = 1
+
+# Velocità (km/h) per tipo di strada OSM, usate quando manca il tag maxspeed
+VELOCITA_STRADE = {
+    'motorway': 110, 'motorway_link': 60,
+    'trunk': 90, 'trunk_link': 50,
+    'primary': 70, 'primary_link': 40,
+    'secondary': 60, 'secondary_link': 40,
+    'tertiary': 50, 'tertiary_link': 30,
+    'unclassified': 40, 'residential': 30, 'living_street': 10, 'service': 20,
+}
+VELOCITA_DEFAULT_KMH = 30
+
+# Velocità (km/h) con cui si percorre il tratto tra un punto e il nodo stradale più vicino
+VELOCITA_ACCESSO_KMH = 20
+
+def pesi_inversi_distanza(gruppo, distanza, n_gruppi, maschera=None):
+    """
+    Calcola pesi inversamente proporzionali al quadrato della distanza,
+    normalizzati a somma 1 all'interno di ogni gruppo
+    
+    Parameters:
+    -----------
+    gruppo : ndarray
+        Gruppo (ufficio chiuso) di appartenenza di ogni vicino
+    distanza : ndarray
+        Distanza in km di ogni vicino
+    n_gruppi : int
+        Numero totale di gruppi
+    maschera : ndarray, optional
+        Vicini da considerare; gli altri ricevono peso 0
+        
+    Returns:
+    --------
+    ndarray : pesi normalizzati per gruppo (0 per i gruppi senza vicini validi)
+    """
+    # Peso come inverso della distanza al quadrato (con limite minimo), come calcola_pesi_distanza
+    peso = 1 / np.maximum(distanza ** 2, 0.01)
+    if maschera is not None:
+        peso = peso * maschera
+    somma = np.bincount(gruppo, weights=peso, minlength=n_gruppi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(somma[gruppo] > 0, peso / somma[gruppo], 0.0)
+
+
+def campiona_coefficienti(distribuzione, n_campioni, concentrazione, rng):
+    """
+    Campiona coefficienti di ridistribuzione da una Dirichlet centrata sui valori dati
+    
+    Parameters:
+    -----------
+    distribuzione : dict
+        Coefficienti di default di un servizio (es. {'up_vicini': 0.4, ...})
+    n_campioni : int
+        Numero di campioni
+    concentrazione : float
+        Concentrazione della Dirichlet: più è alta, più i campioni sono vicini ai default
+    rng : numpy.random.Generator
+        Generatore di numeri casuali
+        
+    Returns:
+    --------
+    dict : array di n_campioni valori per ogni coefficiente (i coefficienti nulli restano 0)
+    """
+    chiavi = list(distribuzione)
+    valori = np.array([distribuzione[c] for c in chiavi], dtype=np.float64)
+    totale = valori.sum()
+    campioni = np.zeros((n_campioni, len(chiavi)))
+    positivi = valori > 0
+    if positivi.any():
+        # Campioni normalizzati alla stessa somma dei coefficienti di default
+        campioni[:, positivi] = rng.dirichlet(
+            concentrazione * valori[positivi] / valori[positivi].sum(), size=n_campioni
+        ) * totale
+    return {c: campioni[:, j] for j, c in enumerate(chiavi)}
+
+
+def salva_balltree(tree, cartella, nome):
+    """
+    Salva un BallTree come file .npy (array) più un file di metadati, in modo
+    che possa essere ricaricato in memory-map senza copiare i dati
+    """
+    stato = list(tree.__getstate__())
+    indici_array = [i for i, valore in enumerate(stato) if isinstance(valore, np.ndarray)]
+    for i in indici_array:
+        np.save(os.path.join(cartella, f'{nome}_{i}.npy'), stato[i])
+        stato[i] = None
+    with open(os.path.join(cartella, f'{nome}_metadati.pkl'), 'wb') as f:
+        pickle.dump({'stato': stato, 'indici_array': indici_array}, f)
+
+
+def carica_balltree(cartella, nome, mmap_mode='r'):
+    """
+    Ricarica un BallTree salvato con salva_balltree
+    """
+    with open(os.path.join(cartella, f'{nome}_metadati.pkl'), 'rb') as f:
+        metadati = pickle.load(f)
+    stato = metadati['stato']
+    for i in metadati['indici_array']:
+        stato[i] = np.load(os.path.join(cartella, f'{nome}_{i}.npy'), mmap_mode=mmap_mode)
+    tree = BallTree.__new__(BallTree)
+    tree.__setstate__(tuple(stato))
+    return tree
+
+
+def chiave_cache(percorsi, hash_contenuto=False):
+    """
+    Calcola la chiave della cache dei dati preparati a partire dai file di input
+    
+    La chiave comprende anche le versioni di numpy e scikit-learn, perché i BallTree
+    sono salvati con il loro stato interno, che può cambiare tra versioni.
+    
+    Parameters:
+    -----------
+    percorsi : list
+        Percorsi dei file di input; per uno shapefile vengono considerati anche
+        i file accessori con lo stesso nome (.dbf, .shx, .prj, ...)
+    hash_contenuto : bool, optional
+        Se True usa l'hash SHA-256 del contenuto invece di dimensione e data di modifica
+        
+    Returns:
+    --------
+    str : chiave esadecimale
+    """
+    h = hashlib.sha256(f'v{VERSIONE_CACHE}:numpy {np.__version__}:sklearn {sklearn.__version__}'.encode())
+    for percorso in percorsi:
+        percorso = os.path.abspath(percorso)
+        file = [percorso]
+        radice, estensione = os.path.splitext(percorso)
+        if estensione.lower() == '.shp':
+            file = sorted(glob.glob(glob.escape(radice) + '.*'))
+        for f in file:
+            h.update(f.encode())
+            if hash_contenuto:
+                with open(f, 'rb') as contenuto:
+                    for blocco in iter(lambda: contenuto.read(1 << 20), b''):
+                        h.update(blocco)
+            else:
+                stato = os.stat(f)
+                h.update(f'{stato.st_size}:{stato.st_mtime_ns}'.encode())
+    return h.hexdigest()[:32]
+
+
+def rimuovi_chiavi_obsolete(cartella_cache, chiave):
+    """
+    Rimuove da cartella_cache le cartelle dei dati preparati con una chiave diversa
+    da chiave (le cartelle dei tempi di percorrenza e quelle temporanee restano)
+    """
+    for nome in os.listdir(cartella_cache):
+        percorso = os.path.join(cartella_cache, nome)
+        if nome != chiave and re.fullmatch(r'[0-9a-f]{32}', nome) and os.path.isdir(percorso):
+            shutil.rmtree(percorso, ignore_errors=True)
+
+
+# Simulatore del processo worker, inizializzato una volta per processo
+_SIMULAZIONE_WORKER = None
+
+
+def _inizializza_worker(cartella):
+    global _SIMULAZIONE_WORKER
+    _SIMULAZIONE_WORKER = SimulazioneChiusuraUP.da_dati_condivisi(cartella)
+
+
+def _simula_blocco(ids_up, personalizza_parametri, formato='dataframe'):
+    # Restituisce anche le statistiche del blocco, da unire a quelle del processo principale
+    statistiche = _SIMULAZIONE_WORKER.statistiche
+    statistiche.azzera()
+    risultati = _SIMULAZIONE_WORKER.simula_chiusure_batch(ids_up, personalizza_parametri, formato)
+    return risultati, statistiche.a_dict()
+
+
+class StatisticheTempi:
+    """
+    Tempi e contatori per fase, aggregati in numero di chiamate, tempo totale e massimo
+    
+    Ogni misura costa due chiamate a time.perf_counter e l'aggiornamento di un
+    dizionario, per cui le statistiche possono restare attive anche nelle
+    esecuzioni batch.
+    """
+    
+    def __init__(self, attiva=True):
+        """
+        Parameters:
+        -----------
+        attiva : bool, optional
+            Se False fase e conta non registrano nulla
+        """
+        self.attiva = attiva
+        self.azzera()
+    
+    def azzera(self):
+        # nome fase → [chiamate, secondi totali, secondi massimi]
+        self._fasi = {}
+        self.contatori = {}
+    
+    @contextmanager
+    def fase(self, nome):
+        """
+        Misura il tempo del blocco with come fase 'nome'
+        """
+        if not self.attiva:
+            yield
+            return
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            durata = time.perf_counter() - inizio
+            misura = self._fasi.get(nome)
+            if misura is None:
+                self._fasi[nome] = [1, durata, durata]
+            else:
+                misura[0] += 1
+                misura[1] += durata
+                if durata > misura[2]:
+                    misura[2] = durata
+    
+    def conta(self, nome, quantita=1):
+        """
+        Incrementa il contatore 'nome'
+        """
+        if self.attiva:
+            self.contatori[nome] = self.contatori.get(nome, 0) + quantita
+    
+    def a_dict(self):
+        """
+        Returns:
+        --------
+        dict : 'fasi' (chiamate, totale_s, medio_s, massimo_s per fase) e 'contatori'
+        """
+        return {
+            'fasi': {
+                nome: {'chiamate': n, 'totale_s': totale, 'medio_s': totale / n, 'massimo_s': massimo}
+                for nome, (n, totale, massimo) in self._fasi.items()
+            },
+            'contatori': dict(self.contatori)
+        }
+    
+    def unisci(self, statistiche):
+        """
+        Aggiunge le statistiche di un'altra istanza, ad esempio di un processo worker
+        
+        Parameters:
+        -----------
+        statistiche : dict
+            Statistiche nel formato di a_dict
+        """
+        if not self.attiva:
+            return
+        for nome, fase in statistiche['fasi'].items():
+            misura = self._fasi.get(nome)
+            if misura is None:
+                self._fasi[nome] = [fase['chiamate'], fase['totale_s'], fase['massimo_s']]
+            else:
+                misura[0] += fase['chiamate']
+                misura[1] += fase['totale_s']
+                misura[2] = max(misura[2], fase['massimo_s'])
+        for nome, quantita in statistiche['contatori'].items():
+            self.conta(nome, quantita)
+    
+    def a_json(self, percorso=None):
+        """
+        Esporta le statistiche in JSON, restituendo il testo e scrivendolo su file se indicato
+        """
+        testo = json.dumps(self.a_dict(), indent=2)
+        if percorso is not None:
+            with open(percorso, 'w') as f:
+                f.write(testo)
+        return testo
+    
+    def a_dataframe(self):
+        """
+        Restituisce le fasi come DataFrame ordinato per tempo totale
+        """
+        fasi = pd.DataFrame.from_dict(self.a_dict()['fasi'], orient='index')
+        return fasi.sort_values('totale_s', ascending=False) if len(fasi) else fasi
+
+
+class CacheLRU:
+    """
+    Cache con politica LRU e statistiche di hit/miss
+    """
+    
+    def __init__(self, capacita=1024):
+        """
+        Parameters:
+        -----------
+        capacita : int, optional
+            Numero massimo di elementi (0 disabilita la memorizzazione)
+        """
+        self.capacita = capacita
+        self._dati = OrderedDict()
+        self.hit = 0
+        self.miss = 0
+    
+    def __len__(self):
+        return len(self._dati)
+    
+    def ottieni(self, chiave, calcola):
+        """
+        Restituisce il valore associato alla chiave, calcolandolo con calcola() se assente
+        """
+        if chiave in self._dati:
+            self.hit += 1
+            self._dati.move_to_end(chiave)
+            return self._dati[chiave]
+        
+        self.miss += 1
+        valore = calcola()
+        if self.capacita > 0:
+            self._dati[chiave] = valore
+            if len(self._dati) > self.capacita:
+                self._dati.popitem(last=False)
+        return valore
+    
+    def svuota(self):
+        self._dati.clear()
+        self.hit = 0
+        self.miss = 0
+    
+    def statistiche(self):
+        richieste = self.hit + self.miss
+        return {
+            'hit': self.hit,
+            'miss': self.miss,
+            'tasso_hit': self.hit / richieste if richieste else 0.0,
+            'dimensione': len(self._dati),
+            'capacita': self.capacita
+        }
+
+
+class ArchivioPunti:
+    """
+    Archivio colonnare di un insieme di punti (UP, LIS o banche)
+    
+    Contiene le coordinate come array NumPy contigui, un indice id → posizione
+    per ricerche O(1) e le matrici numeriche dei volumi e delle abilitazioni
+    ai servizi. Le posizioni coincidono con quelle di righe del DataFrame di origine
+    e degli alberi BallTree costruiti sulle stesse coordinate.
+    """
+    
+    def __init__(self, df, prefisso_abilitazioni='abilitato_'):
+        """
+        Parameters:
+        -----------
+        df : DataFrame
+            Dati dei punti con colonne 'id', 'longitude' e 'latitude'
+        prefisso_abilitazioni : str, optional
+            Prefisso delle colonne booleane di abilitazione ai servizi
+        """
+        # Matrice dei volumi: tutte le colonne numeriche tranne id e coordinate
+        escluse = {'id', 'longitude', 'latitude'}
+        numeriche = df.select_dtypes(include='number').columns
+        colonne_volumi = [c for c in numeriche if c not in escluse]
+        
+        # Matrice delle abilitazioni ai servizi (colonne 'abilitato_<servizio>')
+        colonne_abilitazioni = [c for c in df.columns if str(c).startswith(prefisso_abilitazioni)]
+        
+        self._imposta(
+            ids=df['id'].to_numpy(),
+            lon=np.ascontiguousarray(df['longitude'], dtype=np.float64),
+            lat=np.ascontiguousarray(df['latitude'], dtype=np.float64),
+            colonne_volumi=colonne_volumi,
+            volumi=np.ascontiguousarray(df[colonne_volumi].to_numpy(dtype=np.float64)),
+            servizi_abilitati=[c[len(prefisso_abilitazioni):] for c in colonne_abilitazioni],
+            abilitazioni=np.ascontiguousarray((df[colonne_abilitazioni] == True).to_numpy(dtype=bool))
+        )
+    
+    def _imposta(self, ids, lon, lat, colonne_volumi, volumi, servizi_abilitati, abilitazioni):
+        self.ids = ids
+        self.lon = lon
+        self.lat = lat
+        # Coordinate in radianti nell'ordine (lat, lon) richiesto dalla metrica haversine
+        self.coord_rad = np.ascontiguousarray(np.radians(np.column_stack([lat, lon])))
+        
+        # Indice id → posizione (in caso di duplicati vale la prima occorrenza)
+        primi = ~pd.Index(ids).duplicated(keep='first')
+        self._indice = pd.Index(ids[primi])
+        self._posizioni = np.flatnonzero(primi)
+        
+        self.colonne_volumi = list(colonne_volumi)
+        self._colonna_volume = {c: j for j, c in enumerate(self.colonne_volumi)}
+        self.volumi = volumi
+        
+        self.servizi_abilitati = list(servizi_abilitati)
+        self._colonna_abilitazione = {s: j for j, s in enumerate(self.servizi_abilitati)}
+        self.abilitazioni = abilitazioni
+    
+    def salva(self, cartella, nome):
+        """
+        Salva gli array dell'archivio come file .npy, leggibili in memory-map
+        
+        Parameters:
+        -----------
+        cartella : str
+            Cartella di destinazione
+        nome : str
+            Prefisso dei file (es. 'up')
+        """
+        for attributo in ('lon', 'lat', 'volumi', 'abilitazioni'):
+            np.save(os.path.join(cartella, f'{nome}_{attributo}.npy'), getattr(self, attributo))
+        # Gli id numerici vanno in un .npy, gli id testuali nei metadati
+        ids_numerici = self.ids.dtype != object
+        if ids_numerici:
+            np.save(os.path.join(cartella, f'{nome}_ids.npy'), self.ids)
+        metadati = {
+            'colonne_volumi': self.colonne_volumi,
+            'servizi_abilitati': self.servizi_abilitati,
+            'ids': None if ids_numerici else self.ids
+        }
+        with open(os.path.join(cartella, f'{nome}_metadati.pkl'), 'wb') as f:
+            pickle.dump(metadati, f)
+    
+    @classmethod
+    def carica(cls, cartella, nome, mmap_mode='r'):
+        """
+        Carica un archivio salvato con salva, mappando gli array in memoria
+        
+        Parameters:
+        -----------
+        cartella : str
+            Cartella dei file
+        nome : str
+            Prefisso dei file (es. 'up')
+        mmap_mode : str, optional
+            Modalità di np.load (default 'r': sola lettura condivisa tra processi)
+            
+        Returns:
+        --------
+        ArchivioPunti
+        """
+        with open(os.path.join(cartella, f'{nome}_metadati.pkl'), 'rb') as f:
+            metadati = pickle.load(f)
+        
+        def carica_array(attributo):
+            return np.load(os.path.join(cartella, f'{nome}_{attributo}.npy'), mmap_mode=mmap_mode)
+        
+        archivio = cls.__new__(cls)
+        archivio._imposta(
+            ids=carica_array('ids') if metadati['ids'] is None else metadati['ids'],
+            lon=carica_array('lon'),
+            lat=carica_array('lat'),
+            colonne_volumi=metadati['colonne_volumi'],
+            volumi=carica_array('volumi'),
+            servizi_abilitati=metadati['servizi_abilitati'],
+            abilitazioni=carica_array('abilitazioni')
+        )
+        return archivio
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def posizione(self, id_punto):
+        """
+        Restituisce la posizione di un punto dato il suo id, -1 se non presente
+        """
+        try:
+            return int(self._posizioni[self._indice.get_loc(id_punto)])
+        except (KeyError, TypeError):
+            return -1
+    
+    def posizioni(self, ids):
+        """
+        Restituisce le posizioni di un array di id, -1 per quelli non presenti
+        """
+        loc = self._indice.get_indexer(np.atleast_1d(np.asarray(ids)))
+        return np.where(loc >= 0, self._posizioni[loc], -1)
+    
+    def ha_volume(self, servizio):
+        return servizio in self._colonna_volume
+    
+    def volume(self, servizio):
+        """
+        Restituisce il vettore dei volumi di un servizio
+        """
+        return self.volumi[:, self._colonna_volume[servizio]]
+    
+    def abilitati(self, servizio):
+        """
+        Restituisce il vettore booleano dei punti abilitati a un servizio
+        """
+        return self.abilitazioni[:, self._colonna_abilitazione[servizio]]
+
+
+class MatriceFlussi:
+    """
+    Flussi di ridistribuzione come matrici sparse (ufficio chiuso × punto ricevente),
+    una per servizio
+    
+    Le righe sono le posizioni di tutti gli UP dell'archivio, le colonne gli UP
+    seguiti dai LIS: matrici ottenute da simulazioni diverse sullo stesso dataset
+    hanno quindi la stessa forma e si possono sommare o sottrarre direttamente.
+    """
+    
+    def __init__(self, matrici, ids_up, ids_lis):
+        """
+        Parameters:
+        -----------
+        matrici : dict
+            Servizio → csr_matrix di forma (n_up, n_up + n_lis)
+        ids_up : ndarray
+            ID degli UP (righe e prime n_up colonne)
+        ids_lis : ndarray
+            ID dei LIS (ultime n_lis colonne)
+        """
+        self.matrici = matrici
+        self.ids_up = ids_up
+        self.ids_lis = ids_lis
+    
+    @classmethod
+    def da_array(cls, servizi, righe, colonne, volumi, ids_up, ids_lis):
+        """
+        Costruisce le matrici da array di coordinate (le coppie duplicate vengono sommate)
+        
+        Parameters:
+        -----------
+        servizi : list
+            Servizi, nell'ordine delle liste righe, colonne e volumi
+        righe, colonne, volumi : list
+            Per ogni servizio, array delle posizioni degli uffici chiusi, delle
+            colonne dei riceventi e dei volumi
+        ids_up, ids_lis : ndarray
+            ID degli UP e dei LIS
+            
+        Returns:
+        --------
+        MatriceFlussi
+        """
+        forma = (len(ids_up), len(ids_up) + len(ids_lis))
+        matrici = {}
+        for servizio, r, c, v in zip(servizi, righe, colonne, volumi):
+            matrice = sparse.csr_matrix((v, (r, c)), shape=forma)
+            matrici[servizio] = matrice + matrici[servizio] if servizio in matrici else matrice
+        return cls(matrici, ids_up, ids_lis)
+    
+    @property
+    def servizi(self):
+        return list(self.matrici)
+    
+    @property
+    def ids_riceventi(self):
+        return np.concatenate([self.ids_up, self.ids_lis])
+    
+    @property
+    def tipi_riceventi(self):
+        return np.repeat(['up_vicini', 'lis_vicini'], [len(self.ids_up), len(self.ids_lis)])
+    
+    def matrice(self, servizio=None):
+        """
+        Restituisce la matrice di un servizio o, se servizio è None, la somma su tutti i servizi
+        """
+        if servizio is not None:
+            return self.matrici[servizio]
+        forma = (len(self.ids_up), len(self.ids_up) + len(self.ids_lis))
+        return sum(self.matrici.values(), sparse.csr_matrix(forma))
+    
+    def totali(self):
+        """
+        Volume totale ricevuto da UP e LIS per servizio
+        
+        Returns:
+        --------
+        DataFrame : indice servizio, colonne 'up_vicini' e 'lis_vicini'
+        """
+        n_up = len(self.ids_up)
+        righe = []
+        for servizio, matrice in self.matrici.items():
+            ricevuto = np.asarray(matrice.sum(axis=0)).ravel()
+            righe.append((servizio, ricevuto[:n_up].sum(), ricevuto[n_up:].sum()))
+        return pd.DataFrame(righe, columns=['servizio', 'up_vicini', 'lis_vicini']).set_index('servizio')
+    
+    def carico_riceventi(self):
+        """
+        Volume aggiuntivo ricevuto da ogni punto, per servizio
+        
+        Returns:
+        --------
+        DataFrame : 'id_ricevente', 'tipo' e una colonna per servizio, solo per i
+                    punti che ricevono volume
+        """
+        carico = pd.DataFrame({
+            servizio: np.asarray(matrice.sum(axis=0)).ravel()
+            for servizio, matrice in self.matrici.items()
+        })
+        riceve = (carico != 0).any(axis=1).to_numpy()
+        carico = carico[riceve].reset_index(drop=True)
+        carico.insert(0, 'tipo', self.tipi_riceventi[riceve])
+        carico.insert(0, 'id_ricevente', self.ids_riceventi[riceve])
+        return carico
+    
+    def a_dataframe(self):
+        """
+        Converte le matrici nel formato lungo dei flussi di simula_chiusure_batch
+        
+        Returns:
+        --------
+        DataFrame : 'id_up', 'servizio', 'tipo', 'id_ricevente', 'volume'
+        """
+        n_up = len(self.ids_up)
+        ids_riceventi = self.ids_riceventi
+        tipi_riceventi = self.tipi_riceventi
+        flussi = []
+        for servizio, matrice in self.matrici.items():
+            coo = matrice.tocoo()
+            flussi.append(pd.DataFrame({
+                'id_up': self.ids_up[coo.row],
+                'servizio': servizio,
+                'tipo': tipi_riceventi[coo.col],
+                'id_ricevente': ids_riceventi[coo.col],
+                'volume': coo.data
+            }))
+        if not flussi:
+            return pd.DataFrame(columns=['id_up', 'servizio', 'tipo', 'id_ricevente', 'volume'])
+        flussi = pd.concat(flussi, ignore_index=True)
+        flussi['servizio'] = flussi['servizio'].astype('category')
+        flussi['tipo'] = pd.Categorical(flussi['tipo'], categories=['up_vicini', 'lis_vicini'])
+        return flussi
+    
+    def _combina(self, altra, segno):
+        if not (np.array_equal(self.ids_up, altra.ids_up) and np.array_equal(self.ids_lis, altra.ids_lis)):
+            raise ValueError("Le matrici dei flussi si riferiscono a dataset diversi")
+        matrici = dict(self.matrici)
+        for servizio, matrice in altra.matrici.items():
+            matrici[servizio] = matrici[servizio] + segno * matrice if servizio in matrici else segno * matrice
+        return MatriceFlussi(matrici, self.ids_up, self.ids_lis)
+    
+    def __add__(self, altra):
+        return self._combina(altra, 1)
+    
+    def __sub__(self, altra):
+        """
+        Differenza tra due scenari, servizio per servizio
+        """
+        return self._combina(altra, -1)
+
+
+class MatriceTempi:
+    """
+    Tempi di percorrenza su rete stradale dagli UP agli UP e ai LIS
+    
+    I tempi (in minuti) fino a tempo_max_min sono calcolati una sola volta con
+    Dijkstra sul grafo stradale e conservati come matrici sparse con una riga per
+    UP di origine: la ricerca dei vicini di un insieme di uffici è quindi una
+    selezione di righe, rapida quanto una query sul BallTree. Ogni punto è
+    collegato al nodo stradale più vicino, percorrendo il tratto in linea d'aria
+    a VELOCITA_ACCESSO_KMH.
+    """
+    
+    def __init__(self, tempi_up, tempi_lis, tempo_max_min):
+        """
+        Parameters:
+        -----------
+        tempi_up : csr_matrix
+            Tempi (n_up × n_up) in minuti; i valori assenti superano tempo_max_min
+        tempi_lis : csr_matrix
+            Tempi (n_up × n_lis) in minuti
+        tempo_max_min : float
+            Tempo massimo calcolato
+        """
+        self.tempi_up = tempi_up
+        self.tempi_lis = tempi_lis
+        self.tempo_max_min = tempo_max_min
+    
+    @classmethod
+    def da_rete(cls, nodi_lon, nodi_lat, origine, destinazione, minuti, coord_up, coord_lis,
+                tempo_max_min=30, dimensione_blocco=16):
+        """
+        Calcola le matrici dei tempi da un grafo stradale orientato
+        
+        Parameters:
+        -----------
+        nodi_lon, nodi_lat : ndarray
+            Coordinate dei nodi in gradi
+        origine, destinazione : ndarray
+            Posizioni dei nodi di inizio e fine di ogni arco
+        minuti : ndarray
+            Tempo di percorrenza di ogni arco in minuti
+        coord_up, coord_lis : tuple
+            (lon, lat) degli UP e dei LIS
+        tempo_max_min : float, optional
+            Tempo massimo oltre il quale i percorsi non vengono esplorati
+        dimensione_blocco : int, optional
+            Numero di nodi di origine per chiamata a Dijkstra (la memoria cresce
+            come dimensione_blocco × numero di nodi)
+            
+        Returns:
+        --------
+        MatriceTempi
+        """
+        n_nodi = len(nodi_lon)
+        # Tra archi paralleli vale il più veloce
+        archi = pd.DataFrame({'o': origine, 'd': destinazione, 'm': minuti}).groupby(['o', 'd'])['m'].min()
+        grafo = sparse.csr_matrix(
+            (archi.to_numpy(), (archi.index.get_level_values(0), archi.index.get_level_values(1))),
+            shape=(n_nodi, n_nodi)
+        )
+        albero_nodi = BallTree(np.radians(np.column_stack([nodi_lat, nodi_lon])), metric='haversine')
+        
+        def aggancia(lon, lat):
+            distanze, nodi = albero_nodi.query(np.radians(np.column_stack([lat, lon])), k=1)
+            return nodi[:, 0], distanze[:, 0] * RAGGIO_TERRA_KM / VELOCITA_ACCESSO_KMH * 60
+        
+        nodo_up, accesso_up = aggancia(*coord_up)
+        nodo_lis, accesso_lis = aggancia(*coord_lis)
+        
+        # Dijkstra una volta per nodo di origine distinto
+        nodi_origine, origine_up = np.unique(nodo_up, return_inverse=True)
+        righe_up, righe_lis = [], []
+        for inizio in range(0, len(nodi_origine), dimensione_blocco):
+            blocco = nodi_origine[inizio:inizio + dimensione_blocco]
+            tempi = dijkstra(grafo, directed=True, indices=blocco, limit=tempo_max_min)
+            for tempi_nodi, accesso, righe in ((tempi[:, nodo_up], accesso_up, righe_up),
+                                               (tempi[:, nodo_lis], accesso_lis, righe_lis)):
+                totale = tempi_nodi + accesso
+                # Le matrici sparse non conservano gli zeri: tempo minimo positivo
+                totale = np.where(totale <= tempo_max_min, np.maximum(totale, 1e-6), 0.0)
+                righe.append(sparse.csr_matrix(totale))
+        
+        # Righe per UP: tempi del nodo di origine più il tempo di accesso dell'UP
+        def per_ufficio(righe):
+            tempi = sparse.vstack(righe).tocsr()[origine_up]
+            tempi.data += np.repeat(accesso_up, np.diff(tempi.indptr))
+            tempi.data[tempi.data > tempo_max_min] = 0.0
+            tempi.eliminate_zeros()
+            return tempi
+        
+        return cls(per_ufficio(righe_up), per_ufficio(righe_lis), tempo_max_min)
+    
+    @classmethod
+    def da_pbf(cls, file_pbf, coord_up, coord_lis, tempo_max_min=30, velocita=None, **opzioni):
+        """
+        Calcola le matrici dei tempi dalla rete stradale di un estratto OpenStreetMap
+        
+        Richiede il pacchetto opzionale pyrosm.
+        
+        Parameters:
+        -----------
+        file_pbf : str
+            Percorso dell'estratto .osm.pbf
+        coord_up, coord_lis : tuple
+            (lon, lat) degli UP e dei LIS
+        tempo_max_min : float, optional
+            Tempo massimo calcolato in minuti
+        velocita : dict, optional
+            Velocità in km/h per tipo di strada (default: VELOCITA_STRADE)
+        **opzioni :
+            Altri argomenti di da_rete
+            
+        Returns:
+        --------
+        MatriceTempi
+        """
+        from pyrosm import OSM
+        
+        nodi, archi = OSM(file_pbf).get_network(network_type='driving', nodes=True)
+        indice_nodi = pd.Index(nodi['id'])
+        u = indice_nodi.get_indexer(archi['u'])
+        v = indice_nodi.get_indexer(archi['v'])
+        
+        # Velocità dal tag maxspeed, altrimenti dal tipo di strada
+        velocita_strade = velocita or VELOCITA_STRADE
+        kmh = pd.to_numeric(archi['maxspeed'].astype(str).str.extract(r'(\d+)')[0], errors='coerce')
+        kmh = kmh.fillna(archi['highway'].map(velocita_strade)).fillna(VELOCITA_DEFAULT_KMH).to_numpy()
+        minuti = archi['length'].to_numpy(dtype=np.float64) / 1000 / kmh * 60
+        
+        # Strade a senso unico percorse solo nel verso dell'arco ('-1': verso opposto)
+        senso_unico = archi['oneway'].astype(str).str.lower()
+        avanti = senso_unico != '-1'
+        indietro = ~senso_unico.isin(['yes', 'true', '1']).to_numpy()
+        origine = np.concatenate([u[avanti], v[indietro]])
+        destinazione = np.concatenate([v[avanti], u[indietro]])
+        minuti = np.concatenate([minuti[avanti], minuti[indietro]])
+        
+        validi = (origine >= 0) & (destinazione >= 0)
+        return cls.da_rete(
+            nodi['lon'].to_numpy(dtype=np.float64), nodi['lat'].to_numpy(dtype=np.float64),
+            origine[validi], destinazione[validi], minuti[validi], coord_up, coord_lis,
+            tempo_max_min, **opzioni
+        )
+    
+    def salva(self, cartella):
+        """
+        Salva le matrici dei tempi nella cartella
+        """
+        sparse.save_npz(os.path.join(cartella, 'tempi_up.npz'), self.tempi_up)
+        sparse.save_npz(os.path.join(cartella, 'tempi_lis.npz'), self.tempi_lis)
+        with open(os.path.join(cartella, 'tempi.json'), 'w') as f:
+            json.dump({'tempo_max_min': self.tempo_max_min}, f)
+    
+    @classmethod
+    def carica(cls, cartella):
+        """
+        Carica le matrici salvate con salva, None se la cartella non le contiene
+        """
+        percorso = os.path.join(cartella, 'tempi.json')
+        if not os.path.exists(percorso):
+            return None
+        with open(percorso) as f:
+            metadati = json.load(f)
+        return cls(
+            sparse.load_npz(os.path.join(cartella, 'tempi_up.npz')).tocsr(),
+            sparse.load_npz(os.path.join(cartella, 'tempi_lis.npz')).tocsr(),
+            metadati['tempo_max_min']
+        )
+    
+    def vicini(self, tempi, posizioni, tempo_max_min, escludi=None):
+        """
+        Punti raggiungibili entro tempo_max_min da ciascun UP, nel formato di cerca_vicini
+        
+        Parameters:
+        -----------
+        tempi : csr_matrix
+            self.tempi_up o self.tempi_lis
+        posizioni : ndarray
+            Posizioni degli UP di origine
+        tempo_max_min : float
+            Tempo massimo in minuti (non superiore a quello calcolato)
+        escludi : ndarray, optional
+            Posizione da escludere per ogni UP di origine
+            
+        Returns:
+        --------
+        tuple : (gruppo, indici, minuti)
+        """
+        if tempo_max_min > self.tempo_max_min:
+            raise ValueError(f"Tempi calcolati solo fino a {self.tempo_max_min} minuti")
+        righe = tempi[np.asarray(posizioni, dtype=np.int64)]
+        gruppo = np.repeat(np.arange(righe.shape[0]), np.diff(righe.indptr))
+        indici = righe.indices.astype(np.int64)
+        minuti = righe.data
+        tieni = minuti <= tempo_max_min
+        if escludi is not None:
+            tieni &= indici != np.asarray(escludi, dtype=np.int64)[gruppo]
+        return gruppo[tieni], indici[tieni], minuti[tieni]
+
+
+class ScrittoreParquet:
+    """
+    Destinazione in streaming dei risultati di una simulazione su file Parquet
+    
+    Ogni tabella dei risultati ('uffici', 'totali', 'flussi') viene scritta in una
+    sottocartella, partizionata in stile Hive (es. flussi/parametri=3/part-00000.parquet).
+    Le righe sono accumulate fino a dimensione_row_group e poi scritte come row group,
+    per cui la memoria occupata non dipende dalla lunghezza dello sweep. Il risultato
+    si legge con pd.read_parquet(cartella + '/flussi', filters=[('parametri', '=', 3)])
+    o con polars.scan_parquet senza caricare l'intero dataset.
+    """
+    
+    def __init__(self, cartella, dimensione_row_group=250_000, compressione='zstd', max_file_aperti=16):
+        """
+        Parameters:
+        -----------
+        cartella : str
+            Cartella di destinazione
+        dimensione_row_group : int, optional
+            Numero di righe per row group
+        compressione : str, optional
+            Codec Parquet
+        max_file_aperti : int, optional
+            Numero massimo di file aperti contemporaneamente; oltre questo limite
+            il file usato meno di recente viene chiuso e la partizione prosegue in
+            un nuovo file
+        """
+        # pyarrow serve solo a chi scrive i risultati in streaming
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self._pq = pq
+        
+        self.cartella = cartella
+        self.dimensione_row_group = dimensione_row_group
+        self.compressione = compressione
+        self.max_file_aperti = max_file_aperti
+        os.makedirs(cartella, exist_ok=True)
+        
+        self._schemi = {}
+        self._scrittori = OrderedDict()
+        self._buffer = {}
+        self._righe_buffer = {}
+        self._n_file = {}
+        self.righe_scritte = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *eccezione):
+        self.chiudi()
+    
+    def _tabella_arrow(self, nome, df):
+        # Le colonne object (es. id_ricevente con ID numerici degli UP e testuali dei LIS)
+        # diventano stringhe, così lo schema non dipende dal contenuto del blocco
+        oggetti = df.columns[df.dtypes == object]
+        if len(oggetti):
+            df = df.astype({c: str for c in oggetti})
+        tabella = self._pa.Table.from_pandas(df, preserve_index=False)
+        # Le colonne categoriche diventano stringhe: le categorie possono variare tra blocchi
+        for i, campo in enumerate(tabella.schema):
+            if self._pa.types.is_dictionary(campo.type):
+                tabella = tabella.set_column(i, campo.name, tabella.column(i).cast(campo.type.value_type))
+        if nome not in self._schemi:
+            self._schemi[nome] = tabella.schema
+        return tabella.cast(self._schemi[nome])
+    
+    def scrivi(self, risultati, **partizione):
+        """
+        Aggiunge i risultati di una simulazione
+        
+        Parameters:
+        -----------
+        risultati : dict
+            Risultati colonnari come in simula_chiusure_batch; le chiavi che non
+            sono DataFrame vengono ignorate
+        **partizione :
+            Valori delle colonne di partizione (es. parametri=3)
+        """
+        for nome, df in risultati.items():
+            if isinstance(df, MatriceFlussi):
+                df = df.a_dataframe()
+            if not isinstance(df, pd.DataFrame) or len(df) == 0:
+                continue
+            chiave = (nome,) + tuple(sorted(partizione.items()))
+            self._buffer.setdefault(chiave, []).append(self._tabella_arrow(nome, df))
+            self._righe_buffer[chiave] = self._righe_buffer.get(chiave, 0) + len(df)
+            if self._righe_buffer[chiave] >= self.dimensione_row_group:
+                self._svuota(chiave)
+    
+    def _scrittore(self, chiave):
+        if chiave in self._scrittori:
+            self._scrittori.move_to_end(chiave)
+            return self._scrittori[chiave]
+        
+        if len(self._scrittori) >= self.max_file_aperti:
+            _, vecchio = self._scrittori.popitem(last=False)
+            vecchio.close()
+        
+        nome = chiave[0]
+        cartella = os.path.join(self.cartella, nome, *[f'{k}={v}' for k, v in chiave[1:]])
+        os.makedirs(cartella, exist_ok=True)
+        n_file = self._n_file.get(chiave, 0)
+        self._n_file[chiave] = n_file + 1
+        scrittore = self._pq.ParquetWriter(
+            os.path.join(cartella, f'part-{n_file:05d}.parquet'), self._schemi[nome],
+            compression=self.compressione
+        )
+        self._scrittori[chiave] = scrittore
+        return scrittore
+    
+    def _svuota(self, chiave):
+        tabelle = self._buffer.pop(chiave, None)
+        self._righe_buffer.pop(chiave, None)
+        if not tabelle:
+            return
+        tabella = self._pa.concat_tables(tabelle)
+        self._scrittore(chiave).write_table(tabella, row_group_size=self.dimensione_row_group)
+        self.righe_scritte[chiave[0]] = self.righe_scritte.get(chiave[0], 0) + len(tabella)
+    
+    def svuota(self):
+        """
+        Scrive su disco tutte le righe ancora nel buffer
+        """
+        for chiave in list(self._buffer):
+            self._svuota(chiave)
+    
+    def chiudi(self):
+        """
+        Scrive le righe rimaste e chiude tutti i file
+        """
+        self.svuota()
+        for scrittore in self._scrittori.values():
+            scrittore.close()
+        self._scrittori.clear()
+
+
+class OttimizzatoreChiusure:
+    """
+    Ottimizzatore del portafoglio di chiusure costruito sul simulatore
+    
+    Cerca K uffici da chiudere minimizzando il volume perso: la quota che va a
+    competitor e digitale più, opzionalmente, il volume che non riesce a
+    raggiungere nessun ufficio aperto (colonna 'non_ricollocato' di
+    simula_scenario_chiusure). La prima quota è fissa per ufficio, la seconda
+    dipende solo dalla raggiungibilità di un ufficio aperto nel grafo dei vicini:
+    ogni mossa viene quindi valutata in modo incrementale, ricalcolando solo gli
+    uffici chiusi a monte di quello che cambia stato.
+    """
+    
+    def __init__(self, simulazione, candidati=None, personalizza_parametri=None,
+                 includi_non_ricollocato=True):
+        """
+        Parameters:
+        -----------
+        simulazione : SimulazioneChiusuraUP
+            Simulatore con i dati caricati
+        candidati : list, optional
+            ID degli uffici che possono essere chiusi (default: tutti)
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+        includi_non_ricollocato : bool, optional
+            Se True la perdita include il volume che non raggiunge nessun ufficio aperto
+        """
+        self.simulazione = simulazione
+        self.personalizza_parametri = personalizza_parametri
+        if candidati is None:
+            candidati = simulazione.archivio_up.ids
+        
+        # Perdite per ufficio dal simulatore, una chiusura alla volta
+        batch = simulazione.simula_chiusure_batch(pd.unique(np.asarray(candidati)), personalizza_parametri)
+        self.ids = batch['uffici']['id_up'].to_numpy()
+        m = len(self.ids)
+        totali = batch['totali'].groupby('id_up', sort=False)[
+            ['competitor', 'digitale', 'up_vicini', 'non_ricollocato']
+        ].sum().reindex(self.ids, fill_value=0.0)
+        # Perdita fissa (competitor + digitale) e volume destinato agli UP
+        self.perdita_fissa = (totali['competitor'] + totali['digitale']).to_numpy()
+        self.volume_up = (totali['up_vicini'] + totali['non_ricollocato']).to_numpy()
+        if not includi_non_ricollocato:
+            self.volume_up = np.zeros(m)
+        
+        # Grafo dei vicini tra i candidati; i vicini non candidati restano sempre aperti
+        params = simulazione.unisci_parametri(personalizza_parametri)
+        posizioni = simulazione.archivio_up.posizioni(self.ids)
+        (gruppo, indici, _), _ = simulazione.vicini_chiusure(
+            posizioni, simulazione.archivio_up.lon[posizioni], simulazione.archivio_up.lat[posizioni],
+            batch['uffici']['raggio_km'].to_numpy(), params
+        )
+        locale = np.full(len(simulazione.archivio_up), -1, dtype=np.int64)
+        locale[posizioni] = np.arange(m)
+        destinazione = locale[indici]
+        self.uscita_fissa = np.bincount(gruppo, weights=destinazione < 0, minlength=m) > 0
+        if params['bacino'].get('modalita') == 'knn':
+            # Con il bacino knn lo scenario cerca i k UP aperti più vicini, per cui un
+            # ufficio chiuso raggiunge sempre un ufficio aperto
+            self.uscita_fissa[:] = True
+        
+        archi = destinazione >= 0
+        origine, destinazione = gruppo[archi], destinazione[archi]
+        self._uscenti = sparse.csr_matrix(
+            (np.ones(len(origine), dtype=bool), (origine, destinazione)), shape=(m, m)
+        )
+        self._entranti = self._uscenti.T.tocsr()
+        
+        # Stato: uffici chiusi e, per questi, raggiungibilità di un ufficio aperto
+        # (per gli uffici aperti vale sempre True)
+        self.chiuso = np.zeros(m, dtype=bool)
+        self.raggiunge = np.ones(m, dtype=bool)
+        self.perdita = 0.0
+        
+        # Delta della chiusura di ogni ufficio rispetto allo stato corrente
+        ha_vicini = self.uscita_fissa | (np.diff(self._uscenti.indptr) > 0)
+        self.delta = self.perdita_fissa + np.where(ha_vicini, 0.0, self.volume_up)
+    
+    def _vicini(self, matrice, i):
+        return matrice.indices[matrice.indptr[i]:matrice.indptr[i + 1]]
+    
+    def _monte(self, j):
+        """
+        Uffici chiusi che raggiungono j passando solo per uffici chiusi
+        """
+        visti = {j}
+        da_visitare = [j]
+        while da_visitare:
+            i = da_visitare.pop()
+            for p in self._vicini(self._entranti, i):
+                if self.chiuso[p] and p not in visti:
+                    visti.add(p)
+                    da_visitare.append(p)
+        visti.discard(j)
+        return list(visti)
+    
+    def _componente(self, j):
+        """
+        Componente debolmente connessa degli uffici chiusi che contiene j
+        """
+        visti = {j}
+        da_visitare = [j]
+        while da_visitare:
+            i = da_visitare.pop()
+            for matrice in (self._uscenti, self._entranti):
+                for v in self._vicini(matrice, i):
+                    if self.chiuso[v] and v not in visti:
+                        visti.add(v)
+                        da_visitare.append(v)
+        return list(visti)
+    
+    def _ricalcola_raggiungibilita(self, nodi):
+        # Minimo punto fisso: un ufficio chiuso raggiunge un ufficio aperto se ha
+        # un vicino fisso o un vicino aperto o un vicino chiuso che lo raggiunge
+        self.raggiunge[nodi] = False
+        cambiato = True
+        while cambiato:
+            cambiato = False
+            for i in nodi:
+                if self.raggiunge[i]:
+                    continue
+                if self.uscita_fissa[i] or self.raggiunge[self._vicini(self._uscenti, i)].any():
+                    self.raggiunge[i] = True
+                    cambiato = True
+    
+    def _perdita_variabile(self, nodi):
+        nodi = np.asarray(nodi, dtype=np.int64)
+        return float(np.sum(self.volume_up[nodi] * ~self.raggiunge[nodi]))
+    
+    def _chiudi(self, j):
+        monte = self._monte(j)
+        prima = self._perdita_variabile(monte)
+        self.chiuso[j] = True
+        self._ricalcola_raggiungibilita(monte + [j])
+        self.perdita += self.perdita_fissa[j] + self._perdita_variabile(monte + [j]) - prima
+    
+    def _riapri(self, j):
+        monte = self._monte(j)
+        prima = self.perdita_fissa[j] + self._perdita_variabile(monte + [j])
+        self.chiuso[j] = False
+        self.raggiunge[j] = True
+        self._ricalcola_raggiungibilita(monte)
+        self.perdita += self._perdita_variabile(monte) - prima
+    
+    def _delta_chiusura(self, j):
+        """
+        Variazione della perdita chiudendo j, senza modificare lo stato
+        """
+        monte = self._monte(j)
+        nodi = monte + [j]
+        raggiunge, perdita = self.raggiunge[nodi].copy(), self.perdita
+        self._chiudi(j)
+        delta = self.perdita - perdita
+        self.chiuso[j] = False
+        self.raggiunge[nodi] = raggiunge
+        self.perdita = perdita
+        return delta
+    
+    def _aperti_adiacenti(self, componente):
+        adiacenti = set()
+        for i in componente:
+            adiacenti.update(self._vicini(self._uscenti, i))
+            adiacenti.update(self._vicini(self._entranti, i))
+        adiacenti.update(componente)
+        return [v for v in adiacenti if not self.chiuso[v]]
+    
+    def _aggiorna_delta(self, nodi):
+        for v in nodi:
+            self.delta[v] = self._delta_chiusura(v)
+    
+    def aggiungi(self, j):
+        """
+        Chiude l'ufficio j (indice locale) e aggiorna i delta dei vicini interessati
+        """
+        self._chiudi(j)
+        self._aggiorna_delta(self._aperti_adiacenti(self._componente(j)))
+    
+    def rimuovi(self, j):
+        """
+        Riapre l'ufficio j (indice locale) e aggiorna i delta dei vicini interessati
+        """
+        componente = self._componente(j)
+        self._riapri(j)
+        self._aggiorna_delta(self._aperti_adiacenti(componente))
+    
+    def soluzione(self):
+        return self.ids[self.chiuso].tolist()
+    
+    def greedy(self, k):
+        """
+        Costruisce una soluzione aggiungendo ogni volta l'ufficio con il delta minimo
+        
+        Parameters:
+        -----------
+        k : int
+            Numero di uffici da chiudere
+            
+        Returns:
+        --------
+        list : ID degli uffici chiusi
+        """
+        for _ in range(min(k, len(self.ids)) - int(self.chiuso.sum())):
+            j = int(np.argmin(np.where(self.chiuso, np.inf, self.delta)))
+            self.aggiungi(j)
+        return self.soluzione()
+    
+    def ricerca_locale(self, max_iterazioni=100, tolleranza=1e-9):
+        """
+        Migliora la soluzione corrente con scambi (riapri a, chiudi b) finché esiste
+        uno scambio che riduce la perdita
+        
+        Per ogni ufficio chiuso a, i delta di chiusura degli altri uffici restano
+        validi tranne che per quelli adiacenti alla componente di a, che sono gli
+        unici ricalcolati.
+        
+        Parameters:
+        -----------
+        max_iterazioni : int, optional
+            Numero massimo di scambi applicati
+        tolleranza : float, optional
+            Miglioramento minimo per accettare uno scambio
+            
+        Returns:
+        --------
+        list : ID degli uffici chiusi
+        """
+        for _ in range(max_iterazioni):
+            migliorato = False
+            chiusi = np.flatnonzero(self.chiuso)
+            # Prima gli uffici che contribuiscono di più alla perdita
+            contributo = self.perdita_fissa[chiusi] + self.volume_up[chiusi] * ~self.raggiunge[chiusi]
+            for a in chiusi[np.argsort(-contributo)]:
+                componente = self._componente(a)
+                perdita = self.perdita
+                raggiunge = self.raggiunge.copy()
+                self._riapri(a)
+                delta_rimozione = self.perdita - perdita
+                
+                delta = np.where(self.chiuso, np.inf, self.delta)
+                delta[a] = np.inf
+                for v in self._aperti_adiacenti(componente):
+                    if v != a:
+                        delta[v] = self._delta_chiusura(v)
+                b = int(np.argmin(delta))
+                
+                if np.isfinite(delta[b]) and delta_rimozione + delta[b] < -tolleranza:
+                    # Scambio migliorativo: completa la rimozione di a e chiude b
+                    self._aggiorna_delta(self._aperti_adiacenti(componente))
+                    self.aggiungi(b)
+                    migliorato = True
+                    break
+                
+                # Ripristina lo stato precedente
+                self.chiuso[a] = True
+                self.raggiunge = raggiunge
+                self.perdita = perdita
+            if not migliorato:
+                break
+        return self.soluzione()
+
 
 class SimulazioneChiusuraUP:
-    def __init__(self, file_up, file_lis, file_banche, file_sezioni_censimento, file_presenze):
+    def __init__(self, file_up, file_lis, file_banche, file_sezioni_censimento, file_presenze,
+                 cartella_cache=None, dimensione_cache=1024, statistiche=True):
+        """
+        Inizializzazione con i dataset necessari per la simulazione
+        
+        Parameters:
+        -----------
+        file_up : str
+            Percorso del file contenente i dati degli uffici postali
+        file_lis : str
+            Percorso del file contenente i dati dei punti LIS
+        file_banche : str
+            Percorso del file contenente i dati delle banche
+        file_sezioni_censimento : str
+            Percorso del file contenente i dati delle sezioni di censimento
+        file_presenze : str
+            Percorso del file contenente i dati delle presenze medie
+        cartella_cache : str, optional
+            Cartella della cache su disco dei dati preparati (vedi carica_dati)
+        dimensione_cache : int, optional
+            Numero massimo di elementi delle cache LRU di simula_chiusura_up
+        statistiche : bool, optional
+            Se True registra tempi e contatori per fase in self.statistiche
+        """
+        self.carica_dati(file_up, file_lis, file_banche, file_sezioni_censimento, file_presenze,
+                         cartella_cache)
+        self.configura_parametri_simulazione()
+        self._inizializza_cache(dimensione_cache)
+        # Tempi per fase di simula_chiusura_up e simula_chiusure_batch (anche dei worker)
+        self.statistiche = StatisticheTempi(attiva=statistiche)
+        
+    def carica_dati(self, file_up, file_lis, file_banche, file_sezioni_censimento, file_presenze,
+                    cartella_cache=None):
+        """
+        Carica tutti i dataset necessari
+        
+        Se è indicata una cartella di cache, i dati preparati (tabelle Parquet e
+        GeoParquet, archivi colonnari, densità e BallTree) vengono salvati in una
+        sottocartella identificata da dimensione e data di modifica dei file di
+        input e dalle versioni di numpy e scikit-learn; un avvio successivo con gli
+        stessi input li ricarica da lì senza rileggere i CSV e lo shapefile né
+        ricostruire gli alberi. Scrivendo una nuova sottocartella, quelle con
+        chiavi diverse vengono rimosse.
+        """
+        if cartella_cache is not None:
+            chiave = chiave_cache([file_up, file_lis, file_banche, file_sezioni_censimento, file_presenze])
+            cartella = os.path.join(cartella_cache, chiave)
+            if os.path.isdir(cartella):
+                self.carica_cache(cartella)
+                return
+        
+        # Caricamento dati degli uffici postali
+        self.df_up = pd.read_csv(file_up)
+        # Conversione a geodataframe
+        self.gdf_up = self._crea_geodataframe(self.df_up)
+        
+        # Caricamento dati dei punti LIS
+        self.df_lis = pd.read_csv(file_lis)
+        self.gdf_lis = self._crea_geodataframe(self.df_lis)
+        
+        # Caricamento dati delle banche
+        self.df_banche = pd.read_csv(file_banche)
+        self.gdf_banche = self._crea_geodataframe(self.df_banche)
+        
+        # Caricamento delle sezioni di censimento
+        self.gdf_sezioni = gpd.read_file(file_sezioni_censimento)
+        self.prepara_sezioni()
+        
+        # Caricamento dati di presenze medie
+        self.df_presenze = pd.read_csv(file_presenze)
+        
+        # Archivi colonnari con indice id → posizione
+        self.archivio_up = ArchivioPunti(self.df_up)
+        self.archivio_lis = ArchivioPunti(self.df_lis)
+        self.archivio_banche = ArchivioPunti(self.df_banche)
+        
+        # Densità della sezione di censimento di ogni ufficio postale
+        self.densita_up = self.calcola_densita_punti(self.archivio_up.lon, self.archivio_up.lat)
+        
+        # Preparazione strutture dati per la ricerca spaziale
+        self.prepara_balltree()
+        # Tempi di percorrenza su strada, calcolati su richiesta da prepara_tempi_percorrenza
+        self.tempi = None
+        
+        if cartella_cache is not None:
+            self.salva_cache(cartella)
+            rimuovi_chiavi_obsolete(cartella_cache, chiave)
+    
+    def _crea_geodataframe(self, df):
+        geometry = gpd.points_from_xy(df['longitude'], df['latitude'])
+        return gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
+    
+    def salva_cache(self, cartella):
+        """
+        Salva i dati preparati nella cartella di cache
+        
+        La cartella viene scritta in una cartella temporanea accanto e poi rinominata,
+        in modo che una cache interrotta a metà non venga mai letta.
+        
+        Parameters:
+        -----------
+        cartella : str
+            Cartella di destinazione (non deve esistere)
+        """
+        genitore = os.path.dirname(os.path.abspath(cartella))
+        os.makedirs(genitore, exist_ok=True)
+        temporanea = tempfile.mkdtemp(dir=genitore, prefix='.tmp_')
+        try:
+            self.df_up.to_parquet(os.path.join(temporanea, 'up.parquet'))
+            self.df_lis.to_parquet(os.path.join(temporanea, 'lis.parquet'))
+            self.df_banche.to_parquet(os.path.join(temporanea, 'banche.parquet'))
+            self.df_presenze.to_parquet(os.path.join(temporanea, 'presenze.parquet'))
+            self.gdf_sezioni.to_parquet(os.path.join(temporanea, 'sezioni.parquet'))
+            self._salva_strutture(temporanea)
+            os.rename(temporanea, cartella)
+        except OSError:
+            # Un altro processo ha già scritto la stessa cache
+            shutil.rmtree(temporanea, ignore_errors=True)
+            if not os.path.isdir(cartella):
+                raise
+        except BaseException:
+            shutil.rmtree(temporanea, ignore_errors=True)
+            raise
+    
+    def carica_cache(self, cartella):
+        """
+        Carica i dati preparati da una cartella scritta con salva_cache
+        
+        Parameters:
+        -----------
+        cartella : str
+            Cartella della cache
+        """
+        self.df_up = pd.read_parquet(os.path.join(cartella, 'up.parquet'))
+        self.gdf_up = self._crea_geodataframe(self.df_up)
+        self.df_lis = pd.read_parquet(os.path.join(cartella, 'lis.parquet'))
+        self.gdf_lis = self._crea_geodataframe(self.df_lis)
+        self.df_banche = pd.read_parquet(os.path.join(cartella, 'banche.parquet'))
+        self.gdf_banche = self._crea_geodataframe(self.df_banche)
+        self.df_presenze = pd.read_parquet(os.path.join(cartella, 'presenze.parquet'))
+        
+        # Le sezioni contengono già area e densità: va ricostruito solo l'STRtree
+        self.gdf_sezioni = gpd.read_parquet(os.path.join(cartella, 'sezioni.parquet'))
+        self.densita_sezioni = np.ascontiguousarray(self.gdf_sezioni['densita_popolazione'], dtype=np.float64)
+        self._costruisci_indice_sezioni()
+        
+        self._carica_strutture(cartella, mmap_mode=None)
+        
+    def prepara_balltree(self):
+        """
+        Prepara le strutture dati BallTree per ricerche spaziali efficienti
+        """
+        # Crea BallTree per ogni dataset usando le coordinate in radianti degli archivi
+        self.up_tree = BallTree(self.archivio_up.coord_rad, metric='haversine')
+        self.lis_tree = BallTree(self.archivio_lis.coord_rad, metric='haversine')
+        self.banche_tree = BallTree(self.archivio_banche.coord_rad, metric='haversine')
+    
+    def prepara_tempi_percorrenza(self, file_pbf, tempo_max_min=30, cartella_cache=None, **opzioni):
+        """
+        Calcola i tempi di percorrenza su strada dagli UP agli UP e ai LIS
+        da un estratto OpenStreetMap, per il bacino 'tempo'
+        
+        Parameters:
+        -----------
+        file_pbf : str
+            Percorso dell'estratto .osm.pbf (richiede pyrosm)
+        tempo_max_min : float, optional
+            Tempo massimo calcolato in minuti
+        cartella_cache : str, optional
+            Cartella in cui salvare le matrici, identificate dall'estratto, dalle
+            coordinate dei punti e da tempo_max_min; un avvio successivo con gli
+            stessi dati le ricarica senza ricalcolarle
+        **opzioni :
+            Altri argomenti di MatriceTempi.da_pbf
+        """
+        coord_up = (np.asarray(self.archivio_up.lon), np.asarray(self.archivio_up.lat))
+        coord_lis = (np.asarray(self.archivio_lis.lon), np.asarray(self.archivio_lis.lat))
+        # I vicini memorizzati dipendono dai tempi
+        self.svuota_cache()
+        
+        if cartella_cache is not None:
+            h = hashlib.sha256(chiave_cache([file_pbf]).encode())
+            for array in coord_up + coord_lis:
+                h.update(np.ascontiguousarray(array).tobytes())
+            h.update(repr((tempo_max_min, sorted(opzioni.items(), key=str))).encode())
+            cartella = os.path.join(cartella_cache, 'tempi_' + h.hexdigest()[:32])
+            self.tempi = MatriceTempi.carica(cartella) if os.path.isdir(cartella) else None
+            if self.tempi is not None:
+                return
+        
+        self.tempi = MatriceTempi.da_pbf(file_pbf, coord_up, coord_lis, tempo_max_min, **opzioni)
+        
+        if cartella_cache is not None:
+            os.makedirs(cartella, exist_ok=True)
+            self.tempi.salva(cartella)
+    
+    def vicini_chiusure(self, posizioni, lon, lat, raggi_km, params=None, chiusi=None):
+        """
+        Vicini UP (escluso l'ufficio stesso) e LIS di un insieme di uffici da chiudere,
+        secondo il bacino in params['bacino']
+        
+        Parameters:
+        -----------
+        posizioni : ndarray
+            Posizioni degli uffici in self.archivio_up
+        lon, lat : ndarray
+            Coordinate degli uffici
+        raggi_km : ndarray
+            Raggi di ricerca (bacino 'raggio')
+        params : dict, optional
+            Parametri della simulazione (default: self.params)
+        chiusi : ndarray, optional
+            Maschera booleana degli UP chiusi nello scenario. Con il bacino 'knn' si
+            cercano i k UP aperti più vicini; con gli altri bacini gli UP chiusi
+            restano tra i vicini e il chiamante li gestisce in cascata
+            
+        Returns:
+        --------
+        tuple : (vicini_up, vicini_lis), ciascuno (gruppo, indici, distanze) come in
+                cerca_vicini; con il bacino 'tempo' le distanze sono minuti di percorrenza
+        """
+        params = params or self.params
+        if params.get('bacino', {}).get('modalita', 'raggio') != 'knn':
+            chiusi = None
+        return (self.vicini_bacino(self.up_tree, lon, lat, raggi_km, params, escludi=posizioni,
+                                   esclusi=chiusi, origini=posizioni),
+                self.vicini_bacino(self.lis_tree, lon, lat, raggi_km, params, origini=posizioni))
+    
+    def vicini_bacino(self, tree, lon, lat, raggi_km, params=None, escludi=None, esclusi=None, origini=None):
+        """
+        Vicini in self.up_tree o self.lis_tree di un insieme di punti secondo il
+        bacino in params['bacino']
+        
+        Parameters:
+        -----------
+        tree : BallTree
+            self.up_tree o self.lis_tree
+        lon, lat : ndarray
+            Coordinate dei punti di ricerca
+        raggi_km : ndarray
+            Raggi di ricerca (bacino 'raggio')
+        params : dict, optional
+            Parametri della simulazione (default: self.params)
+        escludi : ndarray, optional
+            Posizione nell'albero da escludere per ogni punto di ricerca
+        esclusi : ndarray, optional
+            Maschera booleana dei punti dell'albero non ammessi come vicini; con il
+            bacino 'knn' vengono saltati cercando i k vicini più prossimi ammessi
+        origini : ndarray, optional
+            Posizioni degli UP le cui righe in self.tempi danno i tempi di
+            percorrenza dei punti (bacino 'tempo', default: le posizioni più vicine)
+            
+        Returns:
+        --------
+        tuple : (gruppo, indici, distanze) come in cerca_vicini; con il bacino 'tempo'
+                le distanze sono minuti di percorrenza
+        """
+        bacino = (params or self.params).get('bacino', {})
+        modalita = bacino.get('modalita', 'raggio')
+        
+        if modalita == 'raggio':
+            vicini = self.cerca_vicini(tree, lon, lat, raggi_km, escludi=escludi)
+        elif modalita == 'knn':
+            return self.cerca_k_vicini(tree, lon, lat, bacino['k'], bacino.get('distanza_max_km'),
+                                       escludi=escludi, esclusi=esclusi)
+        elif modalita == 'tempo':
+            if self.tempi is None:
+                raise ValueError("Tempi di percorrenza non disponibili: eseguire prepara_tempi_percorrenza")
+            if origini is None:
+                origini = np.empty(0, dtype=np.int64)
+                if len(lon):
+                    _, origini = self.up_tree.query(np.radians(np.column_stack([lat, lon])), k=1)
+                    origini = origini[:, 0]
+            tempi = self.tempi.tempi_up if tree is self.up_tree else self.tempi.tempi_lis
+            vicini = self.tempi.vicini(tempi, origini, bacino['tempo_max_min'], escludi=escludi)
+        else:
+            raise ValueError(f"Modalità del bacino non valida: {modalita}")
+        
+        if esclusi is not None:
+            tieni = ~esclusi[vicini[1]]
+            vicini = tuple(a[tieni] for a in vicini)
+        return vicini
+    
+    def esporta_dati_condivisi(self, cartella):
+        """
+        Esporta gli archivi, le densità degli UP, i BallTree e i parametri in una
+        cartella di file .npy che i processi worker aprono in memory-map
+        
+        Parameters:
+        -----------
+        cartella : str
+            Cartella di destinazione (deve esistere)
+        """
+        self._salva_strutture(cartella)
+        with open(os.path.join(cartella, 'params.pkl'), 'wb') as f:
+            pickle.dump(self.params, f)
+    
+    def _salva_strutture(self, cartella):
+        # Archivi colonnari, densità degli UP e BallTree come file .npy
+        self.archivio_up.salva(cartella, 'up')
+        self.archivio_lis.salva(cartella, 'lis')
+        self.archivio_banche.salva(cartella, 'banche')
+        np.save(os.path.join(cartella, 'densita_up.npy'), self.densita_up)
+        salva_balltree(self.up_tree, cartella, 'up_tree')
+        salva_balltree(self.lis_tree, cartella, 'lis_tree')
+        salva_balltree(self.banche_tree, cartella, 'banche_tree')
+        if self.tempi is not None:
+            self.tempi.salva(cartella)
+    
+    def _carica_strutture(self, cartella, mmap_mode='r'):
+        self.archivio_up = ArchivioPunti.carica(cartella, 'up', mmap_mode)
+        self.archivio_lis = ArchivioPunti.carica(cartella, 'lis', mmap_mode)
+        self.archivio_banche = ArchivioPunti.carica(cartella, 'banche', mmap_mode)
+        self.densita_up = np.load(os.path.join(cartella, 'densita_up.npy'), mmap_mode=mmap_mode)
+        self.up_tree = carica_balltree(cartella, 'up_tree', mmap_mode)
+        self.lis_tree = carica_balltree(cartella, 'lis_tree', mmap_mode)
+        self.banche_tree = carica_balltree(cartella, 'banche_tree', mmap_mode)
+        self.tempi = MatriceTempi.carica(cartella)
+    
+    @classmethod
+    def da_dati_condivisi(cls, cartella, mmap_mode='r'):
         """
-        Inizializzazione con i dataset necessari per la simulazione
+        Crea un simulatore senza DataFrame né sezioni di censimento a partire dai
+        file di esporta_dati_condivisi, sufficiente per simula_chiusure_batch e
+        simula_scenario_chiusure
         
         Parameters:
         -----------
-        file_up : str
-            Percorso del file contenente i dati degli uffici postali
-        file_lis : str
-            Percorso del file contenente i dati dei punti LIS
-        file_banche : str
-            Percorso del file contenente i dati delle banche
-        file_sezioni_censimento : str
-            Percorso del file contenente i dati delle sezioni di censimento
-        file_presenze : str
-            Percorso del file contenente i dati delle presenze medie
+        cartella : str
+            Cartella creata da esporta_dati_condivisi
+        mmap_mode : str, optional
+            Modalità di np.load per gli array (default 'r')
+            
+        Returns:
+        --------
+        SimulazioneChiusuraUP
         """
-        self.carica_dati(file_up, file_lis, file_banche, file_sezioni_censimento, file_presenze)
-        self.configura_parametri_simulazione()
+        simulazione = cls.__new__(cls)
+        simulazione._carica_strutture(cartella, mmap_mode)
+        simulazione._inizializza_cache(0)
+        simulazione.statistiche = StatisticheTempi()
+        with open(os.path.join(cartella, 'params.pkl'), 'rb') as f:
+            simulazione.params = pickle.load(f)
+        return simulazione
+    
+    def prepara_sezioni(self):
+        """
+        Precalcola la densità di popolazione delle sezioni di censimento e prepara
+        un indice spaziale STRtree per associare i punti alle sezioni
+        """
+        if self.gdf_sezioni.crs is None:
+            self.gdf_sezioni = self.gdf_sezioni.set_crs("EPSG:4326")
+        
+        # Area in km² calcolata in un sistema di riferimento metrico equivalente
+        area_km2 = self.gdf_sezioni.geometry.to_crs(CRS_METRICO).area.to_numpy() / 1_000_000
+        popolazione = self.gdf_sezioni['popolazione'].to_numpy(dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            densita = np.where(area_km2 > 0, popolazione / area_km2, DENSITA_DEFAULT)
+        self.gdf_sezioni['area_km2'] = area_km2
+        self.gdf_sezioni['densita_popolazione'] = densita
+        self.densita_sezioni = np.ascontiguousarray(densita)
+        self._costruisci_indice_sezioni()
+    
+    def _costruisci_indice_sezioni(self):
+        # Indice spaziale sulle geometrie in coordinate geografiche, come i punti
+        geometrie = self.gdf_sezioni.geometry.to_crs("EPSG:4326").to_numpy()
+        self.sezioni_tree = STRtree(geometrie)
+    
+    def trova_sezioni(self, lon, lat):
+        """
+        Trova la sezione di censimento che contiene ciascun punto
         
-    def carica_dati(self, file_up, file_lis, file_banche, file_sezioni_censimento, file_presenze):
+        Parameters:
+        -----------
+        lon, lat : float o array-like
+            Coordinate dei punti in gradi
+            
+        Returns:
+        --------
+        ndarray : posizione in self.gdf_sezioni della prima sezione che contiene
+                  ciascun punto, -1 se il punto non cade in nessuna sezione
         """
-        Carica tutti i dataset necessari
+        punti = shapely.points(np.atleast_1d(lon), np.atleast_1d(lat))
+        indici_punti, indici_sezioni = self.sezioni_tree.query(punti, predicate='within')
+        
+        # In caso di sezioni sovrapposte vale la prima in ordine di tabella
+        ordine = np.lexsort((indici_sezioni, indici_punti))
+        indici_punti, indici_sezioni = indici_punti[ordine], indici_sezioni[ordine]
+        primi = np.ones(len(indici_punti), dtype=bool)
+        primi[1:] = indici_punti[1:] != indici_punti[:-1]
+        
+        sezioni = np.full(len(punti), -1, dtype=np.int64)
+        sezioni[indici_punti[primi]] = indici_sezioni[primi]
+        return sezioni
+    
+    def configura_parametri_simulazione(self):
         """
-        # Caricamento dati degli uffici postali
-        self.df_up = pd.read_csv(file_up)
-        # Conversione a geodataframe
-        geometry = [Point(xy) for xy in zip(self.df_up['longitude'], self.df_up['latitude'])]
-        self.gdf_up = gpd.GeoDataFrame(self.df_up, geometry=geometry, crs="EPSG:4326")
+        Configura i parametri di default per la simulazione
+        """
+        # Parametri per la distribuzione della produzione
+        self.params = {
+            # Raggio di influenza in metri - varierà in base alla densità di popolazione
+            'raggio_base': 1000,
+            
+            # Bacino dei vicini di un ufficio chiuso: 'raggio' (distanza in linea d'aria
+            # entro il raggio di ricerca), 'tempo' (tempo di percorrenza su strada entro
+            # tempo_max_min, richiede prepara_tempi_percorrenza) o 'knn' (i k punti più
+            # vicini entro distanza_max_km, tenendo sempre almeno l'UP più vicino)
+            'bacino': {'modalita': 'raggio', 'tempo_max_min': 15, 'k': 5, 'distanza_max_km': None},
+            
+            # Coefficienti di ridistribuzione per servizi disponibili nei LIS
+            'servizi_lis': {
+                'bollettini': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
+                'bollette': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
+                'pagoPA': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
+                'ricariche_postepay': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
+                'ricariche_telefoniche': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
+                'pacchi': {'up_vicini': 0.5, 'lis_vicini': 0.2, 'competitor': 0.2, 'digitale': 0.1},
+            },
+            
+            # Coefficienti di ridistribuzione per servizi disponibili solo negli uffici postali
+            'servizi_up': {
+                'polizze': {'up_vicini': 0.7, 'competitor': 0.2, 'digitale': 0.1},
+                'conti': {'up_vicini': 0.7, 'competitor': 0.2, 'digitale': 0.1},
+                'fibra': {'up_vicini': 0.6, 'competitor': 0.3, 'digitale': 0.1},
+                'energia': {'up_vicini': 0.6, 'competitor': 0.3, 'digitale': 0.1},
+                'altri_servizi': {'up_vicini': 0.7, 'competitor': 0.2, 'digitale': 0.1},
+            }
+        }
+    
+    def calcola_raggio_ricerca(self, densita_popolazione):
+        """
+        Calcola il raggio di ricerca in base alla densità della popolazione
         
-        # Caricamento dati dei punti LIS
-        self.df_lis = pd.read_csv(file_lis)
-        geometry = [Point(xy) for xy in zip(self.df_lis['longitude'], self.df_lis['latitude'])]
-        self.gdf_lis = gpd.GeoDataFrame(self.df_lis, geometry=geometry, crs="EPSG:4326")
+        Parameters:
+        -----------
+        densita_popolazione : float
+            Densità della popolazione nell'area (abitanti/km²)
+            
+        Returns:
+        --------
+        float : raggio di ricerca in metri
+        """
+        # Raggio inversamente proporzionale alla densità, con limiti
+        if densita_popolazione <= 100:  # Zone rurali
+            return self.params['raggio_base'] * 3
+        elif densita_popolazione <= 1000:  # Zone suburbane
+            return self.params['raggio_base'] * 2
+        elif densita_popolazione <= 5000:  # Zone urbane
+            return self.params['raggio_base']
+        else:  # Zone ad alta densità
+            return self.params['raggio_base'] * 0.7
+    
+    def cerca_vicini(self, tree, lon, lat, raggi_km, escludi=None):
+        """
+        Ricerca per raggio su un BallTree con distanze haversine esatte
         
-        # Caricamento dati delle banche
-        self.df_banche = pd.read_csv(file_banche)
-        geometry = [Point(xy) for xy in zip(self.df_banche['longitude'], self.df_banche['latitude'])]
-        self.gdf_banche = gpd.GeoDataFrame(self.df_banche, geometry=geometry, crs="EPSG:4326")
+        Parameters:
+        -----------
+        tree : BallTree
+            Uno tra self.up_tree, self.lis_tree e self.banche_tree
+        lon, lat : float o array-like
+            Coordinate dei punti di ricerca in gradi
+        raggi_km : float o array-like
+            Raggio di ricerca in chilometri, comune o uno per punto
+        escludi : int o array-like, optional
+            Posizione nell'albero da escludere per ogni punto di ricerca (-1 per nessuna)
+            
+        Returns:
+        --------
+        tuple : (gruppo, indici, distanze_km) array piatti con il punto di ricerca,
+                la posizione e la distanza in km di ogni vicino, ordinati per punto
+                di ricerca e per distanza crescente
+        """
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        n = len(lon)
+        punti_rad = np.radians(np.column_stack([lat, lon]))
+        raggi_rad = np.ones(n) * np.asarray(raggi_km, dtype=np.float64) / RAGGIO_TERRA_KM
+        
+        if n == 0:
+            vuoto = np.empty(0, dtype=np.int64)
+            return vuoto, vuoto, np.empty(0)
+        
+        indici, distanze = tree.query_radius(
+            punti_rad, r=raggi_rad, return_distance=True, sort_results=True
+        )
+        conteggi = np.fromiter((len(i) for i in indici), dtype=np.int64, count=n)
+        gruppo = np.repeat(np.arange(n), conteggi)
+        indici = np.concatenate(indici).astype(np.int64)
+        distanze = np.concatenate(distanze) * RAGGIO_TERRA_KM
         
-        # Caricamento delle sezioni di censimento
-        self.gdf_sezioni = gpd.read_file(file_sezioni_censimento)
+        if escludi is not None:
+            escludi = np.ones(n, dtype=np.int64) * np.asarray(escludi, dtype=np.int64)
+            tieni = indici != escludi[gruppo]
+            gruppo, indici, distanze = gruppo[tieni], indici[tieni], distanze[tieni]
         
-        # Caricamento dati di presenze medie
-        self.df_presenze = pd.read_csv(file_presenze)
+        return gruppo, indici, distanze
+    
+    def cerca_k_vicini(self, tree, lon, lat, k, distanza_max_km=None, escludi=None, esclusi=None):
+        """
+        Ricerca dei k vicini più prossimi su un BallTree, per tutti i punti in una chiamata
+        
+        Parameters:
+        -----------
+        tree : BallTree
+            Uno tra self.up_tree, self.lis_tree e self.banche_tree
+        lon, lat : float o array-like
+            Coordinate dei punti di ricerca in gradi
+        k : int
+            Numero di vicini per punto
+        distanza_max_km : float, optional
+            Distanza oltre la quale i vicini vengono scartati, tranne il più vicino
+            che è sempre mantenuto
+        escludi : int o array-like, optional
+            Posizione nell'albero da escludere per ogni punto di ricerca (-1 per nessuna)
+        esclusi : ndarray, optional
+            Maschera booleana dei punti dell'albero da saltare per tutti i punti di
+            ricerca (es. uffici chiusi): si cercano i k vicini più prossimi non esclusi
+            
+        Returns:
+        --------
+        tuple : (gruppo, indici, distanze_km) come in cerca_vicini
+        """
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        n = len(lon)
+        n_punti = tree.data.shape[0]
+        # Un vicino in più per compensare il punto escluso
+        k_query = min(k + (escludi is not None), n_punti)
+        if n == 0 or k_query == 0:
+            vuoto = np.empty(0, dtype=np.int64)
+            return vuoto, vuoto, np.empty(0)
+        if escludi is not None:
+            escludi = np.ones(n, dtype=np.int64) * np.asarray(escludi, dtype=np.int64)
+        punti_rad = np.radians(np.column_stack([lat, lon]))
+        
+        # I punti con meno di k vicini validi vengono ricercati di nuovo con k_query
+        # raddoppiato, fino a esaurire l'albero
+        da_cercare = np.arange(n)
+        parti = []
+        while len(da_cercare):
+            distanze, indici = tree.query(punti_rad[da_cercare], k=k_query)
+            distanze = distanze * RAGGIO_TERRA_KM
+            tieni = np.ones(indici.shape, dtype=bool)
+            if escludi is not None:
+                tieni &= indici != escludi[da_cercare, None]
+            if esclusi is not None:
+                tieni &= ~esclusi[indici]
+            completi = (tieni.sum(axis=1) >= k) | (k_query == n_punti)
+            
+            tieni, indici, distanze = tieni[completi], indici[completi], distanze[completi]
+            rango = np.cumsum(tieni, axis=1)
+            tieni &= rango <= k
+            if distanza_max_km is not None:
+                tieni &= (distanze <= distanza_max_km) | (rango == 1)
+            gruppo = np.broadcast_to(da_cercare[completi][:, None], indici.shape)
+            parti.append((gruppo[tieni], indici[tieni].astype(np.int64), distanze[tieni]))
+            
+            da_cercare = da_cercare[~completi]
+            k_query = min(2 * k_query, n_punti)
+        
+        if len(parti) == 1:
+            return parti[0]
+        gruppo, indici, distanze = (np.concatenate(a) for a in zip(*parti))
+        # Ordine per punto di ricerca, mantenendo l'ordine per distanza
+        ordine = np.argsort(gruppo, kind='stable')
+        return gruppo[ordine], indici[ordine], distanze[ordine]
+    
+    def trova_punti_vicini(self, punto_chiusura, raggio_km, posizione_up=None):
+        """
+        Trova tutti i punti (UP, LIS, banche) entro un certo raggio
+        
+        Parameters:
+        -----------
+        punto_chiusura : Point
+            Geometria del punto dell'ufficio postale da chiudere
+        raggio_km : float
+            Raggio di ricerca in chilometri
+        posizione_up : int, optional
+            Posizione dell'ufficio da chiudere in self.gdf_up, escluso dagli UP vicini.
+            Se non indicata vengono esclusi gli UP con la stessa geometria del punto.
+            
+        Returns:
+        --------
+        dict : Dizionario contenente i punti vicini per categoria, ordinati per
+               distanza crescente con la distanza haversine nella colonna 'distanza_km'
+        """
+        def vicini(tree, gdf, escludi=None):
+            _, indici, distanze = self.cerca_vicini(
+                tree, punto_chiusura.x, punto_chiusura.y, raggio_km, escludi
+            )
+            punti = gdf.iloc[indici].copy()
+            punti['distanza_km'] = distanze
+            return punti
+        
+        # Trova uffici postali vicini (escluso quello da chiudere)
+        up_vicini = vicini(self.up_tree, self.gdf_up, posizione_up)
+        if posizione_up is None:
+            up_vicini = up_vicini[up_vicini.geometry != punto_chiusura]
+        
+        return {
+            'up_vicini': up_vicini,
+            'lis_vicini': vicini(self.lis_tree, self.gdf_lis),
+            'banche_vicine': vicini(self.banche_tree, self.gdf_banche)
+        }
+    
+    def calcola_pesi_distanza(self, punti, distanza_max):
+        """
+        Calcola pesi inversamente proporzionali alla distanza
+        
+        Parameters:
+        -----------
+        punti : GeoDataFrame
+            DataFrame contenente i punti con la colonna 'distanza_km'
+        distanza_max : float
+            Distanza massima considerata in km
+            
+        Returns:
+        --------
+        Series : Serie con i pesi calcolati
+        """
+        if len(punti) == 0:
+            return pd.Series()
+            
+        # Calcola peso come inverso della distanza al quadrato (con limite minimo)
+        pesi = 1 / np.maximum(punti['distanza_km']**2, 0.01)
+        
+        # Normalizza i pesi per sommare a 1
+        return pesi / pesi.sum() if pesi.sum() > 0 else pesi
+    
+    def unisci_parametri(self, personalizza_parametri=None):
+        """
+        Restituisce una copia dei parametri di default aggiornata con quelli personalizzati
+        
+        Parameters:
+        -----------
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+            
+        Returns:
+        --------
+        dict : Parametri da usare nella simulazione
+        """
+        # Copia profonda per non modificare i dizionari annidati di self.params
+        params = copy.deepcopy(self.params)
+        if personalizza_parametri:
+            # Aggiorna i parametri in modo ricorsivo
+            def update_dict(d, u):
+                for k, v in u.items():
+                    if isinstance(v, dict):
+                        d[k] = update_dict(d.get(k, {}), v)
+                    else:
+                        d[k] = v
+                return d
+            params = update_dict(params, personalizza_parametri)
+        return params
+    
+    def calcola_geometria(self, posizione, raggio_km, params=None):
+        """
+        Fase geometrica della simulazione di una chiusura: vicini, distanze e pesi
+        
+        Non dipende dai coefficienti di ridistribuzione, per cui il risultato viene
+        memorizzato in self.cache_geometria con chiave (ufficio, raggio).
+        
+        Parameters:
+        -----------
+        posizione : int
+            Posizione dell'ufficio da chiudere in self.archivio_up
+        raggio_km : float
+            Raggio di ricerca in chilometri
+        params : dict, optional
+            Parametri della simulazione, per il bacino (default: self.params)
+            
+        Returns:
+        --------
+        dict : ID, distanze e pesi normalizzati degli UP vicini, dei LIS vicini
+               abilitati per ogni servizio e delle banche vicine (da non modificare)
+        """
+        lon = self.archivio_up.lon[posizione]
+        lat = self.archivio_up.lat[posizione]
+        statistiche = self.statistiche
+        with statistiche.fase('simula_chiusura_up.geometria.ricerca_vicini'):
+            (_, indici_up, distanze_up), (_, indici_lis, distanze_lis) = self.vicini_chiusure(
+                np.atleast_1d(posizione), lon, lat, raggio_km, params
+            )
+            _, indici_banche, distanze_banche = self.cerca_vicini(self.banche_tree, lon, lat, raggio_km)
+        statistiche.conta('vicini_up', len(indici_up))
+        statistiche.conta('vicini_lis', len(indici_lis))
+        statistiche.conta('vicini_banche', len(indici_banche))
+        
+        with statistiche.fase('simula_chiusura_up.geometria.pesi'):
+            # Pesi dei LIS ricalcolati sui soli LIS abilitati a ciascun servizio
+            lis_abilitati = {}
+            for servizio in self.archivio_lis.servizi_abilitati:
+                abilitati = np.asarray(self.archivio_lis.abilitati(servizio)[indici_lis])
+                lis_abilitati[servizio] = (
+                    self.archivio_lis.ids[indici_lis[abilitati]],
+                    pesi_inversi_distanza(np.zeros(abilitati.sum(), dtype=np.int64), distanze_lis[abilitati], 1)
+                )
+            pesi_up = pesi_inversi_distanza(np.zeros(len(indici_up), dtype=np.int64), distanze_up, 1)
+        
+        return {
+            'ids_up': self.archivio_up.ids[indici_up],
+            'distanze_up': distanze_up,
+            'pesi_up': pesi_up,
+            'ids_lis': self.archivio_lis.ids[indici_lis],
+            'distanze_lis': distanze_lis,
+            'lis_abilitati': lis_abilitati,
+            'indici_banche': indici_banche,
+            'distanze_banche': distanze_banche
+        }
+    
+    def applica_parametri(self, geometria, produzione_up, params):
+        """
+        Fase parametrica della simulazione: applica i coefficienti di ridistribuzione
+        ai pesi calcolati da calcola_geometria
+        
+        Parameters:
+        -----------
+        geometria : dict
+            Risultato di calcola_geometria
+        produzione_up : dict
+            Dati (volumi per servizio) dell'ufficio da chiudere
+        params : dict
+            Parametri della simulazione
+            
+        Returns:
+        --------
+        tuple : (redistribuzione, totali) nel formato di simula_chiusura_up
+        """
+        redistribuzione = {}
+        totali = {'up_vicini': {}, 'lis_vicini': {}, 'competitor': {}, 'digitale': {}, 'non_ricollocato': {}}
+        ids_up = geometria['ids_up'].tolist()
+        pesi_up = geometria['pesi_up']
+        
+        for categoria in ('servizi_lis', 'servizi_up'):
+            for servizio, distribuzione in params[categoria].items():
+                if servizio not in produzione_up:
+                    continue
+                
+                volume_originale = produzione_up[servizio]
+                
+                # Redistribuzione agli uffici postali vicini
+                volume_up = volume_originale * distribuzione['up_vicini']
+                
+                if categoria == 'servizi_lis':
+                    # Redistribuzione ai LIS vicini abilitati per questo servizio
+                    volume_lis = volume_originale * distribuzione['lis_vicini']
+                    ids_lis, pesi_lis = geometria['lis_abilitati'].get(servizio, ((), ()))
+                    if len(ids_lis) > 0:
+                        redistribuzione_lis = dict(zip(ids_lis.tolist(), (volume_lis * pesi_lis).tolist()))
+                    else:
+                        # Se non ci sono LIS abilitati, ridistribuisci agli UP
+                        redistribuzione_lis = {}
+                        volume_up += volume_lis
+                
+                redistribuzione_up = dict(zip(ids_up, (volume_up * pesi_up).tolist()))
+                
+                # Volume perso a favore dei competitor e per digitalizzazione
+                volume_competitor = volume_originale * distribuzione['competitor']
+                volume_digitale = volume_originale * distribuzione['digitale']
+                
+                # Salva risultati per questo servizio
+                redistribuzione[servizio] = {
+                    'volume_originale': volume_originale,
+                    'up_vicini': redistribuzione_up
+                }
+                if categoria == 'servizi_lis':
+                    redistribuzione[servizio]['lis_vicini'] = redistribuzione_lis
+                redistribuzione[servizio]['competitor'] = volume_competitor
+                redistribuzione[servizio]['digitale'] = volume_digitale
+                
+                # Aggiorna totali
+                totali['up_vicini'][servizio] = sum(redistribuzione_up.values())
+                if categoria == 'servizi_lis':
+                    totali['lis_vicini'][servizio] = sum(redistribuzione_lis.values())
+                totali['competitor'][servizio] = volume_competitor
+                totali['digitale'][servizio] = volume_digitale
+                # Volume destinato agli UP senza nessun ufficio ricevente nel bacino
+                totali['non_ricollocato'][servizio] = volume_up if len(ids_up) == 0 else 0.0
+                self.statistiche.conta('servizi_elaborati')
+        
+        return redistribuzione, totali
+    
+    def simula_chiusura_up(self, id_up, personalizza_parametri=None, formato='dizionario'):
+        """
+        Simula la chiusura di un ufficio postale e calcola la redistribuzione
+        
+        La simulazione è divisa in due fasi memorizzate separatamente: la fase
+        geometrica (vicini e pesi, in self.cache_geometria) dipende solo da ufficio
+        e raggio, quella parametrica (in self.cache_risultati) anche dai coefficienti.
+        Modificare un coefficiente riesegue quindi solo la fase parametrica.
+        
+        Parameters:
+        -----------
+        id_up : str o int
+            Identificativo dell'ufficio postale da chiudere
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+        formato : str, optional
+            'dizionario' (default) o 'sparso': in quest'ultimo caso 'redistribuzione'
+            è sostituita da 'flussi', una MatriceFlussi (i metodi visualizza_* accettano
+            entrambi i formati)
+            
+        Returns:
+        --------
+        dict : Risultati della simulazione
+        """
+        if formato not in ('dizionario', 'sparso'):
+            raise ValueError(f"Formato dei risultati non valido: {formato}")
+        
+        statistiche = self.statistiche
+        with statistiche.fase('simula_chiusura_up'):
+            with statistiche.fase('simula_chiusura_up.parametri'):
+                # Aggiorna parametri se necessario
+                params = self.unisci_parametri(personalizza_parametri)
+                chiave_bacino = json.dumps(params.get('bacino'), sort_keys=True, default=str)
+                chiave_parametri = json.dumps(
+                    {'servizi_lis': params['servizi_lis'], 'servizi_up': params['servizi_up']},
+                    sort_keys=True, default=str
+                )
+            
+            with statistiche.fase('simula_chiusura_up.raggio'):
+                # Trova l'ufficio postale da chiudere
+                posizione = self.archivio_up.posizione(id_up)
+                if posizione < 0:
+                    statistiche.conta('uffici_non_trovati')
+                    return {'errore': f"Ufficio postale con ID {id_up} non trovato"}
+                
+                # Determina densità popolazione nell'area
+                # (precalcolata dalla sezione di censimento che contiene l'ufficio)
+                densita = float(self.densita_up[posizione])
+                
+                # Calcola raggio di ricerca in base alla densità
+                raggio_km = float(self.calcola_raggi_ricerca(densita, params)) / 1000  # converti metri in km
+            
+            def calcola_geometria():
+                with statistiche.fase('simula_chiusura_up.geometria'):
+                    return self.calcola_geometria(posizione, raggio_km, params)
+            
+            def calcola_risultati():
+                geometria = self.cache_geometria.ottieni((posizione, raggio_km, chiave_bacino), calcola_geometria)
+                with statistiche.fase('simula_chiusura_up.ripartizione'):
+                    # Ottieni dati dell'ufficio da chiudere
+                    produzione_up = self.gdf_up.iloc[posizione].to_dict()
+                    redistribuzione, totali = self.applica_parametri(geometria, produzione_up, params)
+                return {
+                    'up_chiuso': produzione_up,
+                    'raggio_km': raggio_km,
+                    'densita_popolazione': densita,
+                    'redistribuzione': redistribuzione,
+                    'totali': totali
+                }
+            
+            risultati = self.cache_risultati.ottieni((posizione, raggio_km, chiave_bacino, chiave_parametri),
+                                                     calcola_risultati)
+            with statistiche.fase('simula_chiusura_up.copia_risultati'):
+                # Copia, perché il chiamante può modificare i risultati
+                risultati = copy.deepcopy(risultati)
+                if formato == 'sparso':
+                    risultati['flussi'] = self._matrice_da_redistribuzione(
+                        posizione, risultati.pop('redistribuzione')
+                    )
+            return risultati
+    
+    def _matrice_da_redistribuzione(self, posizione, redistribuzione):
+        # Converte la redistribuzione annidata di un ufficio in una MatriceFlussi
+        n_up = len(self.archivio_up)
+        coordinate = ([], [], [], [])
+        for servizio, dettaglio in redistribuzione.items():
+            for tipo, archivio, scostamento in (('up_vicini', self.archivio_up, 0),
+                                                ('lis_vicini', self.archivio_lis, n_up)):
+                volumi = dettaglio.get(tipo, {})
+                colonne = archivio.posizioni(list(volumi)) + scostamento
+                for lista, valori in zip(coordinate, (servizio, np.full(len(volumi), posizione), colonne,
+                                                      np.fromiter(volumi.values(), dtype=np.float64,
+                                                                  count=len(volumi)))):
+                    lista.append(valori)
+        return MatriceFlussi.da_array(*coordinate, self.archivio_up.ids, self.archivio_lis.ids)
+    
+    def _redistribuzione(self, risultati):
+        """
+        Redistribuzione annidata dei risultati di simula_chiusura_up, ricostruita
+        da 'flussi' e 'totali' se i risultati sono in formato 'sparso'
+        """
+        if 'redistribuzione' in risultati:
+            return risultati['redistribuzione']
+        flussi, totali, up_chiuso = risultati['flussi'], risultati['totali'], risultati['up_chiuso']
+        n_up = len(flussi.ids_up)
+        posizione = self.archivio_up.posizione(up_chiuso['id'])
+        redistribuzione = {}
+        for servizio in totali['competitor']:
+            riga = flussi.matrici[servizio][posizione] if servizio in flussi.matrici else sparse.csr_matrix((1, 0))
+            colonne, volumi = riga.indices, riga.data
+            up = colonne < n_up
+            redistribuzione[servizio] = {
+                'volume_originale': up_chiuso[servizio],
+                'up_vicini': dict(zip(flussi.ids_up[colonne[up]].tolist(), volumi[up].tolist()))
+            }
+            if servizio in totali['lis_vicini']:
+                redistribuzione[servizio]['lis_vicini'] = dict(zip(
+                    flussi.ids_lis[colonne[~up] - n_up].tolist(), volumi[~up].tolist()
+                ))
+            redistribuzione[servizio]['competitor'] = totali['competitor'][servizio]
+            redistribuzione[servizio]['digitale'] = totali['digitale'][servizio]
+        return redistribuzione
+    
+    def statistiche_cache(self):
+        """
+        Restituisce le statistiche di hit/miss delle cache della simulazione singola
+        
+        Returns:
+        --------
+        dict : statistiche di self.cache_geometria e self.cache_risultati
+        """
+        return {
+            'geometria': self.cache_geometria.statistiche(),
+            'risultati': self.cache_risultati.statistiche()
+        }
+    
+    def svuota_cache(self):
+        """
+        Svuota le cache di simula_chiusura_up (da chiamare se i dati vengono modificati)
+        """
+        self.cache_geometria.svuota()
+        self.cache_risultati.svuota()
+    
+    def _inizializza_cache(self, dimensione_cache):
+        # Cache LRU delle due fasi di simula_chiusura_up
+        self.cache_geometria = CacheLRU(dimensione_cache)
+        self.cache_risultati = CacheLRU(dimensione_cache)
+    
+    def calcola_raggi_ricerca(self, densita, params=None):
+        """
+        Versione vettorizzata di calcola_raggio_ricerca per un array di densità
+        
+        Parameters:
+        -----------
+        densita : array-like
+            Densità della popolazione (abitanti/km²) per ogni punto
+        params : dict, optional
+            Parametri della simulazione (default: self.params)
+            
+        Returns:
+        --------
+        ndarray : raggi di ricerca in metri
+        """
+        raggio_base = (params or self.params)['raggio_base']
+        densita = np.asarray(densita, dtype=float)
+        return np.select(
+            [densita <= 100, densita <= 1000, densita <= 5000],
+            [raggio_base * 3, raggio_base * 2, raggio_base],
+            default=raggio_base * 0.7
+        )
+    
+    def calcola_densita_punti(self, lon, lat):
+        """
+        Determina la densità di popolazione per un insieme di punti
         
-        # Preparazione strutture dati per la ricerca spaziale
-        self.prepara_balltree()
+        Parameters:
+        -----------
+        lon, lat : float o array-like
+            Coordinate dei punti in gradi
+            
+        Returns:
+        --------
+        ndarray : densità (abitanti/km²) della sezione di censimento che contiene
+                  ciascun punto, DENSITA_DEFAULT per i punti fuori dalle sezioni
+        """
+        sezioni = self.trova_sezioni(lon, lat)
+        return np.where(sezioni >= 0, self.densita_sezioni[sezioni], DENSITA_DEFAULT)
+    
+    def _prepara_chiusure(self, ids_up, params):
+        """
+        Risolve gli ID degli uffici da chiudere e calcola densità e raggi di ricerca
         
-    def prepara_balltree(self):
+        Returns:
+        --------
+        dict : ID e posizioni degli uffici trovati, coordinate, densità, raggi in km
+               e lista degli ID non trovati
         """
-        Prepara le strutture dati BallTree per ricerche spaziali efficienti
+        ids_up = np.asarray(ids_up)
+        posizioni = self.archivio_up.posizioni(ids_up)
+        trovati = posizioni[posizioni >= 0]
+        
+        # Densità (precalcolata) e raggio di ricerca per tutti gli uffici
+        densita = np.asarray(self.densita_up[trovati])
+        return {
+            'ids_up': ids_up[posizioni >= 0],
+            'posizioni': trovati,
+            'non_trovati': ids_up[posizioni < 0].tolist(),
+            'lon': np.asarray(self.archivio_up.lon[trovati]),
+            'lat': np.asarray(self.archivio_up.lat[trovati]),
+            'densita': densita,
+            'raggi_km': self.calcola_raggi_ricerca(densita, params) / 1000
+        }
+    
+    def _ripartisci_servizi(self, params, ids_up, vicini_lis, distribuisci_up, formato='dataframe'):
         """
-        # Converte coordinate in radianti per BallTree
-        def get_spherical_coords(gdf):
-            lon = np.radians(gdf.geometry.x)
-            lat = np.radians(gdf.geometry.y)
-            return np.column_stack([lon, lat])
+        Ripartisce i volumi di ogni servizio tra UP, LIS, competitor e digitale
+        per un insieme di uffici chiusi
         
-        # Crea BallTree per ogni dataset
-        self.up_tree = BallTree(get_spherical_coords(self.gdf_up), metric='haversine')
-        self.lis_tree = BallTree(get_spherical_coords(self.gdf_lis), metric='haversine')
-        self.banche_tree = BallTree(get_spherical_coords(self.gdf_banche), metric='haversine')
+        Parameters:
+        -----------
+        params : dict
+            Parametri della simulazione
+        ids_up : ndarray
+            ID degli uffici chiusi
+        vicini_lis : tuple
+            (gruppo, indici, distanze_km) dei LIS vicini, come restituito da cerca_vicini
+        distribuisci_up : callable
+            Riceve il volume destinato agli UP per ogni ufficio chiuso e restituisce
+            (gruppo, indici_riceventi, volumi, volume_assegnato_per_ufficio)
+        formato : str, optional
+            'dataframe' per i flussi in formato lungo, 'sparso' per una MatriceFlussi
+            
+        Returns:
+        --------
+        tuple : (totali, flussi) con totali come DataFrame colonnare
+        """
+        if formato not in ('dataframe', 'sparso'):
+            raise ValueError(f"Formato dei risultati non valido: {formato}")
+        n = len(ids_up)
+        n_up = len(self.archivio_up)
+        posizioni = self.archivio_up.posizioni(ids_up)
+        gruppo_lis, indici_lis, distanza_lis = vicini_lis
+        
+        totali = []
+        flussi = []
+        # Coordinate delle matrici sparse: servizio, righe, colonne, volumi
+        coordinate = ([], [], [], [])
+        
+        # Colonne categoriche: compatte da concatenare e da trasferire tra processi
+        tipo_servizio = pd.CategoricalDtype(list(params['servizi_lis']) + list(params['servizi_up']))
+        tipo_destinazione = pd.CategoricalDtype(['up_vicini', 'lis_vicini'])
+        
+        def categoria_costante(valore, dtype, n_righe):
+            codici = np.full(n_righe, dtype.categories.get_loc(valore), dtype=np.int16)
+            return pd.Categorical.from_codes(codici, dtype=dtype)
+        
+        def aggiungi_flussi(servizio, tipo, gruppo, indici_riceventi, volumi):
+            archivio = self.archivio_up if tipo == 'up_vicini' else self.archivio_lis
+            if formato == 'sparso':
+                # Colonne: prima gli UP, poi i LIS
+                for lista, valori in zip(coordinate, (servizio, posizioni[gruppo],
+                                                      indici_riceventi + (0 if tipo == 'up_vicini' else n_up),
+                                                      volumi)):
+                    lista.append(valori)
+                return
+            flussi.append(pd.DataFrame({
+                'id_up': ids_up[gruppo],
+                'servizio': categoria_costante(servizio, tipo_servizio, len(gruppo)),
+                'tipo': categoria_costante(tipo, tipo_destinazione, len(gruppo)),
+                'id_ricevente': archivio.ids[indici_riceventi],
+                'volume': volumi
+            }))
+        
+        for categoria in ('servizi_lis', 'servizi_up'):
+            for servizio, distribuzione in params[categoria].items():
+                if not self.archivio_up.ha_volume(servizio):
+                    continue
+                
+                volume_originale = self.archivio_up.volume(servizio)[posizioni]
+                volume_up = volume_originale * distribuzione['up_vicini']
+                volume_lis_assegnato = np.zeros(n)
+                
+                if categoria == 'servizi_lis':
+                    # Redistribuzione ai LIS vicini abilitati per questo servizio
+                    volume_lis = volume_originale * distribuzione['lis_vicini']
+                    abilitati = self.archivio_lis.abilitati(servizio)[indici_lis]
+                    ha_lis = np.bincount(gruppo_lis, weights=abilitati, minlength=n) > 0
+                    
+                    pesi_lis = pesi_inversi_distanza(gruppo_lis, distanza_lis, n, abilitati)
+                    volumi_lis = volume_lis[gruppo_lis] * pesi_lis
+                    aggiungi_flussi(servizio, 'lis_vicini', gruppo_lis[abilitati],
+                                    indici_lis[abilitati], volumi_lis[abilitati])
+                    volume_lis_assegnato = np.where(ha_lis, volume_lis, 0.0)
+                    
+                    # Se non ci sono LIS abilitati, ridistribuisci agli UP
+                    volume_up = volume_up + np.where(ha_lis, 0.0, volume_lis)
+                
+                gruppo_up, indici_up, volumi_up, volume_up_assegnato = distribuisci_up(volume_up)
+                aggiungi_flussi(servizio, 'up_vicini', gruppo_up, indici_up, volumi_up)
+                
+                totali.append(pd.DataFrame({
+                    'id_up': ids_up,
+                    'servizio': categoria_costante(servizio, tipo_servizio, n),
+                    'volume_originale': volume_originale,
+                    'up_vicini': volume_up_assegnato,
+                    'lis_vicini': volume_lis_assegnato,
+                    'competitor': volume_originale * distribuzione['competitor'],
+                    'digitale': volume_originale * distribuzione['digitale'],
+                    # Volume destinato agli UP che non trova nessun ufficio ricevente
+                    'non_ricollocato': volume_up - volume_up_assegnato
+                }))
+        
+        colonne_totali = ['id_up', 'servizio', 'volume_originale', 'up_vicini',
+                          'lis_vicini', 'competitor', 'digitale', 'non_ricollocato']
+        colonne_flussi = ['id_up', 'servizio', 'tipo', 'id_ricevente', 'volume']
+        totali = pd.concat(totali, ignore_index=True) if totali else pd.DataFrame(columns=colonne_totali)
+        if formato == 'sparso':
+            return totali, MatriceFlussi.da_array(*coordinate, self.archivio_up.ids, self.archivio_lis.ids)
+        return (
+            totali,
+            pd.concat(flussi, ignore_index=True) if flussi else pd.DataFrame(columns=colonne_flussi)
+        )
     
-    def configura_parametri_simulazione(self):
+    def simula_chiusure_batch(self, ids_up, personalizza_parametri=None, formato='dataframe'):
         """
-        Configura i parametri di default per la simulazione
+        Simula la chiusura di ciascun ufficio postale, uno alla volta, in un unico
+        passaggio vettorizzato
+        
+        Le ricerche dei vicini vengono eseguite per tutti gli uffici insieme e i pesi
+        sono calcolati su array, senza cicli Python sui singoli vicini. Ogni chiusura
+        è indipendente dalle altre, con la stessa logica di simula_chiusura_up.
+        
+        Parameters:
+        -----------
+        ids_up : list
+            Identificativi degli uffici postali da chiudere (uno per simulazione)
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+        formato : str, optional
+            Formato dei flussi: 'dataframe' (default) o 'sparso' (MatriceFlussi)
+            
+        Returns:
+        --------
+        dict : Risultati colonnari della simulazione
+            'uffici' : DataFrame con raggio, densità e numero di vicini per ufficio chiuso
+            'totali' : DataFrame con i volumi per ufficio chiuso e servizio
+            'flussi' : DataFrame (o MatriceFlussi) con i volumi assegnati a ogni UP/LIS ricevente
+            'non_trovati' : lista degli ID non presenti nel dataset
         """
-        # Parametri per la distribuzione della produzione
-        self.params = {
-            # Raggio di influenza in metri - varierà in base alla densità di popolazione
-            'raggio_base': 1000,
+        statistiche = self.statistiche
+        with statistiche.fase('simula_chiusure_batch'):
+            params = self.unisci_parametri(personalizza_parametri)
+            chiusure = self._prepara_chiusure(ids_up, params)
+            ids_up = chiusure['ids_up']
+            n = len(ids_up)
+            statistiche.conta('uffici_simulati', n)
             
-            # Coefficienti di ridistribuzione per servizi disponibili nei LIS
-            'servizi_lis': {
-                'bollettini': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
-                'bollette': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
-                'pagoPA': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
-                'ricariche_postepay': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
-                'ricariche_telefoniche': {'up_vicini': 0.4, 'lis_vicini': 0.3, 'competitor': 0.2, 'digitale': 0.1},
-                'pacchi': {'up_vicini': 0.5, 'lis_vicini': 0.2, 'competitor': 0.2, 'digitale': 0.1},
-            },
+            with statistiche.fase('simula_chiusure_batch.vicini'):
+                # Ricerca dei vicini per tutti gli uffici in un'unica chiamata per albero,
+                # escludendo dagli UP vicini l'ufficio da chiudere
+                (gruppo_up, indici_up, distanza_up), vicini_lis = self.vicini_chiusure(
+                    chiusure['posizioni'], chiusure['lon'], chiusure['lat'], chiusure['raggi_km'], params
+                )
             
-            # Coefficienti di ridistribuzione per servizi disponibili solo negli uffici postali
-            'servizi_up': {
-                'polizze': {'up_vicini': 0.7, 'competitor': 0.2, 'digitale': 0.1},
-                'conti': {'up_vicini': 0.7, 'competitor': 0.2, 'digitale': 0.1},
-                'fibra': {'up_vicini': 0.6, 'competitor': 0.3, 'digitale': 0.1},
-                'energia': {'up_vicini': 0.6, 'competitor': 0.3, 'digitale': 0.1},
-                'altri_servizi': {'up_vicini': 0.7, 'competitor': 0.2, 'digitale': 0.1},
-            }
+            # Pesi inversamente proporzionali al quadrato della distanza, normalizzati per ufficio
+            pesi_up = pesi_inversi_distanza(gruppo_up, distanza_up, n)
+            ha_up = np.bincount(gruppo_up, minlength=n) > 0
+            
+            def distribuisci_up(volume_up):
+                return (gruppo_up, indici_up, volume_up[gruppo_up] * pesi_up,
+                        np.where(ha_up, volume_up, 0.0))
+            
+            with statistiche.fase('simula_chiusure_batch.ripartizione'):
+                totali, flussi = self._ripartisci_servizi(params, ids_up, vicini_lis, distribuisci_up, formato)
+        
+        return {
+            'uffici': pd.DataFrame({
+                'id_up': ids_up,
+                'raggio_km': chiusure['raggi_km'],
+                'densita_popolazione': chiusure['densita'],
+                'n_up_vicini': np.bincount(gruppo_up, minlength=n),
+                'n_lis_vicini': np.bincount(vicini_lis[0], minlength=n)
+            }),
+            'totali': totali,
+            'flussi': flussi,
+            'non_trovati': chiusure['non_trovati']
         }
     
-    def calcola_raggio_ricerca(self, densita_popolazione):
+    def simula_chiusure_parallelo(self, ids_up, personalizza_parametri=None, n_processi=None,
+                                  dimensione_blocco=500, cartella_condivisa=None, formato='dataframe'):
         """
-        Calcola il raggio di ricerca in base alla densità della popolazione
+        Esegue simula_chiusure_batch distribuendo gli uffici su un pool di processi
+        
+        Coordinate, volumi, densità e BallTree vengono esportati una sola volta in
+        file .npy che ogni worker apre in memory-map: i dati in sola lettura sono
+        condivisi tramite la page cache e non vengono serializzati verso i worker,
+        che ricevono solo gli ID di ciascun blocco.
         
         Parameters:
         -----------
-        densita_popolazione : float
-            Densità della popolazione nell'area (abitanti/km²)
+        ids_up : list
+            Identificativi degli uffici postali da chiudere (uno per simulazione)
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+        n_processi : int, optional
+            Numero di processi (default: numero di CPU)
+        dimensione_blocco : int, optional
+            Numero di uffici simulati da un worker in una singola chiamata
+        cartella_condivisa : str, optional
+            Cartella per i file condivisi (default: cartella temporanea rimossa al termine)
+        formato : str, optional
+            Formato dei flussi: 'dataframe' (default) o 'sparso' (MatriceFlussi)
             
         Returns:
         --------
-        float : raggio di ricerca in metri
+        dict : Risultati colonnari come in simula_chiusure_batch
         """
-        # Raggio inversamente proporzionale alla densità, con limiti
-        if densita_popolazione <= 100:  # Zone rurali
-            return self.params['raggio_base'] * 3
-        elif densita_popolazione <= 1000:  # Zone suburbane
-            return self.params['raggio_base'] * 2
-        elif densita_popolazione <= 5000:  # Zone urbane
-            return self.params['raggio_base']
-        else:  # Zone ad alta densità
-            return self.params['raggio_base'] * 0.7
+        ids_up = np.asarray(ids_up)
+        n_blocchi = max(1, math.ceil(len(ids_up) / dimensione_blocco))
+        blocchi = np.array_split(ids_up, n_blocchi)
+        
+        with tempfile.TemporaryDirectory(dir=cartella_condivisa) as cartella:
+            self.esporta_dati_condivisi(cartella)
+            with ProcessPoolExecutor(max_workers=n_processi, initializer=_inizializza_worker,
+                                     initargs=(cartella,)) as pool:
+                risultati = []
+                for risultati_blocco, statistiche in pool.map(_simula_blocco, blocchi,
+                                                              itertools.repeat(personalizza_parametri),
+                                                              itertools.repeat(formato)):
+                    risultati.append(risultati_blocco)
+                    self.statistiche.unisci(statistiche)
+        
+        if formato == 'sparso':
+            flussi = risultati[0]['flussi']
+            for r in risultati[1:]:
+                flussi = flussi + r['flussi']
+        else:
+            flussi = pd.concat([r['flussi'] for r in risultati], ignore_index=True)
+        
+        return {
+            'uffici': pd.concat([r['uffici'] for r in risultati], ignore_index=True),
+            'totali': pd.concat([r['totali'] for r in risultati], ignore_index=True),
+            'flussi': flussi,
+            'non_trovati': [i for r in risultati for i in r['non_trovati']]
+        }
     
-    def trova_punti_vicini(self, punto_chiusura, raggio_km):
+    def simula_sweep(self, ids_up, insiemi_parametri, cartella, dimensione_blocco=1000,
+                     n_processi=1, **opzioni_scrittura):
         """
-        Trova tutti i punti (UP, LIS, banche) entro un certo raggio
+        Simula la chiusura di ciascun ufficio per più insiemi di parametri, scrivendo
+        i risultati su Parquet man mano che vengono prodotti
+        
+        Ogni blocco di uffici viene simulato con simula_chiusure_batch, scritto con
+        ScrittoreParquet e scartato: in memoria restano solo i blocchi in corso.
+        I risultati sono partizionati per indice dell'insieme di parametri
+        (colonna 'parametri'); gli insiemi sono salvati in cartella/parametri.json.
         
         Parameters:
         -----------
-        punto_chiusura : Point
-            Geometria del punto dell'ufficio postale da chiudere
-        raggio_km : float
-            Raggio di ricerca in chilometri
+        ids_up : list
+            Identificativi degli uffici postali da chiudere (uno per simulazione)
+        insiemi_parametri : list
+            Parametri personalizzati, uno per simulazione di tutti gli uffici
+        cartella : str
+            Cartella di destinazione dei risultati
+        dimensione_blocco : int, optional
+            Numero di uffici simulati in una singola chiamata
+        n_processi : int, optional
+            Numero di processi (con più di 1 i dati vengono condivisi come in
+            simula_chiusure_parallelo)
+        **opzioni_scrittura :
+            Argomenti passati a ScrittoreParquet
             
         Returns:
         --------
-        dict : Dizionario contenente i punti vicini per categoria
+        dict : numero di righe scritte per tabella
         """
-        # Converti coordinate in radianti
-        lon, lat = np.radians([punto_chiusura.x, punto_chiusura.y])
-        punto_rad = np.array([[lon, lat]])
+        ids_up = np.asarray(ids_up)
+        blocchi = np.array_split(ids_up, max(1, math.ceil(len(ids_up) / dimensione_blocco)))
+        insiemi_parametri = list(insiemi_parametri)
+        lavori = ((k, blocco) for k in range(len(insiemi_parametri)) for blocco in blocchi)
+        
+        with ScrittoreParquet(cartella, **opzioni_scrittura) as scrittore:
+            with open(os.path.join(cartella, 'parametri.json'), 'w') as f:
+                json.dump(insiemi_parametri, f, indent=2, default=str)
+            
+            if n_processi == 1:
+                for k, blocco in lavori:
+                    scrittore.scrivi(self.simula_chiusure_batch(blocco, insiemi_parametri[k]), parametri=k)
+            else:
+                self._sweep_parallelo(lavori, insiemi_parametri, scrittore, n_processi or os.cpu_count())
         
-        # Trova uffici postali vicini (escluso quello da chiudere)
-        indici_up = self.up_tree.query_radius(punto_rad, r=raggio_km/6371.0)[0]  # raggio/raggio terra
-        up_vicini = self.gdf_up.iloc[indici_up].copy()
-        up_vicini = up_vicini[up_vicini.geometry != punto_chiusura]
+        return dict(scrittore.righe_scritte)
+    
+    def _sweep_parallelo(self, lavori, insiemi_parametri, scrittore, n_processi):
+        def scrivi(k, futuro):
+            risultati, statistiche = futuro.result()
+            self.statistiche.unisci(statistiche)
+            scrittore.scrivi(risultati, parametri=k)
+        
+        with tempfile.TemporaryDirectory() as condivisa:
+            self.esporta_dati_condivisi(condivisa)
+            with ProcessPoolExecutor(max_workers=n_processi, initializer=_inizializza_worker,
+                                     initargs=(condivisa,)) as pool:
+                # Al più due blocchi in corso per processo, scritti nell'ordine di invio
+                in_corso = []
+                for k, blocco in lavori:
+                    in_corso.append((k, pool.submit(_simula_blocco, blocco, insiemi_parametri[k])))
+                    if len(in_corso) >= 2 * n_processi:
+                        scrivi(*in_corso.pop(0))
+                for k_fatto, futuro in in_corso:
+                    scrivi(k_fatto, futuro)
+    
+    def simula_scenario_chiusure(self, ids_up, personalizza_parametri=None, formato='dataframe'):
+        """
+        Simula la chiusura simultanea di un insieme di uffici postali
         
-        # Calcola la distanza di ciascun UP vicino e aggiungi come colonna
-        up_vicini['distanza_km'] = up_vicini.geometry.apply(
-            lambda p: punto_chiusura.distance(p) * 111  # approssimazione km (1 grado ≈ 111 km)
-        )
+        Gli uffici chiusi vengono mascherati nei risultati dei BallTree esistenti,
+        senza ricostruire gli indici. Un ufficio chiuso che ha vicini aperti
+        ridistribuisce la quota UP solo a questi; se tutti i suoi vicini sono chiusi
+        la quota passa a loro in cascata e viene inoltrata con i loro pesi fino a
+        raggiungere un ufficio aperto. Il volume che non può raggiungere nessun
+        ufficio aperto è riportato nella colonna 'non_ricollocato'. Con il bacino
+        'knn' i vicini sono i k uffici aperti più vicini, per cui non c'è cascata.
         
-        # Trova LIS vicini abilitati
-        indici_lis = self.lis_tree.query_radius(punto_rad, r=raggio_km/6371.0)[0]
-        lis_vicini = self.gdf_lis.iloc[indici_lis].copy()
+        Parameters:
+        -----------
+        ids_up : list
+            Identificativi degli uffici postali chiusi nello scenario
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+        formato : str, optional
+            Formato dei flussi: 'dataframe' (default) o 'sparso' (MatriceFlussi)
+            
+        Returns:
+        --------
+        dict : Risultati colonnari come in simula_chiusure_batch; i flussi verso gli UP
+               sono attribuiti all'ufficio chiuso di origine dopo la cascata
+        """
+        params = self.unisci_parametri(personalizza_parametri)
+        # Ogni ufficio viene chiuso una sola volta
+        ids_up = pd.unique(np.asarray(ids_up))
+        chiusure = self._prepara_chiusure(ids_up, params)
+        ids_up = chiusure['ids_up']
+        posizioni = chiusure['posizioni']
+        n = len(ids_up)
+        n_up = len(self.archivio_up)
+        
+        # Maschera degli uffici chiusi e indice di ciascuno nello scenario
+        indice_chiuso = np.full(n_up, -1, dtype=np.int64)
+        indice_chiuso[posizioni] = np.arange(n)
+        
+        (gruppo_up, indici_up, distanza_up), vicini_lis = self.vicini_chiusure(
+            posizioni, chiusure['lon'], chiusure['lat'], chiusure['raggi_km'], params,
+            chiusi=indice_chiuso >= 0
+        )
         
-        # Calcola la distanza di ciascun LIS vicino
-        lis_vicini['distanza_km'] = lis_vicini.geometry.apply(
-            lambda p: punto_chiusura.distance(p) * 111
+        destinazione = indice_chiuso[indici_up]
+        vicino_chiuso = destinazione >= 0
+        ha_aperti = np.bincount(gruppo_up, weights=~vicino_chiuso, minlength=n) > 0
+        
+        # Uffici chiusi da cui si può raggiungere un ufficio aperto, anche in cascata
+        raggiunge = ha_aperti.copy()
+        while True:
+            inoltro = vicino_chiuso & ~ha_aperti[gruppo_up]
+            inoltro[inoltro] = raggiunge[destinazione[inoltro]]
+            nuovo = raggiunge | (np.bincount(gruppo_up, weights=inoltro, minlength=n) > 0)
+            if (nuovo == raggiunge).all():
+                break
+            raggiunge = nuovo
+        
+        # Con vicini aperti il volume va solo a loro, altrimenti ai vicini chiusi
+        # da cui prosegue la cascata
+        usa = np.where(ha_aperti[gruppo_up], ~vicino_chiuso, inoltro)
+        pesi = pesi_inversi_distanza(gruppo_up, distanza_up, n, usa)
+        
+        # Trasferimenti tra uffici chiusi e verso gli uffici aperti
+        verso_chiusi = usa & vicino_chiuso
+        verso_aperti = usa & ~vicino_chiuso
+        trasferimenti_chiusi = sparse.csc_matrix(
+            (pesi[verso_chiusi], (gruppo_up[verso_chiusi], destinazione[verso_chiusi])),
+            shape=(n, n)
+        )
+        trasferimenti_aperti = sparse.csc_matrix(
+            (pesi[verso_aperti], (gruppo_up[verso_aperti], indici_up[verso_aperti])),
+            shape=(n, n_up)
         )
         
-        # Trova banche vicine
-        indici_banche = self.banche_tree.query_radius(punto_rad, r=raggio_km/6371.0)[0]
-        banche_vicine = self.gdf_banche.iloc[indici_banche].copy()
+        # Quota di ciascun ufficio chiuso che arriva a ogni ufficio aperto dopo la cascata:
+        # T = (I - P)^-1 Q
+        if n > 0 and trasferimenti_chiusi.nnz > 0:
+            trasferimenti = sparse.csr_matrix(spsolve(
+                (sparse.identity(n, format='csc') - trasferimenti_chiusi), trasferimenti_aperti
+            ))
+        else:
+            trasferimenti = trasferimenti_aperti.tocsr()
+        trasferimenti.eliminate_zeros()
+        trasferimenti = trasferimenti.tocoo()
+        quota_assegnata = np.bincount(trasferimenti.row, weights=trasferimenti.data, minlength=n)
         
-        # Calcola la distanza di ciascuna banca vicina
-        banche_vicine['distanza_km'] = banche_vicine.geometry.apply(
-            lambda p: punto_chiusura.distance(p) * 111
-        )
+        def distribuisci_up(volume_up):
+            return (trasferimenti.row, trasferimenti.col,
+                    volume_up[trasferimenti.row] * trasferimenti.data,
+                    volume_up * quota_assegnata)
+        
+        totali, flussi = self._ripartisci_servizi(params, ids_up, vicini_lis, distribuisci_up, formato)
         
         return {
-            'up_vicini': up_vicini,
-            'lis_vicini': lis_vicini,
-            'banche_vicine': banche_vicine
+            'uffici': pd.DataFrame({
+                'id_up': ids_up,
+                'raggio_km': chiusure['raggi_km'],
+                'densita_popolazione': chiusure['densita'],
+                'n_up_vicini': np.bincount(gruppo_up, minlength=n),
+                'n_up_vicini_aperti': np.bincount(gruppo_up, weights=~vicino_chiuso, minlength=n).astype(np.int64),
+                'n_lis_vicini': np.bincount(vicini_lis[0], minlength=n),
+                'in_cascata': ~ha_aperti & raggiunge
+            }),
+            'totali': totali,
+            'flussi': flussi,
+            'non_trovati': chiusure['non_trovati']
         }
     
-    def calcola_pesi_distanza(self, punti, distanza_max):
+    def simula_scenario_capacitato(self, ids_up, capacita_up=None, capacita_lis=None,
+                                   personalizza_parametri=None, max_iterazioni=100, tolleranza=1e-9,
+                                   formato='dataframe'):
         """
-        Calcola pesi inversamente proporzionali alla distanza
+        Simula la chiusura simultanea di un insieme di uffici con capacità limitata
+        dei punti riceventi
+        
+        Si parte dai flussi di simula_scenario_chiusure. A ogni iterazione ogni punto
+        accetta il volume in arrivo fino alla propria capacità residua, in proporzione
+        su tutti i flussi entranti; l'eccedenza dei punti saturi viene inoltrata, con
+        pesi inversamente proporzionali al quadrato della distanza, ai punti dello
+        stesso tipo (UP o LIS abilitati al servizio) entro il raggio di ricerca del
+        punto saturo che hanno ancora capacità. L'insieme dei punti saturi cresce a
+        ogni iterazione; il volume che non trova capacità è riportato in
+        'non_ricollocato'. Tutti i passaggi sono operazioni su matrici sparse
+        (ufficio chiuso × punto ricevente), senza simulazioni per singolo ufficio.
         
         Parameters:
         -----------
-        punti : GeoDataFrame
-            DataFrame contenente i punti con la colonna 'distanza_km'
-        distanza_max : float
-            Distanza massima considerata in km
+        ids_up : list
+            Identificativi degli uffici postali chiusi nello scenario
+        capacita_up, capacita_lis : str, float o array-like, optional
+            Volume aggiuntivo (somma su tutti i servizi) che ogni UP/LIS può assorbire:
+            nome di una colonna di df_up/df_lis, valore comune o array allineato ai
+            dati (default: capacità illimitata)
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+        max_iterazioni : int, optional
+            Numero massimo di passaggi di inoltro dell'eccedenza
+        tolleranza : float, optional
+            Volume sotto il quale un'eccedenza viene considerata nulla
+        formato : str, optional
+            Formato dei flussi: 'dataframe' (default) o 'sparso' (MatriceFlussi)
             
         Returns:
         --------
-        Series : Serie con i pesi calcolati
+        dict : Risultati colonnari come in simula_scenario_chiusure, più
+            'carico' : DataFrame con capacità e volume ricevuto da ogni punto ricevente
+            'iterazioni' : numero di passaggi eseguiti
         """
-        if len(punti) == 0:
-            return pd.Series()
+        if formato not in ('dataframe', 'sparso'):
+            raise ValueError(f"Formato dei risultati non valido: {formato}")
+        params = self.unisci_parametri(personalizza_parametri)
+        risultati = self.simula_scenario_chiusure(ids_up, personalizza_parametri, formato='sparso')
+        n_up = len(self.archivio_up)
+        n_riceventi = n_up + len(self.archivio_lis)
+        
+        capacita = np.concatenate([
+            self._capacita(self.df_up, capacita_up, n_up),
+            self._capacita(self.df_lis, capacita_lis, len(self.archivio_lis))
+        ])
+        # Gli uffici chiusi non possono ricevere volume inoltrato
+        residua = capacita.copy()
+        residua[self.archivio_up.posizioni(risultati['uffici']['id_up'])] = 0.0
+        
+        in_arrivo = dict(risultati['flussi'].matrici)
+        accettati = {servizio: sparse.csr_matrix(m.shape) for servizio, m in in_arrivo.items()}
+        persi = {servizio: np.zeros(n_up) for servizio in in_arrivo}
+        
+        def somma_righe(matrice):
+            return np.asarray(matrice.sum(axis=1)).ravel()
+        
+        iterazioni = 0
+        while in_arrivo and iterazioni < max_iterazioni:
+            iterazioni += 1
+            carico = sum(np.asarray(m.sum(axis=0)).ravel() for m in in_arrivo.values())
             
-        # Calcola peso come inverso della distanza al quadrato (con limite minimo)
-        pesi = 1 / np.maximum(punti['distanza_km']**2, 0.01)
+            # Quota accettata da ogni punto: tutto se c'è capacità, altrimenti la capacità residua
+            saturi = carico > residua + tolleranza
+            quota = np.ones(n_riceventi)
+            quota[saturi] = residua[saturi] / carico[saturi]
+            diagonale = sparse.diags(quota)
+            eccesso = {}
+            for servizio, matrice in in_arrivo.items():
+                accettato = (matrice @ diagonale).tocsr()
+                accettati[servizio] = accettati[servizio] + accettato
+                eccesso[servizio] = matrice - accettato
+            residua = np.where(saturi, 0.0, np.maximum(residua - carico, 0.0))
+            
+            if not saturi.any():
+                in_arrivo = {}
+                break
+            
+            # Inoltro dell'eccedenza dai punti saturi ai vicini con capacità residua
+            instradamento = self._instradamento_eccedenza(np.flatnonzero(saturi), residua > tolleranza,
+                                                          list(eccesso), params)
+            in_arrivo = {}
+            for servizio, matrice in eccesso.items():
+                inoltrato = (matrice @ instradamento[servizio]).tocsr()
+                persi[servizio] += somma_righe(matrice) - somma_righe(inoltrato)
+                inoltrato.data[inoltrato.data < tolleranza] = 0.0
+                inoltrato.eliminate_zeros()
+                if inoltrato.nnz > 0:
+                    in_arrivo[servizio] = inoltrato
+        
+        # Volume ancora in transito dopo l'ultima iterazione
+        for servizio, matrice in in_arrivo.items():
+            persi[servizio] += somma_righe(matrice)
+        
+        flussi = MatriceFlussi(accettati, self.archivio_up.ids, self.archivio_lis.ids)
+        
+        # Totali ricalcolati dai flussi accettati
+        totali = risultati['totali']
+        for servizio, matrice in accettati.items():
+            righe = (totali['servizio'] == servizio).to_numpy()
+            posizioni = self.archivio_up.posizioni(totali.loc[righe, 'id_up'])
+            totali.loc[righe, 'up_vicini'] = somma_righe(matrice[:, :n_up])[posizioni]
+            totali.loc[righe, 'lis_vicini'] = somma_righe(matrice[:, n_up:])[posizioni]
+            totali.loc[righe, 'non_ricollocato'] += persi[servizio][posizioni]
+        
+        ricevuto = np.asarray(flussi.matrice().sum(axis=0)).ravel()
+        riceve = ricevuto > 0
+        risultati['carico'] = pd.DataFrame({
+            'id_ricevente': flussi.ids_riceventi[riceve],
+            'tipo': flussi.tipi_riceventi[riceve],
+            'capacita': capacita[riceve],
+            'ricevuto': ricevuto[riceve],
+            'saturo': ricevuto[riceve] >= capacita[riceve] - tolleranza
+        })
+        risultati['totali'] = totali
+        risultati['flussi'] = flussi if formato == 'sparso' else flussi.a_dataframe()
+        risultati['iterazioni'] = iterazioni
+        return risultati
+    
+    def _capacita(self, df, capacita, n):
+        # Vettore delle capacità da nome di colonna, valore comune o array
+        if capacita is None:
+            return np.full(n, np.inf)
+        if isinstance(capacita, str):
+            return df[capacita].to_numpy(dtype=np.float64).copy()
+        return np.broadcast_to(np.asarray(capacita, dtype=np.float64), (n,)).copy()
+    
+    def _instradamento_eccedenza(self, saturi, disponibili, servizi, params):
+        """
+        Matrici di inoltro (punto saturo × punto ricevente) dell'eccedenza, per servizio
         
-        # Normalizza i pesi per sommare a 1
-        return pesi / pesi.sum() if pesi.sum() > 0 else pesi
+        Parameters:
+        -----------
+        saturi : ndarray
+            Indici (UP e poi LIS, come le colonne di MatriceFlussi) dei punti saturi
+        disponibili : ndarray
+            Maschera booleana dei punti con capacità residua
+        servizi : list
+            Servizi per cui costruire le matrici
+        params : dict
+            Parametri della simulazione (per il bacino di ricerca)
+            
+        Returns:
+        --------
+        dict : servizio → csr_matrix quadrata con righe normalizzate a somma 1
+               (righe nulle per i punti saturi senza vicini disponibili)
+        """
+        n_up = len(self.archivio_up)
+        n_riceventi = len(disponibili)
+        forma = (n_riceventi, n_riceventi)
+        
+        # UP saturi: l'eccedenza va agli UP vicini con capacità residua, per tutti i servizi
+        up = saturi[saturi < n_up]
+        raggi_up = self.calcola_raggi_ricerca(self.densita_up[up], params) / 1000
+        gruppo, indici, distanze = self.vicini_bacino(
+            self.up_tree, self.archivio_up.lon[up], self.archivio_up.lat[up], raggi_up, params,
+            escludi=up, esclusi=~disponibili[:n_up], origini=up
+        )
+        pesi = pesi_inversi_distanza(gruppo, distanze, len(up))
+        verso_up = sparse.csr_matrix((pesi, (up[gruppo], indici)), shape=forma)
+        
+        # LIS saturi: l'eccedenza va ai LIS vicini abilitati allo stesso servizio
+        # (con il bacino 'tempo' i tempi sono quelli dell'UP più vicino al LIS)
+        lis = saturi[saturi >= n_up] - n_up
+        lon_lis, lat_lis = self.archivio_lis.lon[lis], self.archivio_lis.lat[lis]
+        raggi_lis = self.calcola_raggi_ricerca(self.calcola_densita_punti(lon_lis, lat_lis), params) / 1000
+        instradamento = {}
+        for servizio in servizi:
+            esclusi = ~disponibili[n_up:]
+            if servizio in self.archivio_lis.servizi_abilitati:
+                esclusi = esclusi | ~np.asarray(self.archivio_lis.abilitati(servizio), dtype=bool)
+            gruppo_lis, indici_lis, distanze_lis = self.vicini_bacino(
+                self.lis_tree, lon_lis, lat_lis, raggi_lis, params, escludi=lis, esclusi=esclusi
+            )
+            pesi_lis = pesi_inversi_distanza(gruppo_lis, distanze_lis, len(lis))
+            instradamento[servizio] = verso_up + sparse.csr_matrix(
+                (pesi_lis, (n_up + lis[gruppo_lis], n_up + indici_lis)), shape=forma
+            )
+        return instradamento
     
-    def simula_chiusura_up(self, id_up, personalizza_parametri=None):
+    def analisi_sensibilita(self, ids_up, n_campioni=1000, concentrazione=50.0,
+                            quantili=(0.05, 0.5, 0.95), seed=None, personalizza_parametri=None):
         """
-        Simula la chiusura di un ufficio postale e calcola la redistribuzione
+        Analisi Monte Carlo della sensibilità ai coefficienti di ridistribuzione
+        
+        Per ogni servizio campiona n_campioni insiemi di coefficienti da una Dirichlet
+        centrata sui valori dei parametri. Vicini e abilitazioni vengono calcolati
+        una sola volta per ufficio; tutti i campioni sono applicati insieme come
+        prodotti esterni volumi × coefficienti.
         
         Parameters:
         -----------
-        id_up : str o int
-            Identificativo dell'ufficio postale da chiudere
+        ids_up : list
+            Identificativi degli uffici postali da chiudere (uno per simulazione)
+        n_campioni : int, optional
+            Numero di insiemi di coefficienti campionati
+        concentrazione : float, optional
+            Concentrazione della Dirichlet: valori alti danno campioni vicini ai default
+        quantili : tuple, optional
+            Quantili da riportare nel riepilogo
+        seed : int, optional
+            Seme del generatore casuale
         personalizza_parametri : dict, optional
-            Parametri personalizzati per la simulazione
+            Parametri personalizzati usati come centro della distribuzione
             
         Returns:
         --------
-        dict : Risultati della simulazione
+        dict : Risultati dell'analisi
+            'campioni' : array (uffici × campioni) per ogni destinazione del volume
+            'riepilogo' : DataFrame con media, deviazione standard e quantili per
+                          ufficio chiuso e destinazione
+            'totali' : DataFrame (campioni × destinazioni) con i volumi complessivi
+            'coefficienti' : DataFrame dei coefficienti campionati per servizio
+            'non_trovati' : lista degli ID non presenti nel dataset
         """
-        # Aggiorna parametri se necessario
-        params = self.params.copy()
-        if personalizza_parametri:
-            # Aggiorna i parametri in modo ricorsivo
-            def update_dict(d, u):
-                for k, v in u.items():
-                    if isinstance(v, dict):
-                        d[k] = update_dict(d.get(k, {}), v)
-                    else:
-                        d[k] = v
-                return d
-            params = update_dict(params, personalizza_parametri)
-        
-        # Trova l'ufficio postale da chiudere
-        up_da_chiudere = self.gdf_up[self.gdf_up['id'] == id_up]
-        if len(up_da_chiudere) == 0:
-            return {'errore': f"Ufficio postale con ID {id_up} non trovato"}
-        
-        # Ottieni dati dell'ufficio da chiudere
-        punto_chiusura = up_da_chiudere.iloc[0].geometry
-        produzione_up = up_da_chiudere.iloc[0].to_dict()
-        
-        # Determina densità popolazione nell'area
-        # Cerca la sezione di censimento che contiene il punto
-        sezione = self.gdf_sezioni[self.gdf_sezioni.contains(punto_chiusura)]
-        if len(sezione) > 0:
-            # Calcola densità (abitanti/km²)
-            area_km2 = sezione.iloc[0].geometry.area / 1_000_000  # converti m² in km²
-            densita = sezione.iloc[0]['popolazione'] / area_km2 if area_km2 > 0 else 1000
-        else:
-            # Valore di default se non trovata
-            densita = 1000
-        
-        # Calcola raggio di ricerca in base alla densità
-        raggio_km = self.calcola_raggio_ricerca(densita) / 1000  # converti metri in km
-        
-        # Trova punti vicini
-        punti_vicini = self.trova_punti_vicini(punto_chiusura, raggio_km)
-        
-        # Calcola redistribuzione per ogni tipo di servizio
-        risultati = {
-            'up_chiuso': up_da_chiudere.iloc[0].to_dict(),
-            'raggio_km': raggio_km,
-            'densita_popolazione': densita,
-            'redistribuzione': {},
-            'totali': {'up_vicini': {}, 'lis_vicini': {}, 'competitor': {}, 'digitale': {}}
-        }
+        params = self.unisci_parametri(personalizza_parametri)
+        rng = np.random.default_rng(seed)
+        chiusure = self._prepara_chiusure(ids_up, params)
+        posizioni = chiusure['posizioni']
+        n = len(posizioni)
+        
+        # Vicini calcolati una sola volta per ufficio
+        (gruppo_up, _, _), (gruppo_lis, indici_lis, _) = self.vicini_chiusure(
+            posizioni, chiusure['lon'], chiusure['lat'], chiusure['raggi_km'], params
+        )
+        ha_up = np.bincount(gruppo_up, minlength=n) > 0
         
-        # Calcola pesi basati sulla distanza per UP e LIS
-        pesi_up = self.calcola_pesi_distanza(punti_vicini['up_vicini'], raggio_km)
-        pesi_lis = self.calcola_pesi_distanza(punti_vicini['lis_vicini'], raggio_km)
-        pesi_banche = self.calcola_pesi_distanza(punti_vicini['banche_vicine'], raggio_km)
+        destinazioni = ['up_vicini', 'lis_vicini', 'competitor', 'digitale', 'non_ricollocato']
+        campioni = {d: np.zeros((n, n_campioni)) for d in destinazioni}
+        coefficienti = {}
         
-        # Processa servizi disponibili nei LIS
-        for servizio, distribuzione in params['servizi_lis'].items():
-            if servizio not in produzione_up:
-                continue
+        for categoria in ('servizi_lis', 'servizi_up'):
+            for servizio, distribuzione in params[categoria].items():
+                if not self.archivio_up.ha_volume(servizio):
+                    continue
                 
-            volume_originale = produzione_up[servizio]
-            redistribuzione = {}
-            
-            # Redistribuzione agli uffici postali vicini
-            volume_up = volume_originale * distribuzione['up_vicini']
-            redistribuzione_up = {}
-            
-            for i, (idx, peso) in enumerate(pesi_up.items()):
-                up_id = punti_vicini['up_vicini'].iloc[i]['id']
-                volume_assegnato = volume_up * peso
-                redistribuzione_up[up_id] = volume_assegnato
+                volume = self.archivio_up.volume(servizio)[posizioni]
+                c = campiona_coefficienti(distribuzione, n_campioni, concentrazione, rng)
+                coefficienti[servizio] = pd.DataFrame(c)
                 
-            # Redistribuzione ai LIS vicini (solo se abilitati per quel servizio)
-            volume_lis = volume_originale * distribuzione['lis_vicini']
-            redistribuzione_lis = {}
-            
-            # Filtra LIS abilitati per questo servizio
-            lis_abilitati = punti_vicini['lis_vicini'][punti_vicini['lis_vicini'][f'abilitato_{servizio}'] == True]
-            
-            if len(lis_abilitati) > 0:
-                # Ricalcola pesi solo per i LIS abilitati
-                pesi_lis_abilitati = self.calcola_pesi_distanza(lis_abilitati, raggio_km)
+                # Volume destinato agli UP: quota UP più, senza LIS abilitati, la quota LIS
+                if categoria == 'servizi_lis':
+                    abilitati = self.archivio_lis.abilitati(servizio)[indici_lis]
+                    ha_lis = np.bincount(gruppo_lis, weights=abilitati, minlength=n) > 0
+                    campioni['lis_vicini'] += np.outer(volume * ha_lis, c['lis_vicini'])
+                    volume_up = np.outer(volume, c['up_vicini']) + np.outer(volume * ~ha_lis, c['lis_vicini'])
+                else:
+                    volume_up = np.outer(volume, c['up_vicini'])
                 
-                for i, (idx, peso) in enumerate(pesi_lis_abilitati.items()):
-                    lis_id = lis_abilitati.iloc[i]['id']
-                    volume_assegnato = volume_lis * peso
-                    redistribuzione_lis[lis_id] = volume_assegnato
-            else:
-                # Se non ci sono LIS abilitati, ridistribuisci agli UP
-                volume_up += volume_lis
-                # Ricalcola redistribuzione UP
-                for i, (idx, peso) in enumerate(pesi_up.items()):
-                    up_id = punti_vicini['up_vicini'].iloc[i]['id']
-                    redistribuzione_up[up_id] = volume_up * peso
-            
-            # Volume perso a favore dei competitor
-            volume_competitor = volume_originale * distribuzione['competitor']
-            
-            # Volume perso per digitalizzazione
-            volume_digitale = volume_originale * distribuzione['digitale']
-            
-            # Salva risultati per questo servizio
-            risultati['redistribuzione'][servizio] = {
-                'volume_originale': volume_originale,
-                'up_vicini': redistribuzione_up,
-                'lis_vicini': redistribuzione_lis,
-                'competitor': volume_competitor,
-                'digitale': volume_digitale
+                campioni['up_vicini'] += volume_up * ha_up[:, None]
+                campioni['non_ricollocato'] += volume_up * ~ha_up[:, None]
+                campioni['competitor'] += np.outer(volume, c['competitor'])
+                campioni['digitale'] += np.outer(volume, c['digitale'])
+        
+        riepilogo = []
+        for destinazione, valori in campioni.items():
+            statistiche = {
+                'id_up': chiusure['ids_up'],
+                'destinazione': destinazione,
+                'media': valori.mean(axis=1),
+                'dev_std': valori.std(axis=1)
             }
-            
-            # Aggiorna totali
-            risultati['totali']['up_vicini'][servizio] = sum(redistribuzione_up.values())
-            risultati['totali']['lis_vicini'][servizio] = sum(redistribuzione_lis.values())
-            risultati['totali']['competitor'][servizio] = volume_competitor
-            risultati['totali']['digitale'][servizio] = volume_digitale
+            if n_campioni > 0:
+                for q, valori_q in zip(quantili, np.quantile(valori, quantili, axis=1)):
+                    statistiche[f'p{q * 100:g}'] = valori_q
+            riepilogo.append(pd.DataFrame(statistiche))
         
-        # Processa servizi disponibili solo negli UP
-        for servizio, distribuzione in params['servizi_up'].items():
-            if servizio not in produzione_up:
-                continue
-                
-            volume_originale = produzione_up[servizio]
-            redistribuzione = {}
-            
-            # Redistribuzione agli uffici postali vicini
-            volume_up = volume_originale * distribuzione['up_vicini']
-            redistribuzione_up = {}
-            
-            for i, (idx, peso) in enumerate(pesi_up.items()):
-                up_id = punti_vicini['up_vicini'].iloc[i]['id']
-                volume_assegnato = volume_up * peso
-                redistribuzione_up[up_id] = volume_assegnato
-            
-            # Volume perso a favore dei competitor
-            volume_competitor = volume_originale * distribuzione['competitor']
-            
-            # Volume perso per digitalizzazione
-            volume_digitale = volume_originale * distribuzione['digitale']
-            
-            # Salva risultati per questo servizio
-            risultati['redistribuzione'][servizio] = {
-                'volume_originale': volume_originale,
-                'up_vicini': redistribuzione_up,
-                'competitor': volume_competitor,
-                'digitale': volume_digitale
-            }
-            
-            # Aggiorna totali
-            risultati['totali']['up_vicini'][servizio] = sum(redistribuzione_up.values())
-            risultati['totali']['competitor'][servizio] = volume_competitor
-            risultati['totali']['digitale'][servizio] = volume_digitale
+        return {
+            'campioni': campioni,
+            'riepilogo': pd.concat(riepilogo, ignore_index=True),
+            'totali': pd.DataFrame({d: v.sum(axis=0) for d, v in campioni.items()}),
+            'coefficienti': coefficienti,
+            'non_trovati': chiusure['non_trovati']
+        }
+    
+    def ottimizza_chiusure(self, k, candidati=None, personalizza_parametri=None,
+                           ricerca_locale=True, max_iterazioni=100):
+        """
+        Cerca i K uffici da chiudere che minimizzano il volume perso verso
+        competitor e digitale (più il volume non ricollocato)
         
-        return risultati
+        Parameters:
+        -----------
+        k : int
+            Numero di uffici da chiudere
+        candidati : list, optional
+            ID degli uffici che possono essere chiusi (default: tutti)
+        personalizza_parametri : dict, optional
+            Parametri personalizzati per la simulazione
+        ricerca_locale : bool, optional
+            Se True migliora la soluzione greedy con una ricerca locale a scambi
+        max_iterazioni : int, optional
+            Numero massimo di scambi della ricerca locale
+            
+        Returns:
+        --------
+        dict : 'ids_up' (uffici scelti), 'perdita' e 'scenario' con i risultati
+               di simula_scenario_chiusure per la soluzione trovata
+        """
+        ottimizzatore = OttimizzatoreChiusure(self, candidati, personalizza_parametri)
+        soluzione = ottimizzatore.greedy(k)
+        if ricerca_locale:
+            soluzione = ottimizzatore.ricerca_locale(max_iterazioni)
+        return {
+            'ids_up': soluzione,
+            'perdita': ottimizzatore.perdita,
+            'scenario': self.simula_scenario_chiusure(soluzione, personalizza_parametri)
+        }
     
     def visualizza_risultati(self, risultati, mostra_mappa=True):
         """
@@ -384,6 +3008,8 @@ class SimulazioneChiusuraUP:
         mostra_mappa : bool, optional
             Se True, visualizza anche una mappa interattiva
         """
+        from IPython.display import display, HTML
+        
         if 'errore' in risultati:
             return HTML(f"<div style='color: red; font-weight: bold;'>{risultati['errore']}</div>")
         
@@ -436,7 +3062,7 @@ class SimulazioneChiusuraUP:
         """
         
         # Aggiungi riga per ogni servizio
-        for servizio, dati in risultati['redistribuzione'].items():
+        for servizio, dati in self._redistribuzione(risultati).items():
             volume_originale = dati['volume_originale']
             
             # Calcola volumi redistribuiti
@@ -486,8 +3112,11 @@ class SimulazioneChiusuraUP:
         risultati : dict
             Risultati della simulazione
         """
+        import matplotlib.pyplot as plt
+        
         # Prepara dati per i grafici
-        servizi = list(risultati['redistribuzione'].keys())
+        redistribuzione = self._redistribuzione(risultati)
+        servizi = list(redistribuzione.keys())
         n_servizi = len(servizi)
         
         # Crea subplots
@@ -496,7 +3125,7 @@ class SimulazioneChiusuraUP:
             axs = [axs]
         
         for i, servizio in enumerate(servizi):
-            dati = risultati['redistribuzione'][servizio]
+            dati = redistribuzione[servizio]
             volume_originale = dati['volume_originale']
             
             # Ottieni volumi redistribuiti
@@ -544,7 +3173,7 @@ class SimulazioneChiusuraUP:
         plt.tight_layout()
         plt.show()
     
-    def visualizza_mappa_redistribuzione(self, risultati):
+    def visualizza_mappa_redistribuzione(self, risultati, modalita='marker'):
         """
         Visualizza una mappa interattiva della redistribuzione
         
@@ -552,11 +3181,38 @@ class SimulazioneChiusuraUP:
         -----------
         risultati : dict
             Risultati della simulazione
+        modalita : str, optional
+            'marker' (default) per un marker con popup HTML per ogni punto ricevente,
+            'geojson' per livelli GeoJSON e FastMarkerCluster costruiti da array,
+            molto più leggeri quando i punti riceventi sono numerosi
         """
+        import folium
+        from folium.plugins import MarkerCluster
+        
         # Estrai le coordinate dell'ufficio chiuso
         up_chiuso = risultati['up_chiuso']
         coord_chiuso = (up_chiuso['latitude'], up_chiuso['longitude'])
         
+        if modalita == 'geojson':
+            flussi = risultati['flussi'] if 'flussi' in risultati else self._flussi_da_redistribuzione(
+                up_chiuso['id'], risultati['redistribuzione']
+            )
+            mappa = folium.Map(location=coord_chiuso, zoom_start=14)
+            folium.Circle(
+                location=coord_chiuso,
+                radius=risultati['raggio_km'] * 1000,  # converti in metri
+                color='red',
+                fill=True,
+                fill_opacity=0.1,
+                popup='Area di influenza'
+            ).add_to(mappa)
+            return self._mappa_geojson(
+                mappa, np.atleast_1d(up_chiuso['longitude']), np.atleast_1d(up_chiuso['latitude']),
+                np.atleast_1d(risultati['raggio_km']), pd.DataFrame({'id_up': [up_chiuso['id']]}), flussi
+            )
+        if modalita != 'marker':
+            raise ValueError(f"Modalità di visualizzazione non valida: {modalita}")
+        
         # Crea mappa centrata sull'ufficio chiuso
         mappa = folium.Map(location=coord_chiuso, zoom_start=14)
         
@@ -579,7 +3235,7 @@ class SimulazioneChiusuraUP:
         
         # Aggiungi marker per gli uffici postali vicini che ricevono redistribuzione
         up_riceventi = {}
-        for servizio, dati in risultati['redistribuzione'].items():
+        for servizio, dati in self._redistribuzione(risultati).items():
             if 'up_vicini' not in dati:
                 continue
                 
@@ -593,11 +3249,11 @@ class SimulazioneChiusuraUP:
         # Aggiungi marker per UP riceventi
         for up_id, dati in up_riceventi.items():
             # Trova l'UP nel dataframe originale
-            up_info = self.df_up[self.df_up['id'] == up_id]
-            if len(up_info) == 0:
+            posizione = self.archivio_up.posizione(up_id)
+            if posizione < 0:
                 continue
                 
-            up_row = up_info.iloc[0]
+            up_row = self.df_up.iloc[posizione]
             
             # Crea popup con informazioni dettagliate
             popup_html = f"""
@@ -633,7 +3289,7 @@ class SimulazioneChiusuraUP:
         
         # Aggiungi marker per i LIS vicini che ricevono redistribuzione
         lis_riceventi = {}
-        for servizio, dati in risultati['redistribuzione'].items():
+        for servizio, dati in self._redistribuzione(risultati).items():
             if 'lis_vicini' not in dati:
                 continue
                 
@@ -647,11 +3303,11 @@ class SimulazioneChiusuraUP:
         # Aggiungi marker per LIS riceventi
         for lis_id, dati in lis_riceventi.items():
             # Trova il LIS nel dataframe originale
-            lis_info = self.df_lis[self.df_lis['id'] == lis_id]
-            if len(lis_info) == 0:
+            posizione = self.archivio_lis.posizione(lis_id)
+            if posizione < 0:
                 continue
                 
-            lis_row = lis_info.iloc[0]
+            lis_row = self.df_lis.iloc[posizione]
             
             # Crea popup con informazioni dettagliate
             popup_html = f"""
@@ -689,9 +3345,8 @@ class SimulazioneChiusuraUP:
         marker_cluster = MarkerCluster().add_to(mappa)
         
         # Cerca banche nel raggio di influenza
-        punto_chiuso = Point(up_chiuso['longitude'], up_chiuso['latitude'])
-        banche_nel_raggio = self.gdf_banche[self.gdf_banche.geometry.apply(
-            lambda p: p.distance(punto_chiuso) * 111 <= risultati['raggio_km']
+        banche_nel_raggio = self.df_banche.iloc[self._banche_nel_raggio(
+            up_chiuso['longitude'], up_chiuso['latitude'], risultati['raggio_km']
         )]
         
         for idx, banca in banche_nel_raggio.iterrows():
@@ -716,24 +3371,233 @@ class SimulazioneChiusuraUP:
         # Mostra la mappa
         return mappa
     
-    def crea_interfaccia_simulazione(self):
+    def visualizza_mappa_scenario(self, risultati, mostra_banche=True):
+        """
+        Visualizza su una mappa i risultati colonnari di più chiusure
+        
+        Uffici chiusi, punti riceventi e banche sono aggiunti come pochi livelli
+        GeoJSON e FastMarkerCluster costruiti direttamente dagli array, per cui
+        la dimensione del file HTML cresce in modo lineare e contenuto con il
+        numero di punti.
+        
+        Parameters:
+        -----------
+        risultati : dict
+            Risultati di simula_scenario_chiusure o simula_chiusure_batch
+            (flussi come DataFrame o MatriceFlussi)
+        mostra_banche : bool, optional
+            Se True, mostra le banche entro il raggio di ricerca degli uffici chiusi
+            
+        Returns:
+        --------
+        folium.Map
+        """
+        import folium
+        
+        uffici = risultati['uffici']
+        posizioni = self.archivio_up.posizioni(uffici['id_up'])
+        lon = self.archivio_up.lon[posizioni]
+        lat = self.archivio_up.lat[posizioni]
+        
+        if len(posizioni) > 0:
+            mappa = folium.Map(location=(float(np.mean(lat)), float(np.mean(lon))), zoom_start=11)
+            mappa.fit_bounds([[float(lat.min()), float(lon.min())], [float(lat.max()), float(lon.max())]])
+        else:
+            # Nessun ufficio chiuso: mappa centrata sull'insieme degli UP
+            mappa = folium.Map(location=(float(np.mean(self.archivio_up.lat)), float(np.mean(self.archivio_up.lon))),
+                               zoom_start=6)
+        raggi_km = uffici['raggio_km'].to_numpy() if mostra_banche else np.zeros(0)
+        return self._mappa_geojson(mappa, lon, lat, raggi_km, uffici, risultati['flussi'])
+    
+    def _banche_nel_raggio(self, lon, lat, raggi_km):
+        # Posizioni (uniche) delle banche entro il raggio di almeno un punto
+        _, indici, _ = self.cerca_vicini(self.banche_tree, lon, lat, raggi_km)
+        return np.unique(indici)
+    
+    def _flussi_da_redistribuzione(self, id_up, redistribuzione):
+        # Converte la redistribuzione annidata di un ufficio nel formato lungo dei flussi
+        righe = [
+            (id_up, servizio, tipo, id_ricevente, volume)
+            for servizio, dettaglio in redistribuzione.items()
+            for tipo in ('up_vicini', 'lis_vicini')
+            for id_ricevente, volume in dettaglio.get(tipo, {}).items()
+        ]
+        return pd.DataFrame(righe, columns=['id_up', 'servizio', 'tipo', 'id_ricevente', 'volume'])
+    
+    def _nomi(self, df, posizioni, prefisso):
+        ids = df['id'].to_numpy()[posizioni]
+        if 'nome' in df.columns:
+            return df['nome'].to_numpy()[posizioni].astype(str)
+        return np.array([f'{prefisso} {i}' for i in ids])
+    
+    def _mappa_geojson(self, mappa, lon, lat, raggi_km, uffici, flussi):
+        """
+        Aggiunge alla mappa i livelli GeoJSON di uffici chiusi e punti riceventi
+        e il cluster delle banche nel raggio
+        
+        Parameters:
+        -----------
+        mappa : folium.Map
+            Mappa di destinazione
+        lon, lat : ndarray
+            Coordinate degli uffici chiusi
+        raggi_km : ndarray
+            Raggi di ricerca per la selezione delle banche (vuoto per non mostrarle)
+        uffici : DataFrame
+            Uffici chiusi, con colonna 'id_up'
+        flussi : DataFrame o MatriceFlussi
+            Flussi di ridistribuzione
+            
+        Returns:
+        --------
+        folium.Map
+        """
+        import folium
+        from folium.plugins import FastMarkerCluster
+        
+        def punti_geojson(lon, lat, proprieta):
+            proprieta = proprieta.round(2)
+            return {
+                'type': 'FeatureCollection',
+                'features': [
+                    {'type': 'Feature',
+                     'geometry': {'type': 'Point', 'coordinates': [x, y]},
+                     'properties': p}
+                    for x, y, p in zip(lon.tolist(), lat.tolist(), proprieta.to_dict('records'))
+                ]
+            }
+        
+        def livello(nome, dati, colore, campi):
+            # GeoJsonTooltip e GeoJsonPopup richiedono almeno un punto con i campi indicati
+            if not dati['features']:
+                return
+            folium.GeoJson(
+                dati,
+                name=nome,
+                marker=folium.CircleMarker(radius=6, color=colore, fill=True, fill_color=colore, fill_opacity=0.7),
+                tooltip=folium.GeoJsonTooltip(fields=['nome', campi[0]] if campi else ['nome']),
+                popup=folium.GeoJsonPopup(fields=['nome'] + campi)
+            ).add_to(mappa)
+        
+        posizioni_chiusi = self.archivio_up.posizioni(uffici['id_up'])
+        livello('UP chiusi', punti_geojson(lon, lat, pd.DataFrame({
+            'nome': self._nomi(self.df_up, posizioni_chiusi, 'UP')
+        })), 'red', [])
+        
+        # Volume ricevuto da ogni punto, per servizio
+        if isinstance(flussi, MatriceFlussi):
+            carico = flussi.carico_riceventi()
+            carico['tipo'] = carico['tipo'].astype(str)
+        else:
+            carico = flussi.pivot_table(index=['tipo', 'id_ricevente'], columns='servizio', values='volume',
+                                        aggfunc='sum', fill_value=0.0, observed=True).reset_index()
+            carico.columns = [str(c) for c in carico.columns]
+            carico['tipo'] = carico['tipo'].astype(str)
+        servizi = [c for c in carico.columns if c not in ('tipo', 'id_ricevente')]
+        carico.insert(2, 'totale', carico[servizi].sum(axis=1))
+        
+        for tipo, archivio, df, prefisso, colore in (('up_vicini', self.archivio_up, self.df_up, 'UP', 'green'),
+                                                     ('lis_vicini', self.archivio_lis, self.df_lis, 'LIS', 'blue')):
+            riceventi = carico[carico['tipo'] == tipo]
+            posizioni = archivio.posizioni(riceventi['id_ricevente'])
+            trovati = posizioni >= 0
+            riceventi, posizioni = riceventi[trovati], posizioni[trovati]
+            proprieta = riceventi[['totale'] + servizi].reset_index(drop=True)
+            proprieta.insert(0, 'nome', self._nomi(df, posizioni, prefisso))
+            livello(f'{prefisso} riceventi', punti_geojson(archivio.lon[posizioni], archivio.lat[posizioni], proprieta),
+                    colore, ['totale'] + servizi)
+        
+        # Banche competitor nel raggio degli uffici chiusi, selezionate con il BallTree
+        if len(raggi_km) > 0:
+            banche = self._banche_nel_raggio(lon, lat, raggi_km)
+            nomi = self.df_banche['nome'].to_numpy()[banche] if 'nome' in self.df_banche.columns else np.full(len(banche), 'N/D')
+            gruppi = self.df_banche['gruppo'].to_numpy()[banche] if 'gruppo' in self.df_banche.columns else np.full(len(banche), 'N/D')
+            dati = [[y, x, f"Banca: {n}<br>Gruppo: {g}"] for y, x, n, g in zip(
+                self.archivio_banche.lat[banche].tolist(), self.archivio_banche.lon[banche].tolist(), nomi, gruppi
+            )]
+            FastMarkerCluster(
+                dati,
+                name='Banche competitor',
+                callback="""
+                function (row) {
+                    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 5, color: 'purple'});
+                    marker.bindPopup(row[2]);
+                    return marker;
+                }
+                """
+            ).add_to(mappa)
+        
+        legenda_html = """
+        <div style="position: fixed; bottom: 50px; left: 50px; z-index: 1000; background-color: white; padding: 10px; border: 2px solid grey; border-radius: 5px;">
+            <p><span style="color:red">⬤</span> UP Chiusi</p>
+            <p><span style="color:green">⬤</span> UP Riceventi</p>
+            <p><span style="color:blue">⬤</span> LIS Riceventi</p>
+            <p><span style="color:purple">⬤</span> Banche competitor</p>
+        </div>
+        """
+        mappa.get_root().html.add_child(folium.Element(legenda_html))
+        folium.LayerControl().add_to(mappa)
+        return mappa
+    
+    def crea_interfaccia_simulazione(self, ritardo_aggiornamento=0.4):
         """
         Crea un'interfaccia interattiva per la simulazione
         
+        Parameters:
+        -----------
+        ritardo_aggiornamento : float, optional
+            Secondi di inattività degli slider dopo i quali, con l'aggiornamento
+            automatico attivo, la simulazione viene rieseguita
+        
         Returns:
         --------
         widget : ipywidgets.Widget
             Widget interattivo per la simulazione
         """
-        # Crea dropdown per la selezione dell'ufficio postale
-        options_up = [(f"{row['id']} - {row.get('nome', 'N/D')}", row['id']) for _, row in self.df_up.iterrows()]
+        import ipywidgets as widgets
+        
+        # Selezione dell'ufficio postale: casella di ricerca e dropdown con le sole
+        # corrispondenze, calcolate sull'elenco completo solo alla prima ricerca
+        max_opzioni = 50
+        etichette = {}
+        
+        def crea_etichette(df):
+            nomi = df['nome'].astype(str) if 'nome' in df.columns else 'N/D'
+            return (df['id'].astype(str) + ' - ' + nomi).reset_index(drop=True)
+        
+        def opzioni_up(testo):
+            if testo:
+                if 'serie' not in etichette:
+                    etichette['serie'] = crea_etichette(self.df_up)
+                serie = etichette['serie']
+                serie = serie[serie.str.contains(testo, case=False, regex=False)]
+            else:
+                serie = crea_etichette(self.df_up.iloc[:max_opzioni])
+            serie = serie.iloc[:max_opzioni]
+            return list(zip(serie.tolist(), self.df_up['id'].to_numpy()[serie.index].tolist()))
+        
+        ricerca_up = widgets.Text(
+            placeholder='Cerca per ID o nome',
+            description='Cerca UP:',
+            style={'description_width': 'initial'},
+            layout=widgets.Layout(width='50%')
+        )
         dropdown_up = widgets.Dropdown(
-            options=options_up,
+            options=[],
             description='Ufficio Postale:',
             style={'description_width': 'initial'},
             layout=widgets.Layout(width='50%')
         )
         
+        def aggiorna_opzioni(change=None):
+            opzioni = opzioni_up(ricerca_up.value.strip())
+            dropdown_up.options = opzioni
+            if opzioni and dropdown_up.value is None:
+                dropdown_up.value = opzioni[0][1]
+        
+        ricerca_up.observe(aggiorna_opzioni, names='value')
+        aggiorna_opzioni()
+        
         # Slider per i parametri di redistribuzione
         sliders_servizi_lis = {}
         for servizio in ['bollettini', 'bollette', 'pagoPA', 'ricariche_postepay', 'ricariche_telefoniche', 'pacchi']:
@@ -817,6 +3681,16 @@ class SimulazioneChiusuraUP:
             layout=widgets.Layout(width='auto')
         )
         
+        # Checkbox per rieseguire la simulazione quando cambiano i parametri
+        checkbox_automatico = widgets.Checkbox(
+            value=False,
+            description='Aggiorna automaticamente',
+            layout=widgets.Layout(width='auto')
+        )
+        
+        # Stato dell'esecuzione in background
+        stato = widgets.HTML(value='')
+        
         # Output widget per mostrare i risultati
         output = widgets.Output()
         
@@ -856,4 +3730,94 @@ class SimulazioneChiusuraUP:
         tabs_principale = widgets.Tab()
         tabs_principale.children = [tabs_lis, tabs_up]
         tabs_principale.set_title(0, 'Servizi LIS')
-        tabs_principale.set_title(1, '
\ No newline at end of file
+        tabs_principale.set_title(1, 'Servizi UP')
+        
+        def raccogli_parametri():
+            # Raccogli i parametri dagli slider
+            personalizza_parametri = {
+                'raggio_base': slider_raggio.value,
+                'servizi_lis': {},
+                'servizi_up': {}
+            }
+            for servizio, sliders in sliders_servizi_lis.items():
+                personalizza_parametri['servizi_lis'][servizio] = {
+                    'up_vicini': sliders['up'].value,
+                    'lis_vicini': sliders['lis'].value,
+                    'competitor': sliders['competitor'].value,
+                    'digitale': sliders['digitale'].value
+                }
+            for servizio, sliders in sliders_servizi_up.items():
+                personalizza_parametri['servizi_up'][servizio] = {
+                    'up_vicini': sliders['up'].value,
+                    'competitor': sliders['competitor'].value,
+                    'digitale': sliders['digitale'].value
+                }
+            
+            return personalizza_parametri
+        
+        # Solo simula_chiusura_up gira su un thread dedicato, per non bloccare il kernel;
+        # i risultati vengono mostrati dal loop del kernel, l'unico thread da cui
+        # l'Output widget cattura correttamente l'output e pyplot può disegnare.
+        # Ogni richiesta incrementa il numero di esecuzione: quelle ancora in coda
+        # vengono annullate, mentre una simulazione già avviata non può essere
+        # interrotta e il suo risultato, se superato nel frattempo, viene scartato.
+        loop = asyncio.get_event_loop()
+        esecutore = ThreadPoolExecutor(max_workers=1)
+        esecuzione = {'numero': 0, 'futuro': None, 'timer': None}
+        
+        def simula_in_background(numero, id_up, personalizza_parametri):
+            if numero != esecuzione['numero']:
+                return None
+            return self.simula_chiusura_up(id_up, personalizza_parametri)
+        
+        def mostra_risultati(numero, mostra_mappa, futuro):
+            if futuro.cancelled() or numero != esecuzione['numero']:
+                return
+            if futuro.exception() is not None:
+                stato.value = f"<i>Errore nella simulazione: {futuro.exception()}</i>"
+                return
+            output.clear_output(wait=True)
+            with output:
+                self.visualizza_risultati(futuro.result(), mostra_mappa=mostra_mappa)
+            stato.value = ''
+        
+        def esegui_simulazione(b=None):
+            if dropdown_up.value is None:
+                stato.value = "<i>Seleziona un ufficio postale</i>"
+                return
+            esecuzione['numero'] += 1
+            if esecuzione['futuro'] is not None:
+                esecuzione['futuro'].cancel()
+            stato.value = "<i>Simulazione in corso...</i>"
+            futuro = loop.run_in_executor(
+                esecutore, simula_in_background, esecuzione['numero'], dropdown_up.value,
+                raccogli_parametri()
+            )
+            futuro.add_done_callback(partial(mostra_risultati, esecuzione['numero'], checkbox_mappa.value))
+            esecuzione['futuro'] = futuro
+        
+        def parametri_modificati(change):
+            # Debounce: la simulazione parte solo dopo una pausa nei movimenti degli slider
+            if not checkbox_automatico.value:
+                return
+            if esecuzione['timer'] is not None:
+                esecuzione['timer'].cancel()
+            esecuzione['timer'] = loop.call_later(ritardo_aggiornamento, esegui_simulazione)
+        
+        button_simula.on_click(esegui_simulazione)
+        for widget in [slider_raggio, dropdown_up] + [
+            slider for gruppo in (sliders_servizi_lis, sliders_servizi_up) for sliders in gruppo.values()
+            for slider in sliders.values()
+        ]:
+            widget.observe(parametri_modificati, names='value')
+        
+        # Composizione dell'interfaccia
+        return widgets.VBox([
+            ricerca_up,
+            dropdown_up,
+            slider_raggio,
+            tabs_principale,
+            widgets.HBox([checkbox_mappa, checkbox_automatico, button_simula]),
+            stato,
+            output
+        ])
@@ -1,35 +1,353 @@
+import os
+import json
 import time
+import hashlib
+import asyncio
+import inspect
+import sqlite3
+import threading
+from collections import deque
 import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
 from shapely.geometry import Point
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
+from geopy.adapters import BaseAsyncAdapter
+from geopy.exc import GeocoderTimedOut, GeocoderRateLimited, GeocoderServiceError
 
 
-def geocode_address(geolocator, address, retries=3):
-    """Geocode an address using Nominatim API with retries."""
+DEFAULT_CACHE_PATH = "geocode_cache.sqlite"
+DEFAULT_TTL = 90 * 24 * 3600  # Positive results are kept for 90 days
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 3600  # Misses are retried after a week
+
+# Italian street-type abbreviations expanded by normalize_addresses
+# (applied in order, longer forms first)
+ADDRESS_ABBREVIATIONS = [
+    (r"\bV\.?\s?LE\b\.?", "VIALE"),
+    (r"\bP\.?\s?ZZA\b\.?|\bP\.?\s?ZA\b\.?", "PIAZZA"),
+    (r"\bP\.?\s?LE\b\.?", "PIAZZALE"),
+    (r"\bC\.?\s?SO\b\.?", "CORSO"),
+    (r"\bL\.?\s?GO\b\.?", "LARGO"),
+    (r"\bV\.?\s?LO\b\.?", "VICOLO"),
+    (r"\bLUNGOM\b\.?", "LUNGOMARE"),
+    # LOC and FRAZ only at the start of an address part, not inside street names
+    (r"(?:^|(?<=, ))LOC\b\.?", "LOCALITA"),
+    (r"(?:^|(?<=, ))FRAZ\b\.?", "FRAZIONE"),
+    (r"^V\.\s?|(?<=, )V\.\s?", "VIA "),
+]
+
+# Requests per second allowed by the usage policy of public endpoints;
+# any other domain (self-hosted Nominatim/Photon) is not rate limited
+PUBLIC_RATE_LIMITS = {
+    "nominatim.openstreetmap.org": 1.0,
+    "photon.komoot.io": 1.0,
+}
+
+
+def normalize_address(address):
+    """Return the canonical key of a single address (see normalize_addresses), used for cache lookups."""
+    return normalize_addresses([address]).iloc[0]
+
+
+def provider_name(geolocator):
+    """Return the cache key of a geopy geolocator, e.g. 'nominatim:nominatim.openstreetmap.org'."""
+    return f"{type(geolocator).__name__.lower()}:{getattr(geolocator, 'domain', '')}"
+
+
+class GeocodeCache:
+    """Persistent SQLite cache of geocoding results keyed by normalized address and provider.
+
+    Misses are cached too (negative caching) with a shorter TTL, so addresses
+    that no provider can resolve are not queried again on every run; the
+    geocoding functions take retry_misses=True to query them again anyway.
+    The cache can be shared across notebooks and processes through the same file.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS geocode (
+                   provider TEXT NOT NULL,
+                   address TEXT NOT NULL,
+                   lat REAL,
+                   lon REAL,
+                   created REAL NOT NULL,
+                   PRIMARY KEY (provider, address)
+               )"""
+        )
+        self._conn.commit()
+
+    def get(self, address, provider, negative=True):
+        """Return (found, (lat, lon)); found is False on a miss or an expired entry.
+
+        With negative=False a cached "not found" entry is reported as a miss too.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT lat, lon, created FROM geocode WHERE provider = ? AND address = ?",
+                (provider, normalize_address(address)),
+            ).fetchone()
+            if row is not None and (negative or row[0] is not None):
+                lat, lon, created = row
+                ttl = self.ttl if lat is not None else self.negative_ttl
+                if ttl is None or time.time() - created < ttl:
+                    self.hits += 1
+                    return True, (lat, lon)
+            self.misses += 1
+            return False, (None, None)
+
+    def set(self, address, provider, lat, lon):
+        """Store a result; lat/lon None records a negative (not found) entry."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocode (provider, address, lat, lon, created) VALUES (?, ?, ?, ?, ?)",
+                (provider, normalize_address(address), lat, lon, time.time()),
+            )
+            self._conn.commit()
+
+    def purge_expired(self):
+        """Delete expired entries and return how many were removed."""
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for condition, ttl in (("lat IS NOT NULL", self.ttl), ("lat IS NULL", self.negative_ttl)):
+                if ttl is not None:
+                    cursor = self._conn.execute(f"DELETE FROM geocode WHERE {condition} AND created < ?", (now - ttl,))
+                    removed += cursor.rowcount
+            self._conn.commit()
+        return removed
+
+    def clear(self):
+        """Remove every entry and reset the statistics."""
+        with self._lock:
+            self._conn.execute("DELETE FROM geocode")
+            self._conn.commit()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return hit/miss counters and the number of stored entries."""
+        with self._lock:
+            entries, negative = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(lat IS NULL), 0) FROM geocode"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "negative_entries": negative,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _query(geolocator, address, retries):
+    """Query the geolocator; return (completed, (lat, lon)).
+
+    completed is False when every attempt timed out, so the miss is not cached.
+    """
     for _ in range(retries):
         try:
             location = geolocator.geocode(address, timeout=10)
             if location:
-                return location.latitude, location.longitude
+                return True, (location.latitude, location.longitude)
+            return True, (None, None)
         except GeocoderTimedOut:
             time.sleep(2)  # Wait before retrying
-    return None, None
+    return False, (None, None)
+
+
+def geocode_address(geolocator, address, retries=3, cache=None, retry_misses=False):
+    """Geocode an address using Nominatim API with retries, through an optional GeocodeCache.
+
+    A cached "not found" answer is returned as is unless retry_misses is True,
+    in which case the address is queried again and the cache entry refreshed.
+    """
+    if cache is not None:
+        found, coords = cache.get(address, provider_name(geolocator), negative=not retry_misses)
+        if found:
+            return coords
+    completed, coords = _query(geolocator, address, retries)
+    if cache is not None and completed:
+        cache.set(address, provider_name(geolocator), *coords)
+    return coords
 
 
-def geocode_addresses(addresses):
-    """Geocode a list of addresses and return a GeoDataFrame."""
-    geolocator = Nominatim(user_agent="geo_app1")
+def geocode_addresses(addresses, cache=None, geolocator=None, min_delay=1.0, verbose=False,
+                      retry_misses=False):
+    """Geocode a list of addresses and return a GeoDataFrame.
 
+    With a GeocodeCache (or a path to the SQLite file) cached addresses are
+    answered locally and only the remaining ones are sent to the geolocator,
+    waiting min_delay seconds between remote calls. retry_misses sends cached
+    misses to the geolocator again. verbose prints the result of every remote call.
+    """
+    geolocator = geolocator or Nominatim(user_agent="geo_app1")
+    own_cache = isinstance(cache, str)
+    if own_cache:
+        cache = GeocodeCache(cache)
+    try:
+        results = _geocode_results(addresses, geolocator, cache, min_delay, verbose=verbose,
+                                   retry_misses=retry_misses)
+    finally:
+        if own_cache:
+            cache.close()
+
+    return _to_geodataframe(results)
+
+
+def _geocode_results(addresses, geolocator, cache=None, min_delay=1.0, failed=None, verbose=False,
+                     retry_misses=False):
+    """Geocode addresses sequentially and return a list of (address, lat, lon).
+
+    If failed is a list, the positions of the addresses whose query timed out
+    (as opposed to a real miss) are appended to it.
+    """
+    provider = provider_name(geolocator)
     results = []
-    for address in addresses:
-        lat, lon = geocode_address(geolocator, address)
-        print(f"{address}: {lat}, {lon}")
+    last_call = None
+    for position, address in enumerate(addresses):
+        found, (lat, lon) = (
+            cache.get(address, provider, negative=not retry_misses) if cache is not None else (False, (None, None))
+        )
+        if not found:
+            if last_call is not None:
+                time.sleep(max(0.0, min_delay - (time.monotonic() - last_call)))  # Respect Nominatim's rate limits
+            last_call = time.monotonic()
+            completed, (lat, lon) = _query(geolocator, address, retries=3)
+            if cache is not None and completed:
+                cache.set(address, provider, lat, lon)
+            if not completed and failed is not None:
+                failed.append(position)
+            if verbose:
+                print(f"{address}: {lat}, {lon}")
         results.append((address, lat, lon))
-        time.sleep(1)  # Respect Nominatim's rate limits
+    return results
+
+
+def _read_checkpoint(path):
+    """Yield the JSON records of a checkpoint file, skipping a truncated last line."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                return  # Interrupted while writing the last chunk
+
+
+def read_checkpoint(path):
+    """Stream a checkpoint back into a GeoDataFrame, one chunk at a time.
+
+    When a chunk was saved more than once (retried failures), its last record wins.
+    """
+    frames = {}
+    for record in _read_checkpoint(path):
+        if "chunk" in record:
+            frames[record["chunk"]] = pd.DataFrame(record["results"], columns=["Address", "Latitude", "Longitude"])
+    frames = [frames[chunk] for chunk in sorted(frames)]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["Address", "Latitude", "Longitude"])
+    df = df.dropna().reset_index(drop=True)
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df["Longitude"], df["Latitude"]), crs="EPSG:4326")
+
+
+def geocode_addresses_resumable(addresses, checkpoint_path, chunk_size=500, cache=None, geolocator=None,
+                                min_delay=1.0, geocode_chunk=None, verbose=False, retry_misses=False):
+    """Geocode addresses in chunks, appending each finished chunk to a checkpoint file.
+
+    Rerunning with the same addresses and checkpoint_path resumes after the
+    last completed chunk, so a crash or kernel restart only loses the chunk
+    in progress. The checkpoint is a JSON lines file: a header identifying the
+    job, then one line per chunk with its results and the positions of the
+    addresses that failed with a timeout. Real misses are final, while failed
+    addresses are queried again on resume and the chunk is saved again.
+    geocode_chunk(list_of_addresses) can replace the sequential geocoder
+    (e.g. to run geocode_addresses_async per chunk); it must return
+    (address, lat, lon) tuples, or (address, lat, lon, completed) to report
+    failures. verbose prints every remote call besides the per-chunk
+    messages; retry_misses queries cached misses again (as in
+    geocode_addresses). Returns the final GeoDataFrame.
+    """
+    addresses = list(addresses)
+    job = hashlib.sha256("\n".join(map(str, addresses)).encode("utf-8")).hexdigest()
+    header = {"job": job, "addresses": len(addresses), "chunk_size": chunk_size}
+
+    saved = {}
+    if os.path.exists(checkpoint_path):
+        records = _read_checkpoint(checkpoint_path)
+        existing = next(records, None)
+        if existing is not None:
+            if existing != header:
+                raise ValueError(f"Checkpoint {checkpoint_path} belongs to a different job: {existing}")
+            saved = {record["chunk"]: record for record in records}
+        # Drop a partially written last line before appending
+        with open(checkpoint_path, "rb+") as f:
+            content = f.read()
+            f.truncate(content.rfind(b"\n") + 1)
+        if existing is None:
+            os.remove(checkpoint_path)
 
+    geolocator = geolocator or Nominatim(user_agent="geo_app1")
+    own_cache = isinstance(cache, str)
+    if own_cache:
+        cache = GeocodeCache(cache)
+
+    def run(chunk):
+        # Return the (address, lat, lon) results and the positions of failed addresses
+        if geocode_chunk is None:
+            failed = []
+            return _geocode_results(chunk, geolocator, cache, min_delay, failed, verbose, retry_misses), failed
+        results = [tuple(r) for r in geocode_chunk(chunk)]
+        failed = [position for position, r in enumerate(results) if len(r) > 3 and not r[3]]
+        return [r[:3] for r in results], failed
+
+    n_chunks = -(-len(addresses) // chunk_size)
+    try:
+        with open(checkpoint_path, "a", encoding="utf-8") as f:
+            if f.tell() == 0:
+                f.write(json.dumps(header) + "\n")
+            for i in range(n_chunks):
+                chunk = addresses[i * chunk_size:(i + 1) * chunk_size]
+                record = saved.get(i)
+                if record is None:
+                    results, failed = run(chunk)
+                elif record.get("failed"):
+                    # Retry only the addresses that failed in the previous run
+                    results = [tuple(r) for r in record["results"]]
+                    retried, still_failed = run([chunk[position] for position in record["failed"]])
+                    for position, result in zip(record["failed"], retried):
+                        results[position] = result
+                    failed = [record["failed"][j] for j in still_failed]
+                else:
+                    continue
+                f.write(json.dumps({"chunk": i, "results": [list(r) for r in results], "failed": failed}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                print(f"Chunk {i + 1}/{n_chunks} saved" + (f" ({len(failed)} failed, retried on resume)" if failed else ""))
+    finally:
+        if own_cache:
+            cache.close()
+
+    return read_checkpoint(checkpoint_path)
+
+
+def _to_geodataframe(results):
+    """Build a GeoDataFrame from (address, lat, lon) tuples, dropping misses."""
     df = pd.DataFrame(results, columns=["Address", "Latitude", "Longitude"])
     df = df.dropna()
     df["geometry"] = df.apply(lambda row: Point(row["Longitude"], row["Latitude"]), axis=1)
@@ -37,6 +355,347 @@ def geocode_addresses(addresses):
     return gdf
 
 
+class TokenBucket:
+    """Asyncio token bucket allowing `rate` requests per second with bursts up to `burst`.
+
+    rate=None disables the limit. Share one bucket between tasks (or batches)
+    that hit the same provider.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = None
+
+    async def acquire(self):
+        if self.rate is None:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def rate_limit_for(geolocator):
+    """Return the requests per second allowed for the geolocator's domain (None = unlimited)."""
+    return PUBLIC_RATE_LIMITS.get(getattr(geolocator, "domain", None))
+
+
+def async_geolocator(geocoder=Nominatim, user_agent="geo_app1", **kwargs):
+    """Create a geopy geolocator running on aiohttp.
+
+    The adapter keeps a single aiohttp session, so all requests of a batch
+    reuse pooled keep-alive connections. Pass domain/scheme to target a
+    self-hosted instance, e.g. async_geolocator(Photon, domain="localhost:2322", scheme="http").
+    """
+    from geopy.adapters import AioHTTPAdapter  # requires aiohttp
+
+    return geocoder(user_agent=user_agent, adapter_factory=AioHTTPAdapter, **kwargs)
+
+
+async def _query_async(geolocator, address, retries, limiter, timeout=None):
+    """Async counterpart of _query, taking a token from the limiter before each request.
+
+    timeout=None leaves the geolocator's own timeout (e.g. MultiGeocoder.timeout).
+    """
+    options = {} if timeout is None else {"timeout": timeout}
+    for attempt in range(retries):
+        await limiter.acquire()
+        try:
+            location = await geolocator.geocode(address, **options)
+            if location:
+                return True, (location.latitude, location.longitude)
+            return True, (None, None)
+        except GeocoderRateLimited as e:
+            wait = e.retry_after or 2
+        except GeocoderTimedOut:
+            wait = 2
+        if attempt < retries - 1:
+            await asyncio.sleep(wait)  # Wait before retrying
+    return False, (None, None)
+
+
+async def geocode_addresses_async(addresses, geolocator=None, concurrency=8, rate=None, cache=None,
+                                  retries=3, limiter=None, timeout=None, retry_misses=False):
+    """Geocode a list of addresses concurrently and return a GeoDataFrame.
+
+    geolocator must be an async geolocator (see async_geolocator). At most
+    `concurrency` requests are in flight; the request rate defaults to the
+    policy limit of public endpoints and is unlimited for other domains.
+    timeout overrides the per-request timeout configured on the geolocator;
+    retry_misses queries cached misses again. In a notebook: gdf = await geocode_addresses_async(addresses, geolocator).
+    """
+    own_geolocator = geolocator is None
+    if own_geolocator:
+        geolocator = async_geolocator()
+    if limiter is None:
+        limiter = TokenBucket(rate if rate is not None else rate_limit_for(geolocator))
+    own_cache = isinstance(cache, str)
+    if own_cache:
+        cache = GeocodeCache(cache)
+    provider = provider_name(geolocator)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def geocode(address):
+        if cache is not None:
+            found, coords = cache.get(address, provider, negative=not retry_misses)
+            if found:
+                return address, *coords
+        async with semaphore:
+            completed, coords = await _query_async(geolocator, address, retries, limiter, timeout)
+        if cache is not None and completed:
+            cache.set(address, provider, *coords)
+        return address, *coords
+
+    try:
+        results = await asyncio.gather(*(geocode(address) for address in addresses))
+    finally:
+        if own_cache:
+            cache.close()
+        if own_geolocator:
+            await geolocator.__aexit__(None, None, None)
+    return _to_geodataframe(results)
+
+
+class ProviderStats:
+    """Success and latency statistics of one provider over its recent requests."""
+
+    def __init__(self, window=200):
+        self.requests = 0
+        self.found = 0
+        self.misses = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.latencies = deque(maxlen=window)
+        # Elapsed time of requests cancelled or timed out: lower bounds of their latency
+        self.latencies_lower_bound = deque(maxlen=window)
+
+    def success_rate(self):
+        # Laplace smoothing, so untried providers start at 0.5; a request that
+        # lost a hedged race counts as not found
+        return (self.found + 1) / (self.requests + 2)
+
+    def latency(self, quantile=0.5):
+        """Latency quantile, using the elapsed time of unfinished requests as lower bounds."""
+        samples = list(self.latencies) + list(self.latencies_lower_bound)
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "found": self.found,
+            "misses": self.misses,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+            "success_rate": self.success_rate(),
+            "latency_p50": self.latency(0.5),
+            "latency_p95": self.latency(0.95),
+        }
+
+
+class MultiGeocoder:
+    """Geocoder combining several providers with fallback and hedged requests.
+
+    Providers are tried in order of observed success rate and median latency
+    (or in the given order with adaptive=False). On a miss, an error or a
+    timeout the next provider is tried; with hedge_after set, a request still
+    pending after that many seconds is duplicated on the next provider and
+    the first result found wins. Geolocators may be async (async_geolocator)
+    or synchronous geopy geolocators, which run in a worker thread.
+
+    MultiGeocoder exposes geocode() like a geopy async geolocator, so it can
+    be passed to geocode_addresses_async; each provider keeps its own rate
+    limiter.
+    """
+
+    def __init__(self, geolocators, hedge_after=None, timeout=10, adaptive=True, limiters=None):
+        self.geolocators = list(geolocators)
+        self.names = [provider_name(g) for g in self.geolocators]
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.adaptive = adaptive
+        self.limiters = limiters or {name: TokenBucket(rate_limit_for(g)) for name, g in zip(self.names, self.geolocators)}
+        self.provider_stats = {name: ProviderStats() for name in self.names}
+        self.domain = "+".join(str(getattr(g, "domain", "")) for g in self.geolocators)
+
+    def order(self):
+        """Return the (name, geolocator) pairs in the order they will be tried."""
+        providers = list(zip(self.names, self.geolocators))
+        if self.adaptive:
+            providers.sort(key=lambda p: (-self.provider_stats[p[0]].success_rate(), self.provider_stats[p[0]].latency()))
+        return providers
+
+    async def _attempt(self, name, geolocator, address, timeout):
+        """Query one provider; return (completed, location) and update its statistics."""
+        stats = self.provider_stats[name]
+        await self.limiters[name].acquire()
+        stats.requests += 1
+        start = time.monotonic()
+        try:
+            if isinstance(getattr(geolocator, "adapter", None), BaseAsyncAdapter) or inspect.iscoroutinefunction(geolocator.geocode):
+                request = geolocator.geocode(address, timeout=timeout)
+            else:
+                request = asyncio.to_thread(geolocator.geocode, address, timeout=timeout)
+            location = await asyncio.wait_for(request, timeout)
+        except asyncio.CancelledError:
+            stats.cancelled += 1  # Lost a hedged race
+            stats.latencies_lower_bound.append(time.monotonic() - start)
+            raise
+        except (GeocoderServiceError, asyncio.TimeoutError, OSError):
+            stats.errors += 1
+            stats.latencies_lower_bound.append(time.monotonic() - start)
+            return False, None
+        stats.latencies.append(time.monotonic() - start)
+        if location:
+            stats.found += 1
+        else:
+            stats.misses += 1
+        return True, location
+
+    async def geocode(self, address, timeout=None, **kwargs):
+        """Return the first location found, None if every provider misses.
+
+        Raises GeocoderTimedOut when no provider could answer, so the address
+        is retried and not cached as a miss.
+        """
+        timeout = timeout or self.timeout
+        queue = self.order()
+        running = {}
+        answered = False
+
+        def launch():
+            name, geolocator = queue.pop(0)
+            running[asyncio.ensure_future(self._attempt(name, geolocator, address, timeout))] = name
+
+        launch()
+        try:
+            while running:
+                hedge = self.hedge_after if queue else None
+                done, _ = await asyncio.wait(running, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch()  # Slow provider: hedge on the next one
+                    continue
+                for task in done:
+                    del running[task]
+                    completed, location = task.result()
+                    if location:
+                        return location
+                    answered = answered or completed
+                if not running and queue:
+                    launch()  # Miss or error: fall back to the next provider
+        finally:
+            for task in running:
+                task.cancel()
+        if not answered:
+            raise GeocoderTimedOut(f"No provider answered for {address!r}")
+        return None
+
+    def stats(self):
+        """Return per-provider statistics."""
+        return {name: stats.as_dict() for name, stats in self.provider_stats.items()}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        for geolocator in self.geolocators:
+            if isinstance(getattr(geolocator, "adapter", None), BaseAsyncAdapter):
+                await geolocator.__aexit__(*exc)
+
+
+def normalize_addresses(addresses):
+    """Return the canonical key of each address (vectorized over a pandas Series).
+
+    Removes accents, upper-cases, expands street-type abbreviations
+    (V.LE -> VIALE, P.ZZA -> PIAZZA, ...) and normalizes spacing and commas,
+    so spellings of the same address map to the same key.
+    """
+    keys = (
+        pd.Series(addresses, dtype="object").fillna("").astype(str)
+        .str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+        .str.upper()
+        .str.replace(r"\s*,\s*", ", ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip(" ,")
+    )
+    for pattern, replacement in ADDRESS_ABBREVIATIONS:
+        keys = keys.str.replace(pattern, replacement, regex=True)
+    return (
+        keys.str.replace(r"[^\w, /'-]", " ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.replace(r"(, )+", ", ", regex=True)
+        .str.strip(" ,")
+    )
+
+
+def address_keys(df, columns):
+    """Build canonical address keys from address part columns (e.g. street, number, town, province)."""
+    parts = [normalize_addresses(df[column]).reset_index(drop=True) for column in columns]
+    keys = parts[0]
+    for part in parts[1:]:
+        keys = keys.str.cat(part, sep=", ")
+    keys = keys.str.replace(r"(, )+", ", ", regex=True).str.strip(" ,")
+    keys.index = df.index
+    return keys
+
+
+def deduplicate_addresses(addresses):
+    """Return (keys, queries): the canonical key of every address and one original
+    address per distinct non-empty key (its first occurrence), to send to the geocoder."""
+    addresses = pd.Series(addresses, dtype="object")
+    keys = normalize_addresses(addresses)
+    keys.index = addresses.index
+    first = (keys != "") & ~keys.duplicated()
+    return keys, addresses[first].tolist()
+
+
+def broadcast_coordinates(df, keys, geocoded):
+    """Attach the coordinates geocoded per unique key to every row of df.
+
+    geocoded is the GeoDataFrame returned by the geocoders of this module for
+    the queries of deduplicate_addresses; its addresses are mapped back to
+    their canonical key. Rows whose key was not found keep NaN coordinates
+    and an empty geometry.
+    """
+    coords = geocoded[["Latitude", "Longitude"]].set_axis(normalize_addresses(geocoded["Address"]).tolist())
+    coords = coords[~coords.index.duplicated()]
+    out = df.copy()
+    out["AddressKey"] = keys.values
+    out["Latitude"] = out["AddressKey"].map(coords["Latitude"])
+    out["Longitude"] = out["AddressKey"].map(coords["Longitude"])
+    geometry = gpd.points_from_xy(out["Longitude"], out["Latitude"])
+    geometry[out["Latitude"].isna().values] = None
+    return gpd.GeoDataFrame(out, geometry=geometry, crs="EPSG:4326")
+
+
+def geocode_unique(df, address_column="Address", geocode=None, **kwargs):
+    """Geocode each distinct canonical address of df once and broadcast the result to all rows.
+
+    The geocoder receives the first original spelling of each address, not
+    the canonical key. geocode is any function of this module taking a list
+    of addresses (default geocode_addresses); kwargs are passed on. For the
+    async geocoder use deduplicate_addresses and broadcast_coordinates directly:
+        keys, queries = deduplicate_addresses(df["Address"])
+        gdf = broadcast_coordinates(df, keys, await geocode_addresses_async(queries, geolocator))
+    """
+    geocode = geocode or geocode_addresses
+    keys, queries = deduplicate_addresses(df[address_column])
+    print(f"{len(queries)} unique addresses out of {len(df)} rows")
+    return broadcast_coordinates(df, keys, geocode(queries, **kwargs))
+
+
 def plot_geocoded_points(gdf):
     """Plot geocoded points using GeoPandas."""
     gdf.plot(marker='o', color='red', alpha=0.6, figsize=(10, 6))
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# The repository root is not an installed package: make poste importable under plain pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def modulo():
+    """Modulo postal-simulation, caricato come nel benchmark."""
+    import benchmark_simulazione
+    return benchmark_simulazione.carica_simulatore()
+
+
+@pytest.fixture(scope="session")
+def percorsi_dati(tmp_path_factory):
+    """Dataset sintetico 'minimo' del benchmark (500 UP, 2000 LIS)."""
+    import benchmark_simulazione
+    cartella = str(tmp_path_factory.mktemp("dati"))
+    return benchmark_simulazione.genera_dati(cartella, *benchmark_simulazione.DIMENSIONI["minimo"])
+
+
+@pytest.fixture(scope="session")
+def simulazione(modulo, percorsi_dati):
+    return modulo.SimulazioneChiusuraUP(**percorsi_dati)
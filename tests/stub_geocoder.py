@@ -0,0 +1,77 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from geopy.geocoders import Nominatim
+
+
+class StubGeocoderServer:
+    """Local HTTP server answering Nominatim /search requests, for tests and benchmarks.
+
+    delay is the response time in seconds (a number or a function of the
+    query), queries starting with miss_prefix return no results and status
+    other than 200 simulates a failing provider.
+    """
+
+    def __init__(self, delay=0.0, miss_prefix=None, status=200, lat=41.9, lon=12.5):
+        self.delay = delay
+        self.miss_prefix = miss_prefix
+        self.status = status
+        self.lat = lat
+        self.lon = lon
+        self.queries = []
+        self._server = None
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+                stub.queries.append(query)
+                time.sleep(stub.delay(query) if callable(stub.delay) else stub.delay)
+                if stub.status != 200:
+                    self.send_response(stub.status)
+                    self.end_headers()
+                    return
+                found = not (stub.miss_prefix is not None and query.startswith(stub.miss_prefix))
+                body = json.dumps(
+                    [{"lat": str(stub.lat), "lon": str(stub.lon), "display_name": query, "place_id": 1}] if found else []
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client gave up (timeout or lost hedged race)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def domain(self):
+        return f"127.0.0.1:{self._server.server_port}"
+
+    def geolocator(self, **kwargs):
+        """Return a synchronous Nominatim geolocator pointing at this server."""
+        return Nominatim(user_agent="geo_app_test", domain=self.domain, scheme="http", **kwargs)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from geopy.exc import GeocoderTimedOut
+
+from poste.geocode_nominatim import (
+    GeocodeCache, MultiGeocoder, geocode_address, geocode_addresses, geocode_addresses_async,
+    normalize_address, normalize_addresses,
+)
+from stub_geocoder import StubGeocoderServer
+
+
+def geocode_all(geocoder, addresses):
+    async def run():
+        return [await geocoder.geocode(address) for address in addresses]
+    return asyncio.run(run())
+
+
+def test_slow_provider_is_ranked_after_fast_one():
+    with StubGeocoderServer(delay=0.3) as slow, StubGeocoderServer(delay=0.0) as fast:
+        geocoder = MultiGeocoder([slow.geolocator(), fast.geolocator()], hedge_after=0.05, adaptive=False)
+        locations = geocode_all(geocoder, [f"VIA ROMA {i}, ROMA" for i in range(4)])
+
+        assert all(location is not None for location in locations)
+        slow_stats = geocoder.provider_stats[geocoder.names[0]]
+        fast_stats = geocoder.provider_stats[geocoder.names[1]]
+        # Every slow request lost the hedged race: its latency comes from the lower bounds
+        assert slow_stats.cancelled == 4
+        assert slow_stats.latency() >= 0.05 > fast_stats.latency()
+        geocoder.adaptive = True
+        assert [name for name, _ in geocoder.order()] == [geocoder.names[1], geocoder.names[0]]
+
+
+def test_falls_back_on_miss_and_error():
+    with StubGeocoderServer(miss_prefix="VIA") as missing, StubGeocoderServer(status=500) as failing, \
+            StubGeocoderServer() as working:
+        geocoder = MultiGeocoder([missing.geolocator(), failing.geolocator(), working.geolocator()],
+                                 adaptive=False)
+        locations = geocode_all(geocoder, ["VIA ROMA 1, ROMA", "VIA ROMA 2, ROMA"])
+
+        assert all(location is not None for location in locations)
+        stats = geocoder.stats()
+        assert stats[geocoder.names[0]]["misses"] == 2
+        assert stats[geocoder.names[1]]["errors"] == 2
+        assert stats[geocoder.names[2]]["found"] == 2
+
+
+def test_miss_everywhere_returns_none_and_no_answer_raises():
+    with StubGeocoderServer(miss_prefix="") as missing, StubGeocoderServer(status=500) as failing:
+        assert geocode_all(MultiGeocoder([missing.geolocator()]), ["NOWHERE"]) == [None]
+        with pytest.raises(GeocoderTimedOut):
+            geocode_all(MultiGeocoder([failing.geolocator()]), ["NOWHERE"])
+
+
+def timed(coroutine):
+    """Run a coroutine and return (result, seconds) measured inside the loop.
+
+    asyncio.run also waits for the worker threads of synchronous geolocators,
+    which keep blocking on the slow stub after their request was abandoned.
+    """
+    async def run():
+        start = time.monotonic()
+        result = await coroutine
+        return result, time.monotonic() - start
+    return asyncio.run(run())
+
+
+def test_hedge_fires_at_configured_deadline():
+    with StubGeocoderServer(delay=1.0) as slow, StubGeocoderServer() as fast:
+        geocoder = MultiGeocoder([slow.geolocator(), fast.geolocator()], hedge_after=0.2, adaptive=False)
+        location, elapsed = timed(geocoder.geocode("VIA ROMA 1, ROMA"))
+
+        assert location is not None
+        assert 0.2 <= elapsed < 0.8
+        assert fast.queries == ["VIA ROMA 1, ROMA"]
+
+
+def test_batch_geocoder_keeps_provider_timeout():
+    with StubGeocoderServer(delay=1.0) as slow:
+        geocoder = MultiGeocoder([slow.geolocator()], timeout=0.2)
+        gdf, elapsed = timed(geocode_addresses_async(["VIA ROMA 1, ROMA"], geocoder, retries=1))
+
+        assert len(gdf) == 0
+        assert elapsed < 0.8
+        assert geocoder.stats()[geocoder.names[0]]["errors"] == 1
+
+
+@pytest.mark.parametrize("address", [
+    "Loc. Colle, 12, Arezzo",
+    "LOC COLLE 12 AREZZO",
+    "Fraz. San Pietro, Via Roma 3",
+    "via  dei Florentini ,  Roma",
+    "Via Filocamo 4, Fraz Bosco",
+    "V.le Europa, loc. Pian di Scò",
+    "",
+])
+def test_scalar_and_vectorized_normalization_agree(address):
+    assert normalize_address(address) == normalize_addresses([address]).iloc[0]
+    assert normalize_address(address) == normalize_addresses(pd.Series([address, address])).iloc[1]
+
+
+def test_loc_fraz_expanded_only_at_part_start():
+    assert normalize_address("Loc. Colle, 12, Arezzo") == "LOCALITA COLLE, 12, AREZZO"
+    assert normalize_address("Via Filocamo 4, Fraz Bosco") == "VIA FILOCAMO 4, FRAZIONE BOSCO"
+    assert normalize_address("Via Floc 2") == "VIA FLOC 2"
+
+
+class FakeGeolocator:
+    """Synchronous geolocator answering from a dict and recording its queries."""
+
+    domain = "fake"
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = []
+
+    def geocode(self, address, timeout=None):
+        self.queries.append(address)
+        coords = self.answers.get(address)
+        return SimpleNamespace(latitude=coords[0], longitude=coords[1]) if coords else None
+
+
+def test_cached_misses_are_retried_on_request(tmp_path):
+    geolocator = FakeGeolocator({})
+    with GeocodeCache(str(tmp_path / "cache.sqlite")) as cache:
+        assert geocode_address(geolocator, "VIA NUOVA 1, ROMA", cache=cache) == (None, None)
+        # The miss is cached: no new query by default
+        assert geocode_address(geolocator, "VIA NUOVA 1, ROMA", cache=cache) == (None, None)
+        assert len(geolocator.queries) == 1
+
+        geolocator.answers["VIA NUOVA 1, ROMA"] = (41.9, 12.5)
+        assert geocode_address(geolocator, "VIA NUOVA 1, ROMA", cache=cache, retry_misses=True) == (41.9, 12.5)
+        assert len(geolocator.queries) == 2
+        # The refreshed entry is a hit from now on
+        assert geocode_address(geolocator, "VIA NUOVA 1, ROMA", cache=cache) == (41.9, 12.5)
+        assert len(geolocator.queries) == 2
+
+        geolocator.answers["VIA NUOVA 2, ROMA"] = (41.8, 12.4)
+        cache.set("VIA NUOVA 2, ROMA", "fakegeolocator:fake", None, None)
+        gdf = geocode_addresses(["VIA NUOVA 1, ROMA", "VIA NUOVA 2, ROMA"], cache=cache, geolocator=geolocator,
+                                min_delay=0.0)
+        assert gdf["Address"].tolist() == ["VIA NUOVA 1, ROMA"]
+        gdf = geocode_addresses(["VIA NUOVA 1, ROMA", "VIA NUOVA 2, ROMA"], cache=cache, geolocator=geolocator,
+                                min_delay=0.0, retry_misses=True)
+        assert gdf["Address"].tolist() == ["VIA NUOVA 1, ROMA", "VIA NUOVA 2, ROMA"]
+        assert geolocator.queries[2:] == ["VIA NUOVA 2, ROMA"]
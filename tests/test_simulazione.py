@@ -0,0 +1,184 @@
+import itertools
+
+import numpy as np
+import pytest
+
+
+def test_mappa_geojson_senza_riceventi(simulazione):
+    # Raggio di 1 m: nessun UP né LIS nel bacino dell'ufficio chiuso
+    risultati = simulazione.simula_chiusura_up(1, {'raggio_base': 1})
+    assert not any(dettaglio.get('lis_vicini') for dettaglio in risultati['redistribuzione'].values())
+
+    html = simulazione.visualizza_mappa_redistribuzione(risultati, modalita='geojson').get_root().render()
+    assert 'UP chiusi' in html
+    assert 'LIS riceventi' not in html
+
+
+def test_mappa_geojson_uffici_senza_lis(simulazione):
+    for id_up in range(1, 20):
+        risultati = simulazione.simula_chiusura_up(id_up)
+        simulazione.visualizza_mappa_redistribuzione(risultati, modalita='geojson').get_root().render()
+
+
+def test_mappa_scenario_vuoto(simulazione):
+    risultati = simulazione.simula_scenario_chiusure([])
+    mappa = simulazione.visualizza_mappa_scenario(risultati)
+    assert np.isfinite(mappa.location).all()
+    mappa.get_root().render()
+
+
+BACINI = {
+    'raggio': {'bacino': {'modalita': 'raggio'}},
+    'knn': {'bacino': {'modalita': 'knn', 'k': 1}},
+}
+
+
+def perdita_scenario(scenario):
+    return float(scenario['totali'][['competitor', 'digitale', 'non_ricollocato']].to_numpy().sum())
+
+
+def coppie_mutue(simulazione, n):
+    """ID di n coppie di uffici in cui ciascuno è l'UP più vicino dell'altro."""
+    archivio = simulazione.archivio_up
+    _, indici = simulazione.up_tree.query(np.radians(np.column_stack([archivio.lat, archivio.lon])), k=2)
+    vicino = indici[:, 1]
+    posizioni = np.arange(len(vicino))
+    prime = np.flatnonzero((vicino[vicino] == posizioni) & (posizioni < vicino))[:n]
+    return archivio.ids[np.concatenate([prime, vicino[prime]])].tolist()
+
+
+def test_scenario_knn_senza_perdite(simulazione):
+    # Ogni ufficio chiuso ha k vicini aperti, per cui nessuna quota può andare persa
+    ids = simulazione.df_up['id'].to_numpy()
+    scenario = simulazione.simula_scenario_chiusure(ids[::2], BACINI['knn'])
+    assert np.isclose(scenario['totali']['non_ricollocato'].sum(), 0.0, atol=1e-6)
+
+
+@pytest.mark.parametrize('bacino', sorted(BACINI))
+def test_ottimizza_chiusure_coerente_con_scenario(simulazione, bacino):
+    # Con le coppie di vicini reciproci tutte chiuse il bacino knn a k=1 non ha archi
+    # verso uffici aperti nel grafo iniziale
+    candidati = coppie_mutue(simulazione, 10)
+    risultati = simulazione.ottimizza_chiusure(len(candidati), candidati, BACINI[bacino], ricerca_locale=False)
+    assert sorted(risultati['ids_up']) == sorted(candidati)
+    assert np.isclose(risultati['perdita'], perdita_scenario(risultati['scenario']))
+
+    risultati = simulazione.ottimizza_chiusure(8, candidati, BACINI[bacino], max_iterazioni=5)
+    assert np.isclose(risultati['perdita'], perdita_scenario(risultati['scenario']))
+
+
+def uffici_vicini(simulazione, posizione, n):
+    """ID dell'ufficio in posizione e dei suoi n - 1 UP più vicini."""
+    archivio = simulazione.archivio_up
+    _, indici = simulazione.up_tree.query(np.radians([[archivio.lat[posizione], archivio.lon[posizione]]]), k=n)
+    return archivio.ids[indici[0]].tolist()
+
+
+@pytest.mark.parametrize('bacino', sorted(BACINI))
+def test_ottimizzatore_delta_incrementali(modulo, simulazione, bacino):
+    # Uffici vicini tra loro, per cui le chiusure interagiscono nel grafo dei vicini
+    candidati = uffici_vicini(simulazione, 0, 8)
+    ottimizzatore = modulo.OttimizzatoreChiusure(simulazione, candidati, BACINI[bacino])
+
+    def perdita(indici):
+        ids = [candidati[i] for i in indici]
+        return perdita_scenario(simulazione.simula_scenario_chiusure(ids, BACINI[bacino]))
+
+    for mossa, j in [('aggiungi', 0), ('aggiungi', 3), ('aggiungi', 1), ('rimuovi', 3),
+                     ('aggiungi', 5), ('rimuovi', 0), ('aggiungi', 2)]:
+        getattr(ottimizzatore, mossa)(j)
+        chiusi = list(np.flatnonzero(ottimizzatore.chiuso))
+        attuale = perdita(chiusi)
+        assert np.isclose(ottimizzatore.perdita, attuale)
+        for v in np.flatnonzero(~ottimizzatore.chiuso):
+            assert np.isclose(ottimizzatore.delta[v], perdita(chiusi + [v]) - attuale), (mossa, j, v)
+
+
+@pytest.mark.parametrize('bacino', sorted(BACINI))
+def test_ottimizzatore_greedy_contro_forza_bruta(modulo, simulazione, bacino):
+    candidati = uffici_vicini(simulazione, 0, 8)
+    for k in (3, 5):
+        ottima = min(
+            perdita_scenario(simulazione.simula_scenario_chiusure(list(ids), BACINI[bacino]))
+            for ids in itertools.combinations(candidati, k)
+        )
+        ottimizzatore = modulo.OttimizzatoreChiusure(simulazione, candidati, BACINI[bacino])
+        ottimizzatore.greedy(k)
+        assert ottimizzatore.perdita >= ottima - 1e-6
+        soluzione = ottimizzatore.ricerca_locale()
+        assert len(soluzione) == k
+        assert np.isclose(ottimizzatore.perdita, ottima)
+
+
+def test_chiusura_formato_sparso(simulazione, monkeypatch):
+    import matplotlib
+    import matplotlib.pyplot as plt
+    matplotlib.use('Agg')
+    monkeypatch.setattr(plt, 'show', lambda: None)
+
+    dizionario = simulazione.simula_chiusura_up(1)
+    sparso = simulazione.simula_chiusura_up(1, formato='sparso')
+    assert 'redistribuzione' not in sparso
+
+    ricostruita = simulazione._redistribuzione(sparso)
+    assert list(ricostruita) == list(dizionario['redistribuzione'])
+    for servizio, dettaglio in dizionario['redistribuzione'].items():
+        assert set(ricostruita[servizio]) == set(dettaglio)
+        for chiave, valore in dettaglio.items():
+            if isinstance(valore, dict):
+                assert ricostruita[servizio][chiave].keys() == valore.keys()
+                assert np.allclose([ricostruita[servizio][chiave][i] for i in valore], list(valore.values()))
+            else:
+                assert np.isclose(ricostruita[servizio][chiave], valore)
+
+    simulazione.visualizza_risultati(sparso, mostra_mappa=False)
+    for modalita in ('marker', 'geojson'):
+        simulazione.visualizza_mappa_redistribuzione(sparso, modalita).get_root().render()
+
+
+def test_cache_dati_versioni(modulo, percorsi_dati, tmp_path, monkeypatch):
+    file_input = [percorsi_dati[nome] for nome in ('file_up', 'file_lis', 'file_banche',
+                                                    'file_sezioni_censimento', 'file_presenze')]
+    chiave = modulo.chiave_cache(file_input)
+    modulo.SimulazioneChiusuraUP(**percorsi_dati, cartella_cache=str(tmp_path))
+    (tmp_path / 'tempi_0123').mkdir()
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([chiave, 'tempi_0123'])
+
+    # Una versione diversa di scikit-learn cambia la chiave e sostituisce la cache
+    monkeypatch.setattr(modulo.sklearn, '__version__', '0.0.0')
+    nuova = modulo.chiave_cache(file_input)
+    assert nuova != chiave
+    simulazione = modulo.SimulazioneChiusuraUP(**percorsi_dati, cartella_cache=str(tmp_path))
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([nuova, 'tempi_0123'])
+    assert len(simulazione.archivio_up) == len(simulazione.df_up)
+
+
+def test_statistiche_worker_unite(modulo, simulazione, tmp_path):
+    ids = simulazione.df_up['id'].to_numpy()[:40]
+    simulazione.statistiche.azzera()
+    simulazione.simula_chiusure_parallelo(ids, n_processi=2, dimensione_blocco=10)
+    statistiche = simulazione.statistiche.a_dict()
+    assert statistiche['fasi']['simula_chiusure_batch']['chiamate'] == 4
+    assert statistiche['contatori']['uffici_simulati'] == 40
+
+    simulazione.statistiche.azzera()
+    simulazione.simula_sweep(ids, [{}, {'raggio_base': 500}], str(tmp_path / 'sweep'),
+                             dimensione_blocco=20, n_processi=2)
+    statistiche = simulazione.statistiche.a_dict()
+    assert statistiche['fasi']['simula_chiusure_batch']['chiamate'] == 4
+    assert statistiche['contatori']['uffici_simulati'] == 80
+
+
+def test_statistiche_unisci(modulo):
+    statistiche = modulo.StatisticheTempi()
+    statistiche.unisci({'fasi': {'a': {'chiamate': 2, 'totale_s': 1.0, 'medio_s': 0.5, 'massimo_s': 0.75}},
+                        'contatori': {'n': 3}})
+    statistiche.unisci({'fasi': {'a': {'chiamate': 1, 'totale_s': 0.5, 'medio_s': 0.5, 'massimo_s': 0.5}},
+                        'contatori': {'n': 1}})
+    assert statistiche.a_dict() == {
+        'fasi': {'a': {'chiamate': 3, 'totale_s': 1.5, 'medio_s': 0.5, 'massimo_s': 0.75}},
+        'contatori': {'n': 4}
+    }
+    spenta = modulo.StatisticheTempi(attiva=False)
+    spenta.unisci(statistiche.a_dict())
+    assert spenta.a_dict() == {'fasi': {}, 'contatori': {}}